@@ -0,0 +1,98 @@
+# Measures the AWS Lambda's cold start for each action: importing stubhubzlambda, building StubHubz (and the StubHub API
+# if the action needs it), and the imports and AWS clients the action sets up when it first runs. Each action is
+# measured in a fresh Python process, as a cold Lambda container would be, then again in the same process as a warm
+# invocation would be. Nothing is sent to StubHub or AWS.
+#
+# Usage: python benchmarks/startup.py [--repeat <n>] [--json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['botocore', 'pynamodb', 'requests', 'numpy']
+# What each action imports and which AWS clients it creates when it runs (beyond what getStubHubz() sets up)
+ACTIONS = {
+    'scrape': (['stubhubz.aggregate', 'stubhubz.jsonstream'], ['sns']),
+    'scrape_shard': (['stubhubz.aggregate', 'stubhubz.jsonstream'], ['sns']),
+    'compact_price_history': (['stubhubz.rollup'], []),
+    'dump_price_history': (['stubhubz.export'], ['s3'])
+}
+ENVIRONMENT = {
+    'STUBHUBZ_DEBUG': 'False',
+    'STUBHUBZ_REGION': 'us-east-1',
+    'STUBHUBZ_STUBHUB_V2_CONSUMER_KEY': 'benchmark',
+    'STUBHUBZ_STUBHUB_V2_CONSUMER_SECRET': 'benchmark',
+    'STUBHUBZ_STUBHUB_V2_SCOPE': 'benchmark',
+    'STUBHUBZ_STUBHUB_V3_CONSUMER_KEY': 'benchmark',
+    'STUBHUBZ_STUBHUB_V3_CONSUMER_SECRET': 'benchmark',
+    'STUBHUBZ_STUBHUB_USER': 'benchmark',
+    'STUBHUBZ_STUBHUB_PASSWORD': 'benchmark',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark'
+}
+
+def measure(action):
+    """Runs in the child process. Returns the milliseconds each startup step of 'action' took."""
+    _timings = {}
+    _started = time.perf_counter()
+    import stubhubzlambda
+    _timings['import'] = _elapsed(_started)
+    _started = time.perf_counter()
+    stubhubzlambda.getStubHubz(action)
+    _timings['init'] = _elapsed(_started)
+    _started = time.perf_counter()
+    _modules, _clients = ACTIONS[action]
+    for _module in _modules:
+        __import__(_module)
+    from stubhubz.aws import get_client
+    for _client in _clients:
+        get_client(_client, ENVIRONMENT['STUBHUBZ_REGION'])
+    _timings['first_use'] = _elapsed(_started)
+    _timings['cold_total'] = _timings['import'] + _timings['init'] + _timings['first_use']
+    _started = time.perf_counter()
+    stubhubzlambda.getStubHubz(action)
+    for _client in _clients:
+        get_client(_client, ENVIRONMENT['STUBHUBZ_REGION'])
+    _timings['warm'] = _elapsed(_started)
+    _timings['modules'] = [_module for _module in HEAVY_MODULES if _module in sys.modules]
+    return _timings
+
+def _elapsed(started):
+    return (time.perf_counter() - started) * 1000
+
+def run(action):
+    _environment = dict(os.environ, **ENVIRONMENT)
+    _environment['PYTHONPATH'] = ROOT
+    _output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', action], env=_environment, cwd=ROOT, check=True,
+            stdout=subprocess.PIPE).stdout
+    return json.loads(_output.decode('utf-8').strip().splitlines()[-1])
+
+def main():
+    _parser = argparse.ArgumentParser(description='Measures the StubHubz AWS Lambda\'s import and init cost for each action')
+    _parser.add_argument('--repeat', type=int, default=5, help='How many cold starts to measure per action (the median is reported)')
+    _parser.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+    _parser.add_argument('--child', help=argparse.SUPPRESS)
+    _args = _parser.parse_args()
+    if _args.child is not None:
+        print(json.dumps(measure(_args.child)))
+        return
+    if not _args.json:
+        print('{:24} {:>9} {:>9} {:>10} {:>10} {:>9}  {}'.format('action', 'import', 'init', 'first use', 'cold total', 'warm', 'modules loaded'))
+    for _action in ACTIONS:
+        _runs = [run(_action) for _ in range(_args.repeat)]
+        _result = {'action': _action, 'modules': _runs[-1]['modules']}
+        for _step in ['import', 'init', 'first_use', 'cold_total', 'warm']:
+            _result[_step] = round(statistics.median(_run[_step] for _run in _runs), 2)
+        if _args.json:
+            print(json.dumps(_result))
+        else:
+            print('{:24} {:>7.1f}ms {:>7.1f}ms {:>8.1f}ms {:>8.1f}ms {:>7.2f}ms  {}'.format(_action, _result['import'], _result['init'],
+                    _result['first_use'], _result['cold_total'], _result['warm'], ', '.join(_result['modules'])))
+
+if __name__ == '__main__':
+    main()
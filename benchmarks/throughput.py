@@ -0,0 +1,457 @@
+# Measures scrape and export throughput offline. A fake StubHub API (run in its own process so it doesn't skew the
+# timings or memory) serves responses built from the samples/ fixtures, scaled to N events x Z zones x L listings per
+# zone, with optional latency and injected 429s. Events and price history go to a throwaway SQLite database (or an
+# in-memory one, or a local DynamoDB stand-in such as DynamoDB Local) and S3 and SNS are replaced by in-memory stand-ins.
+# Each scenario reports events per second, StubHub requests per event, peak (traced Python and NumPy) memory, and the
+# bytes exported to S3. Tracing memory makes everything several times slower, use --no-memory for representative times:
+#  - scrape: StubHubz.scrape() as the 'scrape' command runs it, --scrapes times with prices moving between scrapes
+#  - export: StubHubz.export_price_history() of every event as 'dump-price-history --s3' runs it
+#  - lambda: stubhubzlambda.handler() for a 'scrape' action, then for the 'dump_price_history' SNS messages it published
+#
+# Usage: python benchmarks/throughput.py [--events <n>] [--zones <n>] [--listings <n>] [--latency <ms>] [--throttle <fraction>]
+#            [--storage memory|sqlite:<path>|dynamodb:<endpoint>] [--no-memory] [--json]
+#
+# Don't point --storage at a real DynamoDB: the benchmark creates and drops the tables.
+
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLES = os.path.join(ROOT, 'samples')
+STUBHUB_URL = 'https://api.stubhub.com/'
+REGION = 'us-east-1'
+S3_BUCKET = 'stubhubz-benchmark'
+S3_KEY_PREFIX = 'benchmark'
+SNS_TOPIC = 'arn:aws:sns:us-east-1:000000000000:stubhubz-benchmark'
+FIRST_EVENT_ID = 100000
+SCENARIOS = ['scrape', 'export', 'lambda']
+ENVIRONMENT = { # for the 'lambda' scenario
+    'STUBHUBZ_DEBUG': 'False',
+    'STUBHUBZ_REGION': REGION,
+    'STUBHUBZ_STUBHUB_V2_CONSUMER_KEY': 'benchmark',
+    'STUBHUBZ_STUBHUB_V2_CONSUMER_SECRET': 'benchmark',
+    'STUBHUBZ_STUBHUB_V2_SCOPE': 'benchmark',
+    'STUBHUBZ_STUBHUB_V3_CONSUMER_KEY': 'benchmark',
+    'STUBHUBZ_STUBHUB_V3_CONSUMER_SECRET': 'benchmark',
+    'STUBHUBZ_STUBHUB_USER': 'benchmark',
+    'STUBHUBZ_STUBHUB_PASSWORD': 'benchmark',
+    'STUBHUBZ_SCHEDULE': 'false',
+    'STUBHUBZ_SNS_TOPIC': SNS_TOPIC,
+    'STUBHUBZ_S3_BUCKET': S3_BUCKET,
+    'STUBHUBZ_S3_KEY_PREFIX': S3_KEY_PREFIX
+}
+
+class FakeStubHub:
+    """The StubHub API endpoints StubHubz calls, answered from the samples/ fixtures. Events are FIRST_EVENT_ID onwards,
+    each with 'zones' zones (the sample venue's zones, repeated as needed) of 'listings' listings (the sample listings
+    with generated prices and quantities). Each round moves the prices of a third of the zones, so consecutive scrapes
+    see some zones change and some not (and events whose ticket info, i.e. cheapest and dearest price, didn't change are
+    skipped by change detection). As on StubHub, an event's listings also include one without a zone, which only shows up
+    when they aren't requested zone by zone."""
+
+    def __init__(self, events, zones, listings, latency=0, throttle=0):
+        self.events = events
+        self.listings = listings
+        self.latency = latency # seconds added to every response
+        self.throttle = throttle # fraction of StubHub API requests answered with a 429
+        self.round = 0
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._tickets = {} # (event ID, zone index) -> total tickets
+        _inventory = _load_sample('stubhub_v2_inventory_search_response.json')
+        self._event_template = _load_sample('stubhub_v3_event_response.json')['events'][0]
+        _sample_zones = collections.OrderedDict()
+        for _section in _inventory['section_stats']:
+            _zone = _sample_zones.setdefault(_section['zoneId'], {'name': _section['zoneName'], 'sections': [], 'price': _section['minTicketPrice']})
+            _zone['sections'].append({'id': _section['sectionId'], 'name': _section['sectionName']})
+            _zone['price'] = min(_zone['price'], _section['minTicketPrice'])
+        _templates = collections.defaultdict(list)
+        for _listing in _inventory['listing']:
+            _templates[_listing['zoneId']].append(_listing)
+        self.zones = []
+        for _index in range(zones):
+            _zone_id, _zone = list(_sample_zones.items())[_index % len(_sample_zones)]
+            _repeat = _index // len(_sample_zones)
+            self.zones.append({
+                'id': _zone_id if _repeat == 0 else 990000 + _index,
+                'name': _zone['name'] if _repeat == 0 else '{} {}'.format(_zone['name'], _repeat + 1),
+                'sections': _zone['sections'],
+                'price': round(_zone['price'], 2),
+                'templates': _templates.get(_zone_id) or _inventory['listing']
+            })
+        self._zone_indices = {_zone['id']: _index for _index, _zone in enumerate(self.zones)}
+
+    def handle(self, method, path, query):
+        """Returns the (status, response) of a request"""
+        if path == '/benchmark/stats':
+            with self._lock:
+                return 200, dict(self.stats)
+        if path == '/benchmark/round':
+            self.round = int(query['round'])
+            return 200, {'round': self.round}
+        with self._lock:
+            self._requests += 1
+            _throttled = self.throttle > 0 and int(self._requests * self.throttle) != int((self._requests - 1) * self.throttle)
+            self.stats['requests'] += 1
+            self.stats['throttled'] += 1 if _throttled else 0
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if _throttled:
+            return 429, {'code': 'TooManyRequests', 'description': 'Injected by the benchmark'}
+        if method == 'POST' and path in ['/sellers/oauth/accesstoken', '/login']:
+            return 200, {'access_token': 'benchmark', 'refresh_token': 'benchmark', 'expires_in': 3600}
+        if path == '/sellers/search/events/v3':
+            _event_ids = [int(_event_id) for _event_id in query.get('id', '').split('|') if _event_id]
+            _events = [self._event(_event_id) for _event_id in _event_ids if self._has_event(_event_id)]
+            return 200, {'numFound': len(_events), 'events': _events}
+        if path.startswith('/partners/catalog/events/v3/') and path.endswith('/sectionZones'):
+            return 200, {'zones': [{'id': _zone['id'], 'name': _zone['name'], 'sections': _zone['sections']} for _zone in self.zones]}
+        if path == '/sellers/find/listings/v3/':
+            return 200, self._listings_page(int(query['eventid']), query.get('zoneIdList'), int(query.get('start', 0)), int(query.get('rows', 100)))
+        return 404, {'code': 'NotFound', 'description': path}
+
+    def _has_event(self, event_id):
+        return FIRST_EVENT_ID <= event_id < FIRST_EVENT_ID + self.events
+
+    def _event(self, event_id):
+        _event = dict(self._event_template, id=event_id)
+        _prices = [self._price(event_id, _index, 0) for _index in range(len(self.zones))]
+        _event['ticketInfo'] = {'minListPrice': min(_prices), 'maxListPrice': max(self._price(event_id, _index, self.listings - 1)
+                for _index in range(len(self.zones))), 'totalTickets': sum(self._zone_tickets(event_id, _index) for _index in range(len(self.zones))),
+                'totalListings': self.listings * len(self.zones)}
+        return _event
+
+    def _listings_page(self, event_id, zone_id, start, rows):
+        if zone_id is not None:
+            _zone_index = self._zone_indices[int(zone_id)]
+            _total_listings = self.listings
+            _total_tickets = self._zone_tickets(event_id, _zone_index)
+            _listings = [self._listing(event_id, _zone_index, _index) for _index in range(start, min(start + rows, _total_listings))]
+        else: # the listing without a zone, then every zone's listings one after another
+            _total_listings = self.listings * len(self.zones) + 1
+            _total_tickets = sum(self._zone_tickets(event_id, _index) for _index in range(len(self.zones))) + self._quantity(event_id, 0, 0)
+            _listings = [self._listing(event_id, (_index - 1) // self.listings, (_index - 1) % self.listings) if _index > 0
+                    else self._unzoned_listing(event_id) for _index in range(start, min(start + rows, _total_listings))]
+        return {'eventId': event_id, 'totalListings': _total_listings, 'totalTickets': _total_tickets, 'start': start, 'rows': len(_listings),
+                'listings': _listings}
+
+    def _listing(self, event_id, zone_index, index):
+        _zone = self.zones[zone_index]
+        _price = self._price(event_id, zone_index, index)
+        _listing = dict(_zone['templates'][index % len(_zone['templates'])])
+        _listing.update({'listingId': event_id * 10 ** 6 + zone_index * 10 ** 4 + index, 'currentPrice': {'amount': _price, 'currency': 'USD'},
+                'listingPrice': {'amount': round(_price * 0.85, 2), 'currency': 'USD'}, 'pricePerProduct': {'amount': _price, 'currency': 'USD'},
+                'quantity': self._quantity(event_id, zone_index, index), 'zoneId': _zone['id'], 'zoneName': _zone['name']})
+        return _listing
+
+    def _unzoned_listing(self, event_id):
+        _listing = self._listing(event_id, 0, 0)
+        _listing['listingId'] = event_id * 10 ** 6 + 9999
+        del _listing['zoneId']
+        del _listing['zoneName']
+        return _listing
+
+    def _price(self, event_id, zone_index, index):
+        """Listings' prices rise through the zone. A third of the zones are 1% dearer each round."""
+        _moved = len([_round for _round in range(1, self.round + 1) if (zone_index + _round) % 3 == 0])
+        _base = self.zones[zone_index]['price'] * (1 + (event_id % 10) / 20) * (1.01 ** _moved)
+        return round(_base * (1 + index / max(1, self.listings)), 2)
+
+    def _quantity(self, event_id, zone_index, index):
+        return 1 + (index * 7 + zone_index + event_id) % 4
+
+    def _zone_tickets(self, event_id, zone_index):
+        _key = (event_id, zone_index)
+        if _key not in self._tickets:
+            self._tickets[_key] = sum(self._quantity(event_id, zone_index, _index) for _index in range(self.listings))
+        return self._tickets[_key]
+
+def serve(args):
+    """Runs in the server process. Prints the port then serves until killed."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    _stubhub = FakeStubHub(args.events, args.zones, args.listings, args.latency / 1000, args.throttle)
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, like StubHub
+        disable_nagle_algorithm = True # otherwise the headers and body are sent in separate packets and wait for a delayed ACK
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._respond('POST')
+
+        def _respond(self, method):
+            _url = urllib.parse.urlsplit(self.path)
+            _status, _response = _stubhub.handle(method, _url.path, dict(urllib.parse.parse_qsl(_url.query)))
+            _body = json.dumps(_response).encode('utf-8')
+            self.send_response(_status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    _server.daemon_threads = True
+    print(_server.server_port, flush=True)
+    _server.serve_forever()
+
+class FakeS3Error(Exception):
+    """An S3 error with its code where botocore's ClientError keeps it"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+class FakeS3:
+    """The S3 calls the exporters make, kept in memory (with ETags for conditional writes)"""
+
+    def __init__(self):
+        self.objects = {}
+        self.bytes = 0
+        self.puts = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Body, Bucket, Key, IfMatch=None, IfNoneMatch=None, **kwargs):
+        with self._lock:
+            _current = self.objects.get((Bucket, Key))
+            if IfMatch is not None and (_current is None or self._etag(_current) != IfMatch):
+                raise FakeS3Error('PreconditionFailed')
+            if IfNoneMatch == '*' and _current is not None:
+                raise FakeS3Error('PreconditionFailed')
+            self.objects[(Bucket, Key)] = Body
+            self.bytes += len(Body)
+            self.puts += 1
+
+    def get_object(self, Bucket, Key):
+        _body = self.objects.get((Bucket, Key))
+        if _body is None:
+            raise FakeS3Error('NoSuchKey')
+        return {'Body': io.BytesIO(_body), 'ETag': self._etag(_body)}
+
+    @staticmethod
+    def _etag(body):
+        return '"{:x}"'.format(hash(body))
+
+class FakeSns:
+    """Keeps the messages published (as SNS delivers them to a subscribed Lambda)"""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message, MessageStructure=None, **kwargs):
+        self.messages.append(json.loads(Message)['default'] if MessageStructure == 'json' else Message)
+
+class _LambdaContext:
+    function_name = 'stubhubz-benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+def redirect_stubhub(session, base_url):
+    """Sends the requests 'session' makes to the StubHub API to 'base_url' instead, through the session's own adapter so
+    its connection pooling and retries still apply"""
+    from requests.adapters import BaseAdapter
+    _adapter = session.get_adapter(base_url)
+
+    class _RedirectAdapter(BaseAdapter):
+        def send(self, request, **kwargs):
+            request.url = base_url + request.url[len(STUBHUB_URL):]
+            return _adapter.send(request, **kwargs)
+
+        def close(self):
+            _adapter.close()
+    session.mount(STUBHUB_URL, _RedirectAdapter())
+
+def get_benchmark_storage(spec, directory):
+    """Returns the storage for 'spec' and the spec the Lambda should use for the same data (or None if it can't)"""
+    from stubhubz.storage import get_storage
+    if spec is None:
+        spec = 'sqlite:' + os.path.join(directory, 'benchmark.db')
+    if spec == 'memory':
+        return get_storage('sqlite::memory:'), None
+    if spec.startswith('dynamodb:'):
+        _endpoint = spec[len('dynamodb:'):]
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark') # a stand-in accepts any credentials
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        import stubhubz.dynamodb
+        from pynamodb.models import Model
+        for _model in vars(stubhubz.dynamodb).values():
+            if isinstance(_model, type) and issubclass(_model, Model) and _model is not Model:
+                _model.Meta.host = _endpoint
+                _model.Meta.region = REGION
+        return get_storage('dynamodb', REGION, _endpoint), 'dynamodb'
+    return get_storage(spec), spec
+
+def add_events(storage, events):
+    _now = datetime.datetime.now(datetime.timezone.utc)
+    for _index in range(events):
+        _event_id = FIRST_EVENT_ID + _index
+        storage.add_event(_event_id)
+        _event = storage.get_event(_event_id)
+        _event.name = 'Benchmark event {}'.format(_index + 1)
+        _event.primary_performer = 'Benchmark'
+        _event.venue_name = 'Benchmark Arena'
+        _event.venue_city = 'Boston'
+        _event.event_status = 'Active'
+        _event.scrape_status = 'Active'
+        _event.date_time = _now + datetime.timedelta(days=1 + _index % 60)
+        storage.save_event(_event)
+    return [FIRST_EVENT_ID + _index for _index in range(events)]
+
+class Benchmark:
+    def __init__(self, args, server_url, storage, lambda_storage):
+        from stubhubz.aws import set_client
+        from stubhubz.session import get_session
+        from stubhubz.stubhub import StubHubApi
+        from stubhubz.stubhubz import StubHubz
+        self.args = args
+        self.server_url = server_url
+        self.lambda_storage = lambda_storage
+        self.s3 = FakeS3()
+        self.sns = FakeSns()
+        set_client('s3', self.s3, REGION)
+        set_client('sns', self.sns, REGION)
+        _session = get_session('stubhub', pool_size=max(10, args.workers))
+        redirect_stubhub(_session, server_url)
+        _stubhub = StubHubApi('benchmark', 'benchmark', 'benchmark', 'benchmark', 'benchmark', 'benchmark', 'benchmark', session=_session)
+        self.stubhubz = StubHubz(_stubhub, None, storage, REGION, False, args.workers, args.mode)
+        self.event_ids = add_events(storage, args.events)
+        self._round = 0
+
+    def run(self, scenario):
+        """Returns the result of 'scenario'"""
+        _server_stats = self._server_stats()
+        _s3_bytes = self.s3.bytes
+        _s3_puts = self.s3.puts
+        if self.args.memory:
+            tracemalloc.start()
+        _started = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if self.args.verbose else open(os.devnull, 'w')):
+            _events = getattr(self, '_' + scenario)()
+        _elapsed = time.perf_counter() - _started
+        _peak = None
+        if self.args.memory:
+            _, _peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        _requests = self._server_stats()['requests'] - _server_stats['requests']
+        return {'scenario': scenario, 'events': _events, 'seconds': round(_elapsed, 3), 'events_per_second': round(_events / _elapsed, 2),
+                'requests_per_event': round(_requests / max(1, _events), 2), 'throttled': self._server_stats()['throttled'] - _server_stats['throttled'],
+                'peak_memory_kib': round(_peak / 1024) if _peak is not None else None, 'export_bytes': self.s3.bytes - _s3_bytes, 's3_puts': self.s3.puts - _s3_puts}
+
+    def _scrape(self):
+        _scraped = 0
+        for _ in range(self.args.scrapes):
+            self._next_round()
+            _scraped += len(self.stubhubz.scrape())
+        return _scraped
+
+    def _export(self):
+        for _event_id in self.event_ids:
+            self.stubhubz.export_price_history(_event_id, S3_BUCKET, S3_KEY_PREFIX, False, self.args.format)
+        return len(self.event_ids)
+
+    def _lambda(self):
+        os.environ.update(ENVIRONMENT)
+        os.environ.update({'STUBHUBZ_STORAGE': self.lambda_storage, 'STUBHUBZ_SCRAPE_WORKERS': str(self.args.workers),
+                'STUBHUBZ_SCRAPE_MODE': self.args.mode, 'STUBHUBZ_EXPORT_FORMAT': self.args.format})
+        import stubhubzlambda
+        self._next_round()
+        del self.sns.messages[:]
+        stubhubzlambda.handler({'action': 'scrape'}, _LambdaContext())
+        _scraped = 0
+        for _message in list(self.sns.messages):
+            _scraped += len(json.loads(_message)['event_ids'])
+            stubhubzlambda.handler({'Records': [{'Sns': {'Message': _message}}]}, _LambdaContext())
+        return _scraped
+
+    def _next_round(self):
+        self._round += 1
+        urllib.request.urlopen('{}benchmark/round?round={}'.format(self.server_url, self._round)).read()
+
+    def _server_stats(self):
+        _stats = json.loads(urllib.request.urlopen(self.server_url + 'benchmark/stats').read().decode('utf-8'))
+        return collections.Counter(_stats)
+
+def _load_sample(name):
+    with open(os.path.join(SAMPLES, name), encoding='utf-8-sig') as _file:
+        return json.load(_file)
+
+def main():
+    _parser = argparse.ArgumentParser(description='Measures StubHubz scrape and export throughput against a fake StubHub API')
+    _parser.add_argument('--events', type=int, default=20, help='How many events to track (default is 20)')
+    _parser.add_argument('--zones', type=int, default=6, help='Zones per event (default is 6, the sample venue\'s)')
+    _parser.add_argument('--listings', type=int, default=200, help='Listings per zone (default is 200)')
+    _parser.add_argument('--scrapes', type=int, default=3, help='How many times the scrape scenario scrapes every event (default is 3)')
+    _parser.add_argument('--workers', type=int, default=1, help='As scrape --workers (default is 1)')
+    _parser.add_argument('--mode', choices=['zone', 'event'], default='zone', help='As scrape --mode (default is zone)')
+    _parser.add_argument('--format', choices=['json', 'columnar'], default='columnar', help='The export format (default is columnar)')
+    _parser.add_argument('--latency', type=float, default=0, help='Milliseconds the fake StubHub API takes to answer each request (default is 0)')
+    _parser.add_argument('--throttle', type=float, default=0, help='Fraction of StubHub API requests answered with a 429, e.g. 0.05 (default is 0)')
+    _parser.add_argument('--storage', default=None, help='\'memory\' (in-memory SQLite), \'sqlite:<path>\', or \'dynamodb:<endpoint>\' of a local stand-in such as DynamoDB Local (default is a temporary SQLite database)')
+    _parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios to run, in order (default is {})'.format(','.join(SCENARIOS)))
+    _parser.add_argument('--no-memory', dest='memory', action='store_false', help='Don\'t trace memory, which slows everything down')
+    _parser.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+    _parser.add_argument('--verbose', action='store_true', help='Show what StubHubz prints')
+    _parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    _args = _parser.parse_args()
+    if _args.serve:
+        serve(_args)
+        return
+    _server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--events', str(_args.events), '--zones', str(_args.zones),
+            '--listings', str(_args.listings), '--latency', str(_args.latency), '--throttle', str(_args.throttle)], stdout=subprocess.PIPE)
+    _directory = tempfile.mkdtemp(prefix='stubhubz-benchmark-')
+    _storage = None
+    try:
+        _server_url = 'http://127.0.0.1:{}/'.format(int(_server.stdout.readline()))
+        _storage, _lambda_storage = get_benchmark_storage(_args.storage, _directory)
+        with contextlib.redirect_stdout(sys.stderr):
+            _storage.create_tables()
+        _benchmark = Benchmark(_args, _server_url, _storage, _lambda_storage)
+        if not _args.json:
+            print('{} events x {} zones x {} listings, {} mode, {} workers, {}ms latency, {:.0%} throttled, {}'.format(_args.events, _args.zones,
+                    _args.listings, _args.mode, _args.workers, _args.latency, _args.throttle, _storage))
+            print('{:8} {:>7} {:>9} {:>9} {:>13} {:>9} {:>12} {:>12}'.format('scenario', 'events', 'seconds', 'events/s', 'requests/event', 'throttled',
+                    'peak memory', 'export'))
+        for _scenario in _args.scenarios.split(','):
+            if _scenario == 'lambda' and _lambda_storage is None:
+                print('Skipping the lambda scenario as the Lambda can\'t open {}'.format(_storage), file=sys.stderr)
+                continue
+            _result = _benchmark.run(_scenario)
+            if _args.json:
+                print(json.dumps(_result))
+            else:
+                print('{:8} {:>7} {:>8.2f}s {:>9.1f} {:>14.1f} {:>9} {:>12} {:>8} KiB'.format(_scenario, _result['events'], _result['seconds'],
+                        _result['events_per_second'], _result['requests_per_event'], _result['throttled'],
+                        '{} KiB'.format(_result['peak_memory_kib']) if _result['peak_memory_kib'] is not None else '-', round(_result['export_bytes'] / 1024)))
+    finally:
+        _server.kill()
+        _server.wait()
+        if _storage is not None:
+            with contextlib.redirect_stdout(sys.stderr):
+                _storage.drop_tables()
+        shutil.rmtree(_directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
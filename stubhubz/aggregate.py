@@ -0,0 +1,176 @@
+import numpy as np
+
+HISTOGRAM_BUCKETS = 10 # equal width price buckets between a zone's min and max price
+PERCENTILES = [('p10_price', 0.10), ('p25_price', 0.25), ('median_price', 0.50)] # ticket weighted
+
+class ZonePriceAccumulator:
+    """Price summary of a zone's listings. Each page of listings is reduced to NumPy arrays of price and quantity (16
+    bytes a listing rather than the listing's JSON) as it arrives and the summary is computed from them in one vectorised
+    pass when first asked for, so it stays fast for zones with tens of thousands of listings. The arrays are kept (so
+    memory grows by 16 bytes a listing, about 0.8 MB for 50,000 listings) because the percentiles are exact and the
+    histogram's buckets depend on the zone's max price, which isn't known until every page has been seen."""
+
+    def __init__(self, zone_id, zone_name):
+        self.zone_id = zone_id
+        self.zone_name = zone_name
+        self.total_tickets = 0 # as reported by StubHub, i.e. what we should see once we've read every page
+        self.total_listings = 0
+        self.complete = None # whether every listing was seen when StubHub doesn't report per zone totals (see EventPriceAccumulator)
+        self._prices = [] # arrays of listing prices, one per page
+        self._quantities = [] # and of their quantities
+        self._summary = None
+
+    def __str__(self):
+        return 'zone_id={}, zone_name={}, min_price={}, avg_price={}, median_price={}, max_quantity={}, tickets_seen={}/{}, listings_seen={}/{}'.format(
+            self.zone_id, self.zone_name, self.min_price, self.avg_price, self.median_price, self.max_quantity, self.tickets_seen,
+            self.total_tickets, self.listings_seen, self.total_listings)
+
+    @property
+    def min_price(self):
+        return self.summary()['min_price']
+
+    @property
+    def max_price(self):
+        return self.summary()['max_price']
+
+    @property
+    def avg_price(self):
+        """Ticket weighted average price or None if no tickets have been seen"""
+        return self.summary()['avg_price']
+
+    @property
+    def median_price(self):
+        return self.summary()['median_price']
+
+    @property
+    def max_quantity(self):
+        return self.summary()['max_quantity']
+
+    @property
+    def tickets_seen(self):
+        return self.summary()['tickets_seen']
+
+    @property
+    def listings_seen(self):
+        return self.summary()['listings_seen']
+
+    @property
+    def avg_price_accurate(self):
+        """Whether every ticket StubHub says is listed in the zone has been seen"""
+        if self.complete is not None:
+            return self.complete
+        return self.tickets_seen == self.total_tickets
+
+    def add_page(self, page):
+        """Folds in a page of a StubHub find listings response (or just its listings' fields, see
+        stubhubz.stubhub.parse_listing_fields())"""
+        self.total_tickets = page.get('totalTickets', self.total_tickets)
+        self.total_listings = page.get('totalListings', self.total_listings)
+        _prices, _quantities, _, _ = _page_arrays(page)
+        self.add_arrays(_prices, _quantities)
+
+    def add_arrays(self, prices, quantities):
+        """Folds in listings given as arrays of their prices and quantities"""
+        if len(prices) > 0:
+            self._prices.append(prices)
+            self._quantities.append(quantities)
+            self._summary = None
+
+    def summary(self):
+        """Returns the zone's price statistics: min/max price, ticket weighted average, p10, p25, and median price (None
+        without tickets), max quantity, tickets and listings seen, and a histogram of tickets by price (see histogram())"""
+        if self._summary is None:
+            if len(self._prices) > 1: # only concatenate once, later summaries start from the concatenated arrays
+                self._prices = [np.concatenate(self._prices)]
+                self._quantities = [np.concatenate(self._quantities)]
+            _prices = self._prices[0] if len(self._prices) > 0 else np.empty(0)
+            _quantities = self._quantities[0] if len(self._quantities) > 0 else np.empty(0)
+            self._summary = _summarise(_prices, _quantities)
+        return self._summary
+
+class EventPriceAccumulator:
+    """Price summaries of all zones of an event built from a single stream of the event's listings (i.e. not filtered by
+    zone). Listings are bucketed into zones by their 'zoneId' and named by their 'zoneName'. 'zone_name_lookup' is only
+    called with a zone ID to name a zone whose listings don't have a 'zoneName'. Listings without a 'zoneId' aren't in
+    any zone (as when listings are requested zone by zone) but still count towards the event's tickets seen."""
+
+    def __init__(self, zone_name_lookup):
+        self.zone_name_lookup = zone_name_lookup
+        self.zones = {} # zone ID -> ZonePriceAccumulator
+        self.tickets_seen = 0
+        self.total_tickets = 0
+
+    def add_page(self, page):
+        """Folds in a page of a StubHub find listings response for the whole event (or just its listings' fields, see
+        stubhubz.stubhub.parse_listing_fields())"""
+        self.total_tickets = page.get('totalTickets', self.total_tickets)
+        _prices, _quantities, _zone_ids, _zone_names = _page_arrays(page)
+        if len(_prices) == 0:
+            return
+        _indices_by_zone = {} # zone ID -> indices of its listings in the page
+        for _index, _zone_id in enumerate(_zone_ids):
+            if _zone_id is not None:
+                _indices_by_zone.setdefault(_zone_id, []).append(_index)
+        for _zone_id, _indices in _indices_by_zone.items():
+            self._zone(_zone_id, _zone_names.get(_zone_id)).add_arrays(_prices[_indices], _quantities[_indices])
+        self.tickets_seen += int(_quantities.sum())
+
+    def _zone(self, zone_id, zone_name):
+        _zone = self.zones.get(zone_id)
+        if _zone is None:
+            _zone = ZonePriceAccumulator(zone_id, zone_name or self.zone_name_lookup(zone_id))
+            self.zones[zone_id] = _zone
+        return _zone
+
+    def zone_prices(self):
+        """Returns the ZonePriceAccumulator of each zone. StubHub only reports totals for the whole event so a zone's totals
+        are what we saw and its average is accurate only if we saw every ticket of the event."""
+        _complete = self.tickets_seen == self.total_tickets
+        for _zone in self.zones.values():
+            _zone.total_tickets = _zone.tickets_seen
+            _zone.total_listings = _zone.listings_seen
+            _zone.complete = _complete
+        return list(self.zones.values())
+
+def _page_arrays(page):
+    """Returns a page's listings as (prices, quantities, zone IDs, zone ID -> zone name)"""
+    if 'listing_prices' in page:
+        return (np.array(page['listing_prices'], dtype=float), np.array(page['listing_quantities'], dtype=float), page['listing_zone_ids'],
+                page['zone_names'])
+    _listings = page.get('listings', [])
+    _zone_names = {}
+    for _listing in _listings:
+        _zone_names.setdefault(_listing.get('zoneId'), _listing.get('zoneName'))
+    return (np.fromiter((_listing['pricePerProduct']['amount'] for _listing in _listings), float, len(_listings)),
+            np.fromiter((_listing['quantity'] for _listing in _listings), float, len(_listings)), [_listing.get('zoneId') for _listing in _listings],
+            _zone_names)
+
+def _summarise(prices, quantities):
+    _summary = {'min_price': None, 'max_price': None, 'avg_price': None, 'max_quantity': 0, 'tickets_seen': 0, 'listings_seen': len(prices),
+            'histogram': None}
+    for _name, _ in PERCENTILES:
+        _summary[_name] = None
+    if len(prices) == 0:
+        return _summary
+    _summary['min_price'] = float(prices.min())
+    _summary['max_price'] = float(prices.max())
+    _summary['max_quantity'] = int(quantities.max())
+    _tickets = quantities.sum()
+    _summary['tickets_seen'] = int(_tickets)
+    if _tickets <= 0: # listings without tickets, there's nothing to weight prices by
+        return _summary
+    _summary['avg_price'] = float(np.dot(prices, quantities) / _tickets)
+    _order = np.argsort(prices, kind='stable')
+    _cumulative = np.cumsum(quantities[_order])
+    _indices = np.searchsorted(_cumulative, [_fraction * _tickets for _, _fraction in PERCENTILES], side='left')
+    for (_name, _), _index in zip(PERCENTILES, _indices.tolist()):
+        _summary[_name] = float(prices[_order[min(_index, len(_order) - 1)]])
+    _summary['histogram'] = histogram(prices, quantities, _summary['min_price'], _summary['max_price'])
+    return _summary
+
+def histogram(prices, quantities, min_price, max_price):
+    """Tickets by price in HISTOGRAM_BUCKETS equal width buckets from min_price to max_price, i.e. {'start', 'width',
+    'tickets': [...]}. The last bucket includes max_price."""
+    _width = (max_price - min_price) / HISTOGRAM_BUCKETS
+    _counts, _ = np.histogram(prices, bins=HISTOGRAM_BUCKETS, range=(min_price, max_price if _width > 0 else min_price + 1), weights=quantities)
+    return {'start': round(min_price, 2), 'width': round(_width, 2), 'tickets': [int(_count) for _count in _counts]}
@@ -0,0 +1,185 @@
+import datetime
+import json
+import os
+import threading
+import zlib
+from abc import ABCMeta, abstractmethod
+
+from stubhubz import metrics
+
+ARCHIVE_VERSION = 1
+BATCH_SUFFIX = '.jsonl.gz'
+_DATE_TIME_FORMAT = '%Y%m%dT%H%M%S%fZ'
+
+class ArchiveBatch:
+    """The raw find listings responses of one scrape of an event, compressed as they arrive (from any thread) and
+    written to the archive as a single object by close(). A batch is gzipped JSON lines: a {'zone_id', 'start', 'page'}
+    line per response ('page' is the response exactly as StubHub sent it) then a {'batch': ...} line with the event ID,
+    scrape mode, the date time of the scrape's PriceHistory item, and the zones' names."""
+
+    def __init__(self, archive, event_id, mode):
+        self.archive = archive
+        self.event_id = event_id
+        self.mode = mode
+        self.pages = 0
+        self._lock = threading.Lock()
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31 is a gzip header
+        self._compressed = []
+
+    def add_page(self, zone_id, start, raw):
+        """Adds a find listings response (bytes) for the listings from 'start'. It's valid JSON so any line breaks are whitespace and can be dropped."""
+        _line = b'{"zone_id": ' + json.dumps(zone_id).encode('utf-8') + b', "start": ' + str(start).encode('utf-8') + b', "page": ' + \
+                raw.replace(b'\r', b' ').replace(b'\n', b' ') + b'}\n'
+        with self._lock:
+            self._compressed.append(self._compressor.compress(_line))
+            self.pages += 1
+
+    def close(self, date_time, zones):
+        """Writes the batch for the scrape's PriceHistory item at 'date_time' with the names of 'zones' (the scrape's
+        ZonePriceAccumulators) returning its key"""
+        _date_time = date_time if date_time.tzinfo is not None else date_time.replace(tzinfo=datetime.timezone.utc)
+        _trailer = {'batch': {'version': ARCHIVE_VERSION, 'event_id': self.event_id, 'mode': self.mode, 'date_time': _date_time.isoformat(),
+                'pages': self.pages, 'zones': [[_zone.zone_id, _zone.zone_name] for _zone in zones]}}
+        with self._lock:
+            self._compressed.append(self._compressor.compress(json.dumps(_trailer).encode('utf-8') + b'\n'))
+            self._compressed.append(self._compressor.flush())
+            _body = b''.join(self._compressed)
+            self._compressed = []
+        _key = self.archive.batch_key(self.event_id, _date_time)
+        with metrics.phase('archive_write'):
+            self.archive.write(_key, _body)
+        metrics.increment('archive_bytes', len(_body))
+        return _key
+
+class ListingsArchive(metaclass=ABCMeta):
+    """Append-only store of raw listings, a batch (see ArchiveBatch) per scrape of an event, partitioned by event and day:
+    '<event ID>/<YYYY-MM-DD>/<date time>.jsonl.gz'. Batches are never changed once written so history can always be
+    recomputed from them (see replay_batch())."""
+
+    def new_batch(self, event_id, mode):
+        return ArchiveBatch(self, event_id, mode)
+
+    def batch_key(self, event_id, date_time):
+        return '{}/{}/{}{}'.format(event_id, date_time.strftime('%Y-%m-%d'), date_time.strftime(_DATE_TIME_FORMAT), BATCH_SUFFIX)
+
+    def list_batches(self, event_id, since=None, until=None):
+        """Returns the keys of an event's batches (oldest first) scraped after 'since' and up to 'until' (inclusive)"""
+        _keys = []
+        for _day in sorted(self.list('{}/'.format(event_id))):
+            if (since is not None and _day < since.strftime('%Y-%m-%d')) or (until is not None and _day > until.strftime('%Y-%m-%d')):
+                continue
+            for _name in self.list('{}/{}/'.format(event_id, _day)):
+                if not _name.endswith(BATCH_SUFFIX):
+                    continue
+                _date_time = batch_date_time(_name)
+                if (since is None or _date_time > since) and (until is None or _date_time <= until):
+                    _keys.append('{}/{}/{}'.format(event_id, _day, _name))
+        return sorted(_keys)
+
+    def list_event_ids(self):
+        return sorted(int(_name) for _name in self.list('') if _name.isdigit())
+
+    @abstractmethod
+    def list(self, prefix):
+        """Returns the names of the objects and 'directories' directly under 'prefix' (which ends with '/' or is '')"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def write(self, key, body):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read(self, key):
+        raise NotImplementedError
+
+class LocalListingsArchive(ListingsArchive):
+    """Archive in a local directory"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'Listings archive {}'.format(self.path)
+
+    def list(self, prefix):
+        _directory = os.path.join(self.path, *prefix.split('/'))
+        return os.listdir(_directory) if os.path.isdir(_directory) else []
+
+    def write(self, key, body):
+        _path = os.path.join(self.path, *key.split('/'))
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        with open(_path + '.tmp', 'wb') as _file:
+            _file.write(body)
+        os.replace(_path + '.tmp', _path)
+
+    def read(self, key):
+        with open(os.path.join(self.path, *key.split('/')), 'rb') as _file:
+            return _file.read()
+
+class S3ListingsArchive(ListingsArchive):
+    """Archive in an S3 bucket under 'key_prefix'"""
+
+    def __init__(self, s3_client, bucket, key_prefix=''):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key_prefix = key_prefix.strip('/') + '/' if key_prefix.strip('/') else ''
+
+    def __str__(self):
+        return 'Listings archive s3://{}/{}'.format(self.bucket, self.key_prefix)
+
+    def list(self, prefix):
+        _names = []
+        for _page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.key_prefix + prefix, Delimiter='/'):
+            _names.extend(_object['Key'][len(self.key_prefix + prefix):] for _object in _page.get('Contents', []))
+            _names.extend(_prefix['Prefix'][len(self.key_prefix + prefix):].rstrip('/') for _prefix in _page.get('CommonPrefixes', []))
+        return _names
+
+    def write(self, key, body):
+        self.s3_client.put_object(Body=body, Bucket=self.bucket, Key=self.key_prefix + key, ContentType='application/x-ndjson', ContentEncoding='gzip')
+
+    def read(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket, Key=self.key_prefix + key)['Body'].read()
+
+def get_archive(spec, region=None):
+    """Returns the archive for 'spec' which is 'file:<directory>' or 's3:<bucket>[/<key prefix>]'"""
+    if spec.startswith('file:'):
+        return LocalListingsArchive(spec[len('file:'):])
+    if spec.startswith('s3:'):
+        from stubhubz.aws import get_client
+        _bucket, _, _key_prefix = spec[len('s3:'):].partition('/')
+        return S3ListingsArchive(get_client('s3', region), _bucket, _key_prefix)
+    raise ValueError('Unknown listings archive \'{}\'. Expected \'file:<directory>\' or \'s3:<bucket>[/<key prefix>]\''.format(spec))
+
+def batch_date_time(key):
+    """The date time of the scrape a batch's key (or name) is for"""
+    return datetime.datetime.strptime(key.rsplit('/', 1)[-1][:-len(BATCH_SUFFIX)], _DATE_TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+
+def read_batch(body):
+    """Returns a batch's (find listings records, trailer), see ArchiveBatch. The records are yielded one at a time."""
+    _lines = zlib.decompress(body, 31).splitlines()
+    _trailer = json.loads(_lines[-1])['batch']
+    return (json.loads(_line) for _line in _lines[:-1]), _trailer
+
+def replay_batch(archive_spec, region, key):
+    """Re-aggregates a batch the way it was scraped, returning (event ID, date time, zone prices) of the PriceHistory item
+    it makes. Pages are archived as they arrive but were aggregated in order so they're replayed in order too (averages
+    depend on it down to the last digit). This is run in replay worker processes (see StubHubz.replay()) so it takes the
+    archive's spec."""
+    from stubhubz.aggregate import EventPriceAccumulator, ZonePriceAccumulator
+    from stubhubz.stubhubz import StubHubz
+    _records, _trailer = read_batch(get_archive(archive_spec, region).read(key))
+    _records = sorted(_records, key=lambda record: record['start'])
+    _zone_names = {_zone_id: _zone_name for _zone_id, _zone_name in _trailer['zones']}
+    if _trailer['mode'] == 'event':
+        _accumulator = EventPriceAccumulator(_zone_names.get)
+        for _record in _records:
+            _accumulator.add_page(_record['page'])
+        _zones = _accumulator.zone_prices()
+    else:
+        _zones = {_zone_id: ZonePriceAccumulator(_zone_id, _zone_name) for _zone_id, _zone_name in _trailer['zones']}
+        for _record in _records:
+            if _record['zone_id'] not in _zones:
+                _zones[_record['zone_id']] = ZonePriceAccumulator(_record['zone_id'], None)
+            _zones[_record['zone_id']].add_page(_record['page'])
+        _zones = list(_zones.values())
+    return _trailer['event_id'], datetime.datetime.fromisoformat(_trailer['date_time']), StubHubz.build_zone_prices(_zones)
@@ -0,0 +1,31 @@
+import threading
+
+# The botocore session and the clients by (service, region), shared by every caller. botocore is only imported once a
+# client is needed.
+_SESSION = None
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_client(service_name, region=None):
+    """Returns the shared botocore client for 'service_name' (e.g. 's3', 'sns', 'lambda') in 'region'"""
+    global _SESSION
+    with _CLIENTS_LOCK:
+        _key = (service_name, region)
+        if _key not in _CLIENTS:
+            if _SESSION is None:
+                import botocore.session
+                _SESSION = botocore.session.get_session()
+            _CLIENTS[_key] = _SESSION.create_client(service_name, region_name=region)
+        return _CLIENTS[_key]
+
+def set_client(service_name, client, region=None):
+    """Makes get_client() return 'client' for 'service_name' in 'region', e.g. an in-memory stand-in for benchmarks"""
+    with _CLIENTS_LOCK:
+        _CLIENTS[(service_name, region)] = client
+
+def reset_clients():
+    """Forgets the session and clients, e.g. in a forked process so it doesn't share its parent's connections"""
+    global _SESSION
+    with _CLIENTS_LOCK:
+        _SESSION = None
+        _CLIENTS.clear()
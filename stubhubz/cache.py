@@ -0,0 +1,155 @@
+import collections
+import json
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+# Caches by spec (see get_cache()), so everything asking for the same cache shares its entries
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+class CacheStats:
+    """Thread safe hit/miss counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return 'hits={}, misses={}'.format(self.hits, self.misses)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+class Cache(metaclass=ABCMeta):
+    """A key/value cache where every entry expires after its own time to live (in seconds). Values must be JSON
+    serialisable so any backend can store them."""
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    @abstractmethod
+    def get(self, key):
+        """Return the value cached for key or None if there isn't one or it has expired."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Cache value for key for ttl seconds."""
+        raise NotImplementedError
+
+    def get_or_load(self, key, ttl, loader, refresh=False):
+        """Return the value cached for key, calling loader() and caching its result on a miss (or if refresh is True)."""
+        _value = None if refresh else self.get(key)
+        self.stats.record(_value is not None)
+        if _value is None:
+            _value = loader()
+            if _value is not None:
+                self.set(key, _value, ttl)
+        return _value
+
+class MemoryCache(Cache):
+    """In-process cache which evicts the least recently used entry once it holds max_entries"""
+
+    def __init__(self, max_entries=1000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # key -> (expires at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            _entry = self._entries.get(key)
+            if _entry is None:
+                return None
+            if _entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return _entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class FileCache(MemoryCache):
+    """MemoryCache which is loaded from and saved to a JSON file so entries survive between processes"""
+
+    def __init__(self, path, max_entries=1000):
+        super().__init__(max_entries)
+        self.path = path
+        if os.path.exists(path):
+            with open(path, 'r') as _file:
+                for _key, _entry in json.load(_file).items():
+                    self._entries[_key] = tuple(_entry)
+
+    def set(self, key, value, ttl):
+        super().set(key, value, ttl)
+        with self._lock:
+            _now = time.time()
+            _text = json.dumps({_key: _entry for _key, _entry in self._entries.items() if _entry[0] > _now})
+            with open(self.path + '.tmp', 'w') as _file:
+                _file.write(_text)
+            os.replace(self.path + '.tmp', self.path)
+
+class DynamoDbCache(Cache):
+    """Cache stored in the StubHubzCache DynamoDB table (see stubhubz.dynamodb.CacheEntry)"""
+
+    def get(self, key):
+        from stubhubz.dynamodb import CacheEntry
+        try:
+            _entry = CacheEntry.get(key)
+        except CacheEntry.DoesNotExist:
+            return None
+        if _entry.expires_at <= time.time():
+            return None
+        return json.loads(_entry.value)
+
+    def set(self, key, value, ttl):
+        from stubhubz.dynamodb import CacheEntry
+        CacheEntry(key, value=json.dumps(value), expires_at=int(time.time() + ttl)).save()
+
+class TieredCache(Cache):
+    """Looks in a fast cache (e.g. MemoryCache) before a slower persistent cache, filling the fast cache on the way out"""
+
+    def __init__(self, fast, slow, fast_ttl=3600):
+        super().__init__()
+        self.fast = fast
+        self.slow = slow
+        self.fast_ttl = fast_ttl # the persistent cache doesn't tell us how long its entries have left so keep them briefly
+
+    def get(self, key):
+        _value = self.fast.get(key)
+        if _value is None:
+            _value = self.slow.get(key)
+            if _value is not None:
+                self.fast.set(key, _value, self.fast_ttl)
+        return _value
+
+    def set(self, key, value, ttl):
+        self.fast.set(key, value, min(ttl, self.fast_ttl))
+        self.slow.set(key, value, ttl)
+
+def get_cache(spec):
+    """Returns the shared cache for 'spec' which is one of 'memory', 'file:<path>', or 'dynamodb'. Persistent caches are
+    fronted by an in-process MemoryCache."""
+    with _CACHES_LOCK:
+        if spec not in _CACHES:
+            if spec == 'memory':
+                _CACHES[spec] = MemoryCache()
+            elif spec.startswith('file:'):
+                _CACHES[spec] = TieredCache(MemoryCache(), FileCache(spec[len('file:'):]))
+            elif spec == 'dynamodb':
+                _CACHES[spec] = TieredCache(MemoryCache(), DynamoDbCache())
+            else:
+                raise ValueError('Unknown cache \'{}\'. Expected \'memory\', \'file:<path>\', or \'dynamodb\''.format(spec))
+        return _CACHES[spec]
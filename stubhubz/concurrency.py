@@ -0,0 +1,87 @@
+import collections
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class TokenBucket:
+    """A thread safe token bucket rate limiter. Allows bursts of up to 'capacity' calls and refills at 'rate' calls per
+    second. Share a single instance between all workers that talk to the same API so they stay inside its quota together."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('Rate must be positive but was {}'.format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'TokenBucket rate={}/s, capacity={}'.format(self.rate, self.capacity)
+
+    def acquire(self, tokens=1):
+        """Blocks until 'tokens' tokens are available and takes them."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                _wait = (tokens - self._tokens) / self.rate
+            time.sleep(_wait)
+
+    def _refill(self):
+        _now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (_now - self._last_refill) * self.rate)
+        self._last_refill = _now
+
+class WorkerPool:
+    """A bounded pool of threads. With a single worker everything runs in the calling thread so the sequential behaviour
+    (and its stack traces) is unchanged. Work runs in a copy of the submitting thread's context variables (e.g. the
+    event stubhubz.metrics records for)."""
+
+    def __init__(self, workers):
+        self.workers = max(1, int(workers))
+        self._executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return False
+
+    def map(self, function, items):
+        """Returns a list of function(item) for each item, in the order of items. Exceptions are re-raised."""
+        if self._executor is None:
+            return [function(_item) for _item in items]
+        return [_future.result() for _future in [self._executor.submit(contextvars.copy_context().run, function, _item) for _item in items]]
+
+    def imap(self, function, items):
+        """Like map() but lazily yields the results in order, keeping at most 'workers' items in flight, so results can
+        be consumed (and discarded) as they arrive."""
+        if self._executor is None:
+            for _item in items:
+                yield function(_item)
+            return
+        _pending = collections.deque()
+        for _item in items:
+            _pending.append(self._executor.submit(contextvars.copy_context().run, function, _item))
+            if len(_pending) >= self.workers:
+                yield _pending.popleft().result()
+        while _pending:
+            yield _pending.popleft().result()
+
+    def map_outcomes(self, function, items):
+        """Like map() but returns a list of (item, result, error) tuples so one failed item doesn't stop the others."""
+        def _outcome(item):
+            try:
+                return (item, function(item), None)
+            except Exception as err:
+                return (item, None, err)
+        return self.map(_outcome, items)
@@ -0,0 +1,156 @@
+import collections
+import datetime
+
+from stubhubz.cache import MemoryCache
+
+KEYFRAME_HOURS = 24 # every zone is written at least this often so readers never have to go far back to rebuild the state
+ZONE_PRICE_FIELDS = ['min_price', 'avg_price', 'avg_price_accurate', 'max_ticket_quantity', 'total_tickets', 'total_listings', 'max_price',
+        'median_price', 'p10_price', 'p25_price', 'histogram']
+LAST_STATE_TTL = 7 * 24 * 3600
+KEYFRAME_PAGE_SIZE = 25 # items read at a time when reading back to the newest full item, a keyframe's worth of hourly scrapes
+
+# Each event's last written zone prices, only used while the item they were written with is still the event's newest
+_LAST_STATE_CACHE = MemoryCache(max_entries=2000)
+
+def diff_zone_prices(previous, current):
+    """Returns the zone prices of 'current' (a zone_prices list) which differ from 'previous' (zone ID -> zone price)
+    plus a {'zone_id', 'zone_name', 'removed': True} marker for each zone in 'previous' that's no longer in 'current'"""
+    _changed = []
+    _current_ids = set()
+    for _zone_price in current:
+        _current_ids.add(_zone_price['zone_id'])
+        _previous = previous.get(_zone_price['zone_id'])
+        if _previous is None or any(_previous.get(_field) != _zone_price.get(_field) for _field in ZONE_PRICE_FIELDS):
+            _changed.append(_zone_price)
+    for _zone_id, _previous in previous.items():
+        if _zone_id not in _current_ids:
+            _changed.append({'zone_id': _zone_id, 'zone_name': _previous['zone_name'], 'removed': True})
+    return _changed
+
+def apply_price_history(state, price_history):
+    """Updates 'state' (zone ID -> zone price) with a PriceHistory item, i.e. replaces it for a full item or applies the
+    changed and removed zones of a delta item"""
+    if not price_history.delta:
+        state.clear()
+    for _zone_price in price_history.zone_prices or []:
+        if _zone_price.get('removed'):
+            state.pop(_zone_price['zone_id'], None)
+        else:
+            state[_zone_price['zone_id']] = _zone_price
+    return state
+
+def expand_price_history(price_histories, state=None):
+    """Yields PriceHistory items (oldest first) with the zone prices of every zone, carrying unchanged zones forward from
+    earlier items. 'state' is the zone prices before the first item (see get_zone_prices_at()) if it may be a delta."""
+    _state = collections.OrderedDict(state or {})
+    for _price_history in price_histories:
+        if not _price_history.delta:
+            yield _price_history
+            apply_price_history(_state, _price_history)
+            continue
+        apply_price_history(_state, _price_history)
+        yield type(_price_history)(_price_history.event_id, _price_history.date_time, zone_prices=list(_state.values()),
+                resolution=_price_history.resolution)
+
+def get_zone_prices_at(storage, event_id, until=None):
+    """Returns (zone ID -> zone price, date_time of the newest full item, date_time of the newest item) of an event as of
+    'until' (inclusive, or now), reading back from the newest item to the newest full one. Everything is None without
+    price history. Items are read KEYFRAME_PAGE_SIZE at a time so only about a keyframe's worth is read (and paid for)."""
+    _items = []
+    for _price_history in storage.get_price_history(event_id, until=until, newest_first=True, page_size=KEYFRAME_PAGE_SIZE):
+        _items.append(_price_history)
+        if not _price_history.delta:
+            break
+    if len(_items) == 0:
+        return None, None, None
+    _state = collections.OrderedDict()
+    for _price_history in reversed(_items):
+        apply_price_history(_state, _price_history)
+    return _state, _items[-1].date_time if not _items[-1].delta else None, _items[0].date_time
+
+def read_price_history(storage, event_id, since=None, until=None, newest_first=False, limit=None):
+    """Like Storage.get_price_history() but every item has the zone prices of every zone (see expand_price_history()).
+    With a limit the newest 'limit' items (or oldest if not newest_first) are read plus, if the first of them is a
+    delta, back to the full item before it."""
+    if limit is None and not newest_first:
+        _state = get_zone_prices_at(storage, event_id, since)[0] if since is not None else None
+        return expand_price_history(storage.get_price_history(event_id, since, until), _state)
+    _items = list(storage.get_price_history(event_id, since, until, newest_first, limit))
+    if newest_first:
+        _items.reverse()
+    _state = None
+    if len(_items) > 0 and _items[0].delta:
+        _state = get_zone_prices_at(storage, event_id, _items[0].date_time - datetime.timedelta(microseconds=1))[0]
+    _expanded = list(expand_price_history(_items, _state))
+    return _expanded[::-1] if newest_first else _expanded
+
+class PriceHistoryWriter:
+    """Writes scraped zone prices as PriceHistory items holding only the zones that changed since the event's previous
+    item (a 'delta' item) so unchanged zones cost no write units, storage, or export size. A scrape where nothing changed
+    is written as an empty delta, a heartbeat saying the prices were checked. Every 'keyframe_hours' (and whenever the
+    previous state isn't known) every zone is written so readers rebuild the state from a nearby item.
+
+    The previous state comes from 'cache' (an in-memory stubhubz.cache.Cache) if the item it was cached with is still the
+    event's newest, otherwise it's rebuilt from storage (e.g. another worker scraped the event)."""
+
+    def __init__(self, storage, keyframe_hours=KEYFRAME_HOURS, cache=None):
+        self.storage = storage # a stubhubz.storage.Storage
+        self.keyframe_hours = keyframe_hours
+        self.cache = cache if cache is not None else _LAST_STATE_CACHE
+
+    def __str__(self):
+        return 'PriceHistoryWriter keyframe_hours={}'.format(self.keyframe_hours)
+
+    def write(self, event_id, date_time, zone_prices):
+        """Writes an event's scraped zone prices returning how many zones were written"""
+        _state, _keyframe, _last = self._last_state(event_id)
+        _date_time = date_time if date_time.tzinfo is not None else date_time.replace(tzinfo=datetime.timezone.utc)
+        if _keyframe is None or _date_time - _keyframe >= datetime.timedelta(hours=self.keyframe_hours):
+            _written = list(zone_prices)
+            _keyframe = _date_time
+            self.storage.add_price_history(event_id, date_time, _written)
+        else:
+            _written = diff_zone_prices(_state, zone_prices)
+            self.storage.add_price_history(event_id, date_time, _written, delta=True)
+        _state = collections.OrderedDict((_zone_price['zone_id'], _zone_price) for _zone_price in zone_prices)
+        self.cache.set(self._key(event_id), {'state': _state, 'keyframe': _keyframe, 'last': _date_time}, LAST_STATE_TTL)
+        return len(_written)
+
+    def rewrite(self, event_id, replayed):
+        """Rewrites an event's price history with 'replayed' zone prices ((date time, zone prices) oldest first, e.g.
+        recomputed from the listings archive) replacing the items at the same date times. Every item from the first
+        replayed one on is re-encoded as the full and delta items write() would have written, so the items after the
+        replayed ones still apply to the right state. Rollups are kept as they are. Returns how many items were written."""
+        if len(replayed) == 0:
+            return 0
+        _before = _utc(replayed[0][0]) - datetime.timedelta(microseconds=1)
+        _state, _keyframe, _ = get_zone_prices_at(self.storage, event_id, _before)
+        _timeline = {_price_history.date_time: (_price_history.zone_prices, _price_history.resolution) for _price_history in
+                read_price_history(self.storage, event_id, _before)}
+        for _date_time, _zone_prices in replayed:
+            _timeline[_utc(_date_time)] = (_zone_prices, None)
+        for _date_time in sorted(_timeline):
+            _zone_prices, _resolution = _timeline[_date_time]
+            if _resolution is not None or _keyframe is None or _date_time - _keyframe >= datetime.timedelta(hours=self.keyframe_hours):
+                self.storage.add_price_history(event_id, _date_time, list(_zone_prices), _resolution)
+                _keyframe = _date_time
+            else:
+                self.storage.add_price_history(event_id, _date_time, diff_zone_prices(_state, _zone_prices), delta=True)
+            _state = collections.OrderedDict((_zone_price['zone_id'], _zone_price) for _zone_price in _zone_prices)
+        self.cache.set(self._key(event_id), {'state': _state, 'keyframe': _keyframe, 'last': max(_timeline)}, LAST_STATE_TTL)
+        return len(_timeline)
+
+    def _last_state(self, event_id):
+        _newest = list(self.storage.get_price_history(event_id, newest_first=True, limit=1, attributes=['date_time']))
+        if len(_newest) == 0:
+            return None, None, None
+        _cached = self.cache.get(self._key(event_id))
+        if _cached is not None and _cached['last'] == _newest[0].date_time:
+            return _cached['state'], _cached['keyframe'], _cached['last']
+        return get_zone_prices_at(self.storage, event_id)
+
+    def _key(self, event_id):
+        return 'last-zone-prices:{}'.format(event_id)
+
+def _utc(date_time):
+    return date_time if date_time.tzinfo is not None else date_time.replace(tzinfo=datetime.timezone.utc)
@@ -0,0 +1,114 @@
+import json
+import multiprocessing
+import sys
+from abc import ABCMeta, abstractmethod
+
+from stubhubz.aws import get_client, reset_clients
+
+_PROCESS_HANDLER = None # the handler of the ProcessDispatcher that is dispatching, inherited by its forked workers
+
+def split_shards(items, shards):
+    """Splits items into at most 'shards' non-empty lists, dealing them out in turn so every shard gets a fair share of
+    the items at the front (e.g. the highest priority events)"""
+    _shards = [items[_shard::shards] for _shard in range(max(1, shards))]
+    return [_shard for _shard in _shards if len(_shard) > 0]
+
+class Dispatcher(metaclass=ABCMeta):
+    """Sends messages (JSON serialisable dictionaries with an 'action' like the AWS Lambda handler accepts) to workers"""
+
+    @abstractmethod
+    def dispatch(self, messages):
+        """Sends each message to a worker. Returns the workers' results in the order of messages or None if the workers
+        run asynchronously and report their results themselves."""
+        raise NotImplementedError
+
+class LocalDispatcher(Dispatcher):
+    """Handles every message in this process, one after another, by calling handler(message)"""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __str__(self):
+        return 'LocalDispatcher'
+
+    def dispatch(self, messages):
+        return [self.handler(_message) for _message in messages]
+
+class ProcessDispatcher(Dispatcher):
+    """Handles messages in a pool of forked processes by calling handler(message) in them. The handler (and whatever it
+    uses) is inherited from this process rather than pickled, only messages and results are. Each process drops the
+    connections it inherited (see reset_connections()) and opens its own."""
+
+    def __init__(self, handler, processes=None):
+        self.handler = handler
+        self.processes = processes
+
+    def __str__(self):
+        return 'ProcessDispatcher processes={}'.format(self.processes)
+
+    def dispatch(self, messages):
+        global _PROCESS_HANDLER
+        _PROCESS_HANDLER = self.handler
+        try:
+            with multiprocessing.get_context('fork').Pool(self.processes or len(messages), initializer=reset_connections) as _pool:
+                return _pool.map(_handle, messages, chunksize=1)
+        finally:
+            _PROCESS_HANDLER = None
+
+def _handle(message):
+    return _PROCESS_HANDLER(message)
+
+def reset_connections():
+    """Drops the connections a forked process inherited from its parent, so it doesn't write to the same sockets: the
+    shared AWS clients, the pooled HTTP sessions, and PynamoDB's connections. Modules that haven't been imported have
+    nothing to drop and aren't imported."""
+    reset_clients()
+    if 'stubhubz.session' in sys.modules:
+        sys.modules['stubhubz.session'].reset_sessions()
+    if 'stubhubz.dynamodb' in sys.modules:
+        sys.modules['stubhubz.dynamodb'].reset_connections()
+
+class SnsDispatcher(Dispatcher):
+    """Publishes each message to an AWS SNS topic which triggers the StubHubz Lambda"""
+
+    def __init__(self, topic_arn, region):
+        self.topic_arn = topic_arn
+        self._client = get_client('sns', region)
+
+    def __str__(self):
+        return 'SnsDispatcher topic_arn={}'.format(self.topic_arn)
+
+    def dispatch(self, messages):
+        for _message in messages:
+            self._client.publish(TopicArn=self.topic_arn, MessageStructure='json', Message=json.dumps({'default': json.dumps(_message)}))
+        return None
+
+class LambdaDispatcher(Dispatcher):
+    """Invokes an AWS Lambda function asynchronously with each message"""
+
+    def __init__(self, function_name, region):
+        self.function_name = function_name
+        self._client = get_client('lambda', region)
+
+    def __str__(self):
+        return 'LambdaDispatcher function_name={}'.format(self.function_name)
+
+    def dispatch(self, messages):
+        for _message in messages:
+            self._client.invoke(FunctionName=self.function_name, InvocationType='Event', Payload=json.dumps(_message).encode('utf-8'))
+        return None
+
+def get_dispatcher(spec, handler, region=None):
+    """Returns a dispatcher for 'spec' which is one of 'local', 'process' or 'process:<processes>', 'sns:<topic ARN>', or
+    'lambda:<function name>'. 'handler' handles messages for the local and process dispatchers."""
+    if spec == 'local':
+        return LocalDispatcher(handler)
+    if spec == 'process':
+        return ProcessDispatcher(handler)
+    if spec.startswith('process:'):
+        return ProcessDispatcher(handler, int(spec[len('process:'):]))
+    if spec.startswith('sns:'):
+        return SnsDispatcher(spec[len('sns:'):], region)
+    if spec.startswith('lambda:'):
+        return LambdaDispatcher(spec[len('lambda:'):], region)
+    raise ValueError('Unknown dispatcher \'{}\'. Expected \'local\', \'process[:<processes>]\', \'sns:<topic ARN>\', or \'lambda:<function name>\''.format(spec))
@@ -0,0 +1,33 @@
+import numpy
+
+def lttb(x, y, threshold):
+    """Returns the (sorted) indices of the points kept when downsampling the series (x, y) to 'threshold' points with the
+    Largest-Triangle-Three-Buckets algorithm. This is the same algorithm as downsample() in
+    web/chartjs-plugin-downsample.js: the first and last points are always kept and every bucket in between keeps the
+    point forming the largest triangle with the previously kept point and the average of the next bucket."""
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    _length = len(x)
+    if threshold >= _length or threshold < 3:
+        return numpy.arange(_length)
+    _every = (_length - 2) / (threshold - 2)
+    # bucket i (for i in 0..threshold-3) covers points starts[i]..starts[i+1]-1, the extra start bounds the last average
+    _starts = numpy.minimum(numpy.floor(numpy.arange(threshold) * _every).astype(int) + 1, _length)
+    _cumulative_x = numpy.concatenate(([0.0], numpy.cumsum(x)))
+    _cumulative_y = numpy.concatenate(([0.0], numpy.cumsum(y)))
+    _avg_ends = _starts[2:]
+    _avg_starts = _starts[1:-1]
+    _avg_lengths = numpy.maximum(_avg_ends - _avg_starts, 1)
+    _avg_x = (_cumulative_x[_avg_ends] - _cumulative_x[_avg_starts]) / _avg_lengths
+    _avg_y = (_cumulative_y[_avg_ends] - _cumulative_y[_avg_starts]) / _avg_lengths
+    _kept = numpy.empty(threshold, dtype=int)
+    _kept[0] = 0
+    _a = 0
+    for _i in range(threshold - 2):
+        _bucket_x = x[_starts[_i]:_starts[_i + 1]]
+        _bucket_y = y[_starts[_i]:_starts[_i + 1]]
+        _areas = numpy.abs((x[_a] - _avg_x[_i]) * (_bucket_y - y[_a]) - (x[_a] - _bucket_x) * (_avg_y[_i] - y[_a]))
+        _a = _starts[_i] + int(numpy.argmax(_areas))
+        _kept[_i + 1] = _a
+    _kept[-1] = _length - 1
+    return _kept
@@ -1,15 +1,40 @@
 import configparser
+import datetime
+import random
+import threading
+import time
+from contextlib import contextmanager
 
+from pynamodb.attributes import BooleanAttribute
 from pynamodb.attributes import ListAttribute
+from pynamodb.attributes import MapAttribute
 from pynamodb.attributes import NumberAttribute
 from pynamodb.attributes import UnicodeAttribute
 from pynamodb.attributes import UTCDateTimeAttribute
 
+from pynamodb.exceptions import PutError
+from pynamodb.indexes import AllProjection
+from pynamodb.indexes import GlobalSecondaryIndex
 from pynamodb.models import Model
 
+from stubhubz import metrics
+from stubhubz.storage import PRICE_HISTORY_KEYS, Storage
+
 REGION_NAME = None
 ENDPOINT_URL = None
 
+class ActiveEventIndex(GlobalSecondaryIndex):
+    """Events by scrape status and date so a scrape can query the events that are still active and haven't happened
+    instead of scanning every event ever tracked. Events without a scrape status or date aren't indexed. All attributes
+    are projected because the scrape writes back whole events (see WriteBuffer), and events are small."""
+    class Meta:
+        index_name = 'ActiveEventIndex'
+        write_capacity_units = 1
+        read_capacity_units = 1
+        projection = AllProjection()
+    scrape_status = UnicodeAttribute(hash_key=True)
+    date_time = UTCDateTimeAttribute(range_key=True)
+
 class Event(Model):
     class Meta:
         table_name = 'Event'
@@ -26,6 +51,12 @@ class Event(Model):
     primary_performer = UnicodeAttribute(null=True)
     last_scraped_date_time = UTCDateTimeAttribute(null=True)
     scrape_status = UnicodeAttribute(null=True)
+    ticket_info = MapAttribute(null=True) # StubHub's summary of the listings (see StubHubApi.get_ticket_info) when last scraped
+    last_checked_date_time = UTCDateTimeAttribute(null=True) # when ticket_info was last found unchanged (so wasn't scraped)
+    next_scrape_date_time = UTCDateTimeAttribute(null=True) # when the event is next due to be scraped (see stubhubz.schedule)
+    volatility = NumberAttribute(null=True) # how much the event's prices have been moving (see ScrapeScheduler.volatility)
+    min_price = NumberAttribute(null=True) # the lowest min price of the event's zones when last scraped (for the events index)
+    active_index = ActiveEventIndex()
 
     def __str__(self):
         return 'Event id={}, name={}, date_time={}, event_status={}, venue_name={}, venue_city={}, primary_performer={}, last_scraped_date_time={}, scrape_status={}'.format(
@@ -41,19 +72,159 @@ class PriceHistory(Model):
     event_id = NumberAttribute(hash_key=True)
     date_time = UTCDateTimeAttribute(range_key=True)
     zone_prices = ListAttribute()
+    resolution = UnicodeAttribute(null=True) # None for a scrape, 'hour' or 'day' for a rollup (see stubhubz.rollup)
+    delta = BooleanAttribute(null=True) # True if zone_prices only has the zones that changed since the previous item (see stubhubz.delta)
 
     def __str__(self):
         result = 'PriceHistory event_id={}, date_time={}, zone_prices='.format(self.event_id, self.date_time)
+        if self.resolution is not None:
+            result = 'PriceHistory event_id={}, date_time={}, resolution={}, zone_prices='.format(self.event_id, self.date_time, self.resolution)
+        if self.delta:
+            result = 'PriceHistory event_id={}, date_time={}, delta=True, zone_prices='.format(self.event_id, self.date_time)
         for z in sorted(self.zone_prices, key=lambda k: k['zone_name']):
+            if z.get('removed'):
+                result += '\n zone_id={}, zone_name={:10} removed'.format(z['zone_id'], z['zone_name'] + ',')
+                continue
             result += '\n zone_id={}, zone_name={:10} min_price={:.2f}, avg_price={:.3f}, max_ticket_quantity={:2}, total_tickets={:3}, total_listings={:2}'.format(
                 z['zone_id'], z['zone_name'] + ',', z['min_price'], z['avg_price'], z['max_ticket_quantity'], z['total_tickets'], z['total_listings'])
         return result
 
-class StubHubzDynamoDb:
+class ExportState(Model):
+    """How far an event's price history has been exported to S3 (see stubhubz.export.PriceHistoryExporter)"""
+    class Meta:
+        table_name = 'ExportState'
+        region = REGION_NAME
+        host = ENDPOINT_URL
+        write_capacity_units = 1
+        read_capacity_units = 1
+    event_id = NumberAttribute(hash_key=True)
+    last_date_time = UTCDateTimeAttribute(null=True) # date_time of the newest exported PriceHistory item
+    segment = NumberAttribute(default=0) # the newest S3 segment
+    segment_rows = NumberAttribute(default=0) # how many PriceHistory items are in the newest segment
+    rows_exported = NumberAttribute(default=0)
+    summary_segments = NumberAttribute(null=True) # how many (sealed) segments the downsampled summary covers, None for none
+
+class CacheEntry(Model):
+    """An entry of stubhubz.cache.DynamoDbCache. 'expires_at' is epoch seconds so it can also be the table's TTL attribute"""
+    class Meta:
+        table_name = 'StubHubzCache'
+        region = REGION_NAME
+        host = ENDPOINT_URL
+        write_capacity_units = 1
+        read_capacity_units = 1
+    key = UnicodeAttribute(hash_key=True)
+    value = UnicodeAttribute()
+    expires_at = NumberAttribute()
+
+BATCH_WRITE_SIZE = 25 # the most items DynamoDB accepts per BatchWriteItem request
+BATCH_WRITE_RETRIES = 5 # on top of PynamoDB's own retries of unprocessed items
+
+def reset_connections():
+    """Forgets each model's PynamoDB connection (and its botocore client), e.g. in a forked process so it doesn't share
+    its parent's"""
+    for _model in [Event, PriceHistory, ExportState, CacheEntry]:
+        _model._connection = None
+
+class WriteBuffer:
+    """Collects PriceHistory puts and writes them with DynamoDB batch writes. Items are written once a full batch is
+    buffered and whatever is left when flush() is called. Items are whole so putting them again is harmless, which is how
+    batches DynamoDB didn't process are retried. Events aren't buffered: a batch write puts whole items, which would
+    overwrite changes made to an event since it was read (e.g. by update-event-manual or another shard)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._price_histories = []
+        self.items_written = 0
+        self.batches_written = 0
+
+    def __len__(self):
+        return len(self._price_histories)
+
+    def add_price_history(self, price_history):
+        with self._lock:
+            self._price_histories.append(price_history)
+            _full = len(self._price_histories) >= BATCH_WRITE_SIZE
+        if _full:
+            self.flush()
+
+    def flush(self):
+        """Writes everything buffered. Items that still can't be written are kept for the next flush and RuntimeError raised."""
+        with self._lock:
+            _items = self._price_histories
+            self._price_histories = []
+        _failed = []
+        for _start in range(0, len(_items), BATCH_WRITE_SIZE):
+            _batch = _items[_start:_start + BATCH_WRITE_SIZE]
+            if not self._write(PriceHistory, _batch):
+                _failed.extend(_batch)
+        if _failed:
+            with self._lock: # put back without flushing again
+                self._price_histories.extend(_failed)
+            raise RuntimeError('Could not batch write {} items to DynamoDB'.format(len(_failed)))
+
+    def _write(self, model, items):
+        for _attempt in range(BATCH_WRITE_RETRIES):
+            try:
+                with metrics.phase('dynamodb_write'):
+                    _batch = model.batch_write(auto_commit=False)
+                    for _item in items:
+                        _batch.save(_item)
+                    _batch.commit()
+                with self._lock:
+                    self.items_written += len(items)
+                    self.batches_written += 1
+                metrics.increment('dynamodb_items', len(items))
+                metrics.increment('dynamodb_batches')
+                return True
+            except PutError as err:
+                print(' Batch write to {} failed (attempt {}). Error: {}'.format(model.Meta.table_name, _attempt + 1, err))
+                metrics.increment('dynamodb_retries')
+                time.sleep(random.uniform(0, 0.1 * 2 ** _attempt))
+        return False
+
+class StubHubzDynamoDb(Storage):
 
     def __init__(self, region, endpoint):
         REGION_NAME = region
         ENDPOINT_URL = endpoint
+        self._write_buffer = None
+        self._write_batch_depth = 0
+        self._write_batch_lock = threading.Lock()
+        self.endpoint = endpoint
+
+    def __str__(self):
+        return 'DynamoDB {}'.format(self.endpoint)
+
+    # Within this block price history is buffered and written with batch writes (event updates are still written as they
+    # happen, see WriteBuffer). Everything is written when the (outermost) block exits, even if it exits with an
+    # exception. If the block raised, a failure to write is only reported so the block's exception isn't hidden
+    @contextmanager
+    def write_batch(self):
+        with self._write_batch_lock:
+            if self._write_buffer is None:
+                self._write_buffer = WriteBuffer()
+            self._write_batch_depth += 1
+        _error = None
+        try:
+            yield self._write_buffer
+        except BaseException as err:
+            _error = err
+            raise
+        finally:
+            with self._write_batch_lock:
+                self._write_batch_depth -= 1
+                _buffer = self._write_buffer if self._write_batch_depth == 0 else None
+                if _buffer is not None:
+                    self._write_buffer = None
+            if _buffer is not None:
+                try:
+                    _buffer.flush()
+                except Exception as err:
+                    if _error is None:
+                        raise
+                    print(' Could not write {} buffered PriceHistory items to DynamoDB. Error: {}'.format(len(_buffer), err))
+                else:
+                    print(' Wrote {} items to DynamoDB in {} batches'.format(_buffer.items_written, _buffer.batches_written))
 
     # Creates the tables
     def create_tables(self):
@@ -63,6 +234,51 @@ class StubHubzDynamoDb:
         if not PriceHistory.exists():
             PriceHistory.create_table(wait = True)
             print('Created PriceHistory table')
+        if not ExportState.exists():
+            ExportState.create_table(wait = True)
+            print('Created ExportState table')
+        if not CacheEntry.exists():
+            CacheEntry.create_table(wait = True)
+            print('Created StubHubzCache table')
+
+    # Adds what create_tables() would create to existing tables, i.e. the ActiveEventIndex. DynamoDB backfills the index
+    # from the existing events, this waits until it has finished
+    def migrate_tables(self):
+        _client = Event._get_connection().connection.client
+        _table = _client.describe_table(TableName=Event.Meta.table_name)['Table']
+        _indexes = [_index['IndexName'] for _index in _table.get('GlobalSecondaryIndexes', [])]
+        if ActiveEventIndex.Meta.index_name in _indexes:
+            print('Event table already has {}'.format(ActiveEventIndex.Meta.index_name))
+        else:
+            _client.update_table(
+                TableName=Event.Meta.table_name,
+                AttributeDefinitions=[
+                    {'AttributeName': 'scrape_status', 'AttributeType': 'S'},
+                    {'AttributeName': 'date_time', 'AttributeType': 'S'}
+                ],
+                GlobalSecondaryIndexUpdates=[{'Create': {
+                    'IndexName': ActiveEventIndex.Meta.index_name,
+                    'KeySchema': [
+                        {'AttributeName': 'scrape_status', 'KeyType': 'HASH'},
+                        {'AttributeName': 'date_time', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': ActiveEventIndex.Meta.read_capacity_units,
+                        'WriteCapacityUnits': ActiveEventIndex.Meta.write_capacity_units
+                    }
+                }}])
+            print('Creating {} on the Event table...'.format(ActiveEventIndex.Meta.index_name))
+        while True:
+            _table = _client.describe_table(TableName=Event.Meta.table_name)['Table']
+            _index = [_index for _index in _table.get('GlobalSecondaryIndexes', []) if _index['IndexName'] == ActiveEventIndex.Meta.index_name][0]
+            if _index['IndexStatus'] == 'ACTIVE' and not _index.get('Backfilling', False):
+                break
+            print(' Index is {}{}...'.format(_index['IndexStatus'], ' (backfilling)' if _index.get('Backfilling', False) else ''))
+            time.sleep(10)
+        _unindexed = [_event.id for _event in Event.scan() if _event.scrape_status is None or _event.date_time is None]
+        print('{} is ready. Events without a scrape status or date (which won\'t be scraped until updated): {}'.format(
+            ActiveEventIndex.Meta.index_name, _unindexed))
 
     # Drops the tables
     def drop_tables(self):
@@ -75,6 +291,16 @@ class StubHubzDynamoDb:
             print('Dropped PriceHistory table')
         else:
             print('Can\'t drop PriceHistory table because it does not exist')
+        if ExportState.exists():
+            ExportState.delete_table()
+            print('Dropped ExportState table')
+        else:
+            print('Can\'t drop ExportState table because it does not exist')
+        if CacheEntry.exists():
+            CacheEntry.delete_table()
+            print('Dropped StubHubzCache table')
+        else:
+            print('Can\'t drop StubHubzCache table because it does not exist')
     
     # Adds an event to the Event table
     def add_event(self, event_id):
@@ -95,13 +321,105 @@ class StubHubzDynamoDb:
         except Event.DoesNotExist:
             return None
 
+    # Saves every attribute of an Event
+    def save_event(self, event):
+        event.save()
+
     # Retrieves all events
     def get_events(self):
         return Event.scan()
 
-    def add_price_history(self, event_id, date_time, zone_prices):
-        price_history_item = PriceHistory(event_id, date_time, zone_prices=zone_prices)
-        price_history_item.save()
+    # Retrieves the Active events scheduled after 'since' (via the ActiveEventIndex)
+    def get_active_events(self, since):
+        return Event.active_index.query('Active', Event.date_time >= since)
+
+    # Retrieves the Active events scheduled before 'before', i.e. ones that have happened but haven't been marked Inactive
+    def get_expired_active_events(self, before):
+        return Event.active_index.query('Active', Event.date_time < before)
+
+    def add_price_history(self, event_id, date_time, zone_prices, resolution=None, delta=False):
+        price_history_item = PriceHistory(event_id, date_time, zone_prices=zone_prices, resolution=resolution, delta=True if delta else None)
+        if self._write_buffer is not None:
+            self._write_buffer.add_price_history(price_history_item)
+        else:
+            with metrics.phase('dynamodb_write'):
+                price_history_item.save()
+            metrics.increment('dynamodb_items')
+
+    # Deletes PriceHistory items with batch writes. Anything buffered by write_batch() is written first so a rollup is
+    # always written before the items it replaces are deleted
+    def delete_price_history(self, event_id, date_times):
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+        with PriceHistory.batch_write() as _batch:
+            for _date_time in date_times:
+                _batch.delete(PriceHistory(event_id, _date_time))
+
+    # Records that an event was scraped (and optionally changes its scrape status). Only these attributes are updated so
+    # changes made to the event since it was read aren't overwritten
+    def update_event_scraped(self, event, date_time, scrape_status=None, ticket_info=None, next_scrape_date_time=None, volatility=None,
+            min_price=None):
+        event.last_scraped_date_time = date_time
+        _actions = [Event.last_scraped_date_time.set(date_time)]
+        if scrape_status is not None:
+            event.scrape_status = scrape_status
+            _actions.append(Event.scrape_status.set(scrape_status))
+        if ticket_info is not None:
+            event.ticket_info = ticket_info
+            _actions.append(Event.ticket_info.set(ticket_info))
+        if next_scrape_date_time is not None:
+            event.next_scrape_date_time = next_scrape_date_time
+            _actions.append(Event.next_scrape_date_time.set(next_scrape_date_time))
+        if volatility is not None:
+            event.volatility = volatility
+            _actions.append(Event.volatility.set(volatility))
+        if min_price is not None:
+            event.min_price = min_price
+            _actions.append(Event.min_price.set(min_price))
+        self._update_event(event, _actions)
+
+    # Records that an event's ticket info was checked and hadn't changed since it was last scraped
+    def update_event_checked(self, event, date_time, next_scrape_date_time=None):
+        event.last_checked_date_time = date_time
+        _actions = [Event.last_checked_date_time.set(date_time)]
+        if next_scrape_date_time is not None:
+            event.next_scrape_date_time = next_scrape_date_time
+            _actions.append(Event.next_scrape_date_time.set(next_scrape_date_time))
+        self._update_event(event, _actions)
+
+    def _update_event(self, event, actions):
+        with metrics.phase('dynamodb_write'):
+            event.update(actions=actions)
+        metrics.increment('dynamodb_items')
+
+    # Retrieves an event's price history (see Storage.get_price_history()). The time window is a range key condition and
+    # the attributes a projection so DynamoDB only reads (and we only pay for) the items asked for. 'page_size' is each
+    # query's Limit, the next page is only queried if the caller keeps iterating
+    def get_price_history(self, event_id, since=None, until=None, newest_first=False, limit=None, attributes=None, page_size=None):
+        if since is not None and until is not None:
+            _condition = PriceHistory.date_time.between(since + datetime.timedelta(microseconds=1), until) # between is inclusive
+        elif since is not None:
+            _condition = PriceHistory.date_time > since
+        elif until is not None:
+            _condition = PriceHistory.date_time <= until
+        else:
+            _condition = None
+        _attributes = sorted(set(attributes) | set(PRICE_HISTORY_KEYS)) if attributes is not None else None
+        return PriceHistory.query(event_id, _condition, scan_index_forward=not newest_first, limit=limit, attributes_to_get=_attributes,
+                page_size=page_size)
+
+    # Retrieves how far an event's price history has been exported or None if it never has been
+    def get_export_state(self, event_id):
+        try:
+            return ExportState.get(event_id)
+        except ExportState.DoesNotExist:
+            return None
+
+    def new_export_state(self, event_id):
+        return ExportState(event_id, segment=0, segment_rows=0, rows_exported=0)
+
+    def save_export_state(self, export_state):
+        export_state.save()
 
-    def get_price_history(self, event_id):
-        return PriceHistory.query(event_id)
\ No newline at end of file
+    def delete_export_state(self, event_id):
+        ExportState(event_id).delete()
\ No newline at end of file
@@ -0,0 +1,479 @@
+import datetime
+import gzip
+import json
+import random
+import time
+
+from stubhubz import metrics
+from stubhubz.cache import MemoryCache
+from stubhubz.delta import read_price_history
+from stubhubz.downsample import lttb
+
+SEGMENT_ROWS = 168 # PriceHistory rows (i.e. scrapes) per S3 segment, about a week of hourly scrapes
+OVERVIEW_POINTS = 300 # points per zone in the overview, the same as the UI downsamples to
+SUMMARY_POINTS = 4 * OVERVIEW_POINTS # points per zone the summary of the sealed segments keeps for the overview
+SEGMENT_CACHE_TTL = 24 * 3600
+PRICE_SCALE = 100 # prices are stored as integers of 1/PRICE_SCALE (i.e. cents) in the columnar format
+COLUMNAR_VERSION = 2
+SUMMARY_VERSION = 1
+EVENTS_INDEX_VERSION = 1
+INDEX_WRITE_ATTEMPTS = 5 # to update the events index while other workers are updating it too
+# Optional zone price statistics (see stubhubz.aggregate) exported with each point -> their name in the export
+STATS = {'max_price': 'maxPrice', 'median_price': 'medianPrice', 'p10_price': 'p10Price', 'p25_price': 'p25Price'}
+
+# Segments and summaries read or written, only used while they match the event's ExportState (see _read_object())
+_SEGMENT_CACHE = MemoryCache(max_entries=200)
+
+class ZoneSeries:
+    """The price history of one zone of an event held as parallel lists (one entry per scrape)"""
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.date_times = []
+        self.min_prices = []
+        self.avg_prices = []
+        self.total_tickets = []
+        self.total_listings = []
+        self.avg_price_accurate = [] # None for price history stored before we tracked accuracy
+        self.stats = {_name: [] for _name in STATS} # None for price history stored before we computed them
+        self.histogram = None # the latest histogram of tickets by price (see stubhubz.aggregate.histogram())
+
+    def __len__(self):
+        return len(self.date_times)
+
+    def append(self, date_time, zone_price):
+        """Appends a zone price (see StubHubz._build_zone_price) scraped at date_time. A run of unchanged prices only
+        keeps its first and last points (which is all a line chart needs to draw it)"""
+        self.histogram = zone_price.get('histogram', self.histogram)
+        if len(self) >= 2 and self._unchanged(-2, zone_price) and self._unchanged(-1, zone_price):
+            self.date_times[-1] = date_time
+            return
+        self.date_times.append(date_time)
+        self.min_prices.append(round(float(zone_price['min_price']), 2))
+        self.avg_prices.append(round(float(zone_price['avg_price']), 2))
+        self.total_tickets.append(zone_price['total_tickets'])
+        self.total_listings.append(zone_price['total_listings'])
+        self.avg_price_accurate.append(zone_price.get('avg_price_accurate'))
+        for _name, _values in self.stats.items():
+            _values.append(_round_price(zone_price.get(_name)))
+
+    def _unchanged(self, index, zone_price):
+        return (self.min_prices[index] == round(float(zone_price['min_price']), 2) and self.avg_prices[index] == round(float(zone_price['avg_price']), 2)
+                and self.total_tickets[index] == zone_price['total_tickets'] and self.total_listings[index] == zone_price['total_listings']
+                and self.avg_price_accurate[index] == zone_price.get('avg_price_accurate')
+                and all(_values[index] == _round_price(zone_price.get(_name)) for _name, _values in self.stats.items()))
+
+    def extend(self, other):
+        """Appends every point of another ZoneSeries (of the same zone)"""
+        self.date_times.extend(other.date_times)
+        self.min_prices.extend(other.min_prices)
+        self.avg_prices.extend(other.avg_prices)
+        self.total_tickets.extend(other.total_tickets)
+        self.total_listings.extend(other.total_listings)
+        self.avg_price_accurate.extend(other.avg_price_accurate)
+        for _name, _values in self.stats.items():
+            _values.extend(other.stats[_name])
+        if other.histogram is not None:
+            self.histogram = other.histogram
+
+    def take(self, indices):
+        """Returns a new ZoneSeries with just the points at indices"""
+        _series = ZoneSeries(self.zone)
+        for _i in indices:
+            _series.date_times.append(self.date_times[_i])
+            _series.min_prices.append(self.min_prices[_i])
+            _series.avg_prices.append(self.avg_prices[_i])
+            _series.total_tickets.append(self.total_tickets[_i])
+            _series.total_listings.append(self.total_listings[_i])
+            _series.avg_price_accurate.append(self.avg_price_accurate[_i])
+            for _name, _values in self.stats.items():
+                _series.stats[_name].append(_values[_i])
+        _series.histogram = self.histogram
+        return _series
+
+    def downsample(self, threshold):
+        """Returns a new ZoneSeries of (at most) threshold points of the minimum price chosen with LTTB"""
+        return self.take(lttb([_date_time.timestamp() for _date_time in self.date_times], self.min_prices, threshold))
+
+    def days(self):
+        """How many calendar days the series spans"""
+        if len(self) == 0:
+            return 0
+        return (self.date_times[-1].date() - self.date_times[0].date()).days + 1
+
+    def to_chartjs(self):
+        """Returns the zone as a Chart.js dataset, i.e. {'zone', 'data': [{'x', 'y', 'avgPrice', ...}], 'histogram'}"""
+        _data = []
+        for _i in range(len(self)):
+            _point = {
+                'x': self.date_times[_i].isoformat(),
+                'y': self.min_prices[_i],
+                'avgPrice': self.avg_prices[_i],
+                'totalTickets': self.total_tickets[_i],
+                'totalListings': self.total_listings[_i]
+            }
+            if self.avg_price_accurate[_i] is not None:
+                _point['avgPriceAccurate'] = self.avg_price_accurate[_i]
+            for _name, _values in self.stats.items():
+                if _values[_i] is not None:
+                    _point[STATS[_name]] = _values[_i]
+            _data.append(_point)
+        _dataset = {'zone': self.zone, 'data': _data}
+        if self.histogram is not None:
+            _dataset['histogram'] = self.histogram
+        return _dataset
+
+    def to_columnar(self):
+        """Returns the zone as parallel arrays. Times are a start (epoch seconds) plus the seconds since the previous point
+        and prices are integers of 1/PRICE_SCALE, e.g. {'zone', 'start', 'dt': [0, 3600, ...], 'y': [8498, ...], ...}"""
+        _times = [int(_date_time.timestamp()) for _date_time in self.date_times]
+        _dataset = {
+            'zone': self.zone,
+            'start': _times[0] if _times else 0,
+            'dt': [0] + [_times[_i] - _times[_i - 1] for _i in range(1, len(_times))] if _times else [],
+            'y': [int(round(_price * PRICE_SCALE)) for _price in self.min_prices],
+            'avgPrice': [int(round(_price * PRICE_SCALE)) for _price in self.avg_prices],
+            'totalTickets': self.total_tickets,
+            'totalListings': self.total_listings,
+            'avgPriceAccurate': [None if _accurate is None else int(_accurate) for _accurate in self.avg_price_accurate]
+        }
+        for _name, _values in self.stats.items():
+            if any(_value is not None for _value in _values): # older segments don't have them
+                _dataset[STATS[_name]] = [None if _price is None else int(round(_price * PRICE_SCALE)) for _price in _values]
+        if self.histogram is not None:
+            _dataset['histogram'] = self.histogram
+        return _dataset
+
+    @classmethod
+    def from_columnar(cls, dataset):
+        _series = cls(dataset['zone'])
+        _time = dataset['start']
+        for _dt in dataset['dt']:
+            _time += _dt
+            _series.date_times.append(datetime.datetime.fromtimestamp(_time, datetime.timezone.utc))
+        _series.min_prices = [_price / PRICE_SCALE for _price in dataset['y']]
+        _series.avg_prices = [_price / PRICE_SCALE for _price in dataset['avgPrice']]
+        _series.total_tickets = list(dataset['totalTickets'])
+        _series.total_listings = list(dataset['totalListings'])
+        _series.avg_price_accurate = [None if _accurate is None else bool(_accurate) for _accurate in dataset['avgPriceAccurate']]
+        for _name, _key in STATS.items():
+            _series.stats[_name] = [None if _price is None else _price / PRICE_SCALE for _price in dataset.get(_key, [None] * len(dataset['dt']))]
+        _series.histogram = dataset.get('histogram')
+        return _series
+
+    @classmethod
+    def from_chartjs(cls, dataset):
+        _series = cls(dataset['zone'])
+        for _point in dataset['data']:
+            _series.date_times.append(datetime.datetime.fromisoformat(_point['x']))
+            _series.min_prices.append(_point['y'])
+            _series.avg_prices.append(_point['avgPrice'])
+            _series.total_tickets.append(_point['totalTickets'])
+            _series.total_listings.append(_point['totalListings'])
+            _series.avg_price_accurate.append(_point.get('avgPriceAccurate'))
+            for _name, _key in STATS.items():
+                _series.stats[_name].append(_point.get(_key))
+        _series.histogram = dataset.get('histogram')
+        return _series
+
+def _round_price(price):
+    return None if price is None else round(float(price), 2)
+
+class PriceHistorySeries:
+    """The price history of every zone of an event"""
+
+    def __init__(self):
+        self.zones = {} # zone name -> ZoneSeries
+        self.rows = 0 # how many PriceHistory items were added
+
+    def add(self, price_history):
+        """Appends a stubhubz.dynamodb.PriceHistory item"""
+        for _zone_price in price_history.zone_prices:
+            _zone_name = _zone_price['zone_name']
+            if _zone_name not in self.zones:
+                self.zones[_zone_name] = ZoneSeries(_zone_name)
+            self.zones[_zone_name].append(price_history.date_time, _zone_price)
+        self.rows += 1
+
+    def extend(self, other):
+        """Appends another (later) PriceHistorySeries"""
+        for _zone_name, _zone_series in other.zones.items():
+            if _zone_name not in self.zones:
+                self.zones[_zone_name] = ZoneSeries(_zone_name)
+            self.zones[_zone_name].extend(_zone_series)
+        self.rows += other.rows
+
+    def downsample(self, threshold_by_zone):
+        """Returns a new PriceHistorySeries with each zone downsampled to threshold_by_zone(zone series) points"""
+        _series = PriceHistorySeries()
+        for _zone_name, _zone_series in self.zones.items():
+            _series.zones[_zone_name] = _zone_series.downsample(threshold_by_zone(_zone_series))
+        _series.rows = self.rows
+        return _series
+
+    def to_chartjs(self):
+        """Returns the Chart.js datasets (sorted by zone name) for the UI"""
+        return [self.zones[_zone_name].to_chartjs() for _zone_name in sorted(self.zones.keys())]
+
+    def to_object(self, format):
+        """Returns the series as an object to be saved as JSON in either the 'json' (Chart.js datasets) or the more
+        compact 'columnar' format"""
+        _zone_names = sorted(self.zones.keys())
+        if format == 'columnar':
+            return {'version': COLUMNAR_VERSION, 'rows': self.rows, 'zones': [self.zones[_zone_name].to_columnar() for _zone_name in _zone_names]}
+        return {'rows': self.rows, 'zones': self.to_chartjs()}
+
+    @classmethod
+    def from_object(cls, value):
+        """Reverses to_object() for either format"""
+        _series = cls()
+        _from_zone = ZoneSeries.from_columnar if value.get('version') == COLUMNAR_VERSION else ZoneSeries.from_chartjs
+        for _dataset in value['zones']:
+            _series.zones[_dataset['zone']] = _from_zone(_dataset)
+        _series.rows = value['rows']
+        return _series
+
+class PriceHistoryExporter:
+    """Publishes an event's price history to S3 for the UI. The history is split into segments of SEGMENT_ROWS scrapes
+    ('<prefix>/<event ID>/<segment>.js') listed by '<prefix>/<event ID>/manifest.js'. Only the newest segment changes
+    when new price history arrives so an incremental export reads only the PriceHistory items newer than the last export
+    (tracked in the ExportState table) and rewrites only the newest segment and the manifest.
+
+    The manifest also lists downsampled resolutions of the whole history so the UI can load a small overview first:
+    'overview.js' (OVERVIEW_POINTS points per zone) and 'daily.js' (about a point per zone per day). So that an export
+    doesn't read and downsample the whole history again, each segment is downsampled once, when it's sealed, into a
+    summary of the sealed segments ('<prefix>/<event ID>/summary.js', SUMMARY_POINTS per zone towards the overview and a
+    point per zone per day). The resolutions are the summary plus the newest segment."""
+
+    def __init__(self, storage, s3_client, s3_bucket, s3_key_prefix, format='json', segment_cache=None):
+        self.storage = storage # a stubhubz.storage.Storage
+        self.format = format # see PriceHistorySeries.to_object()
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key_prefix = s3_key_prefix
+        self.segment_cache = segment_cache if segment_cache is not None else _SEGMENT_CACHE
+
+    def export(self, event_id, incremental=True):
+        """Exports an event's price history to S3 returning how many PriceHistory items were exported. Without a previous
+        export (or if incremental is False) everything is exported from scratch."""
+        _state = self.storage.get_export_state(event_id) if incremental else None
+        if _state is None:
+            _state = self.storage.new_export_state(event_id)
+            _series = PriceHistorySeries()
+            _price_histories = read_price_history(self.storage, event_id)
+        else:
+            _series = self._read_segment(event_id, _state.segment, _state.segment_rows) if _state.segment_rows > 0 else PriceHistorySeries()
+            _price_histories = read_price_history(self.storage, event_id, since=_state.last_date_time)
+        _first_segment = _state.segment
+        _sealed = [] # segments sealed by this export
+        _exported = 0
+        _changed = False # whether _series has rows that aren't in S3 yet
+        for _price_history in _price_histories:
+            if _series.rows >= SEGMENT_ROWS:
+                if _changed:
+                    self._write_segment(event_id, _state.segment, _series)
+                _sealed.append(_series)
+                _state.segment += 1
+                _series = PriceHistorySeries()
+            _series.add(_price_history)
+            _changed = True
+            _state.last_date_time = _price_history.date_time
+            _exported += 1
+        if _exported == 0:
+            return 0
+        self._write_segment(event_id, _state.segment, _series)
+        self._write_resolutions(event_id, self._update_summary(event_id, _state, _first_segment, _sealed), _series)
+        self._write_object(self._manifest_key(event_id), {
+            'version': 1,
+            'format': self.format,
+            'segments': ['{}.js'.format(_i) for _i in range(_state.segment + 1)],
+            'resolutions': {'overview': 'overview.js', 'daily': 'daily.js'}
+        })
+        _state.segment_rows = _series.rows
+        _state.rows_exported = (_state.rows_exported or 0) + _exported
+        self.storage.save_export_state(_state)
+        return _exported
+
+    def _update_summary(self, event_id, state, first_segment, sealed):
+        """Returns the summary (overview, daily) of the segments sealed before the newest one, folding in those sealed
+        since it was written ('sealed' by this export, from 'first_segment' on, and any earlier ones exported before
+        summaries existed, which are read once)"""
+        _summarised = state.summary_segments or 0
+        if _summarised > 0:
+            _summary = self._read_object(self._summary_key(event_id), lambda summary: summary.get('segments') == _summarised)
+            _overview, _daily = PriceHistorySeries.from_object(_summary['overview']), PriceHistorySeries.from_object(_summary['daily'])
+        else:
+            _overview, _daily = PriceHistorySeries(), PriceHistorySeries()
+        if _summarised == state.segment:
+            return _overview, _daily
+        for _i in range(_summarised, state.segment):
+            _segment_series = sealed[_i - first_segment] if _i >= first_segment else self._read_segment(event_id, _i)
+            _overview.extend(_segment_series)
+            _daily.extend(_segment_series.downsample(lambda zone_series: zone_series.days() + 2)) # LTTB always keeps the first and last points
+        _overview = _overview.downsample(lambda zone_series: SUMMARY_POINTS)
+        self._write_object(self._summary_key(event_id), {'version': SUMMARY_VERSION, 'segments': state.segment,
+                'overview': _overview.to_object(self.format), 'daily': _daily.to_object(self.format)}, cache=True)
+        state.summary_segments = state.segment
+        return _overview, _daily
+
+    def _write_resolutions(self, event_id, summary, series):
+        """Writes the resolutions of the summary of the sealed segments followed by the newest segment's 'series'"""
+        _summary_overview, _summary_daily = summary
+        _overview = PriceHistorySeries()
+        _overview.extend(_summary_overview)
+        _overview.extend(series)
+        _overview = _overview.downsample(lambda zone_series: OVERVIEW_POINTS)
+        self._write_object(self._resolution_key(event_id, 'overview'), _overview.to_object(self.format))
+        _daily = PriceHistorySeries()
+        _daily.extend(_summary_daily)
+        _daily.extend(series.downsample(lambda zone_series: zone_series.days() + 2))
+        self._write_object(self._resolution_key(event_id, 'daily'), _daily.to_object(self.format))
+
+    def _read_segment(self, event_id, segment, rows=None):
+        """Reads a segment, 'rows' being how many rows the ExportState says it has (if it may still be growing)"""
+        return PriceHistorySeries.from_object(self._read_object(self._segment_key(event_id, segment),
+                (lambda value: value['rows'] == rows) if rows is not None else None))
+
+    def _read_object(self, key, current=None):
+        """Reads an object from the segment cache or S3. A cached object that 'current' (if given) says doesn't match the
+        ExportState is stale, i.e. another container has exported the event since, so it's read from S3 again"""
+        _value = self.segment_cache.get('s3:' + key)
+        if _value is None or (current is not None and not current(_value)):
+            with metrics.phase('s3_read'):
+                _response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=key)
+                _body = _response['Body'].read()
+            metrics.increment('s3_gets')
+            metrics.increment('s3_read_bytes', len(_body))
+            _value = json.loads(gzip.decompress(_body).decode('utf-8'))
+            self.segment_cache.set('s3:' + key, _value, SEGMENT_CACHE_TTL)
+        return _value
+
+    def _write_segment(self, event_id, segment, series):
+        self._write_object(self._segment_key(event_id, segment), series.to_object(self.format), cache=True)
+
+    def _write_object(self, key, value, cache=False):
+        """Writes 'value' as gzipped JSON, also keeping it in the segment cache if 'cache' (i.e. it'll be read back)"""
+        _body = gzip.compress(json.dumps(value).encode('utf-8'))
+        with metrics.phase('s3_write'):
+            self.s3_client.put_object(ACL='private', Body=_body, Bucket=self.s3_bucket, ContentEncoding='gzip', ContentType='application/javascript',
+                Key=key)
+        metrics.increment('s3_puts')
+        metrics.increment('s3_bytes', len(_body))
+        if cache:
+            self.segment_cache.set('s3:' + key, value, SEGMENT_CACHE_TTL)
+
+    def _manifest_key(self, event_id):
+        return '{}/{}/manifest.js'.format(self.s3_key_prefix, event_id)
+
+    def _resolution_key(self, event_id, resolution):
+        return '{}/{}/{}.js'.format(self.s3_key_prefix, event_id, resolution)
+
+    def _segment_key(self, event_id, segment):
+        return '{}/{}/{}.js'.format(self.s3_key_prefix, event_id, segment)
+
+    def _summary_key(self, event_id):
+        return '{}/{}/summary.js'.format(self.s3_key_prefix, event_id)
+
+class EventsIndexExporter:
+    """Publishes the events the UI lists to S3 ('<prefix>/events.js', next to the price history) so a page view is a
+    static fetch instead of a dump of the Event table. Only what the UI shows is kept, events without a status are left
+    out, and the rest are sorted as the UI lists them: tracked events first, then by event date.
+
+    The index is updated in place with just the events that changed (see update()) so the Event table is only read
+    when the index is first built (or rebuilt, see rebuild()). Writes are conditional on the index being unchanged
+    since it was read (S3 conditional writes) so workers updating it at the same time don't lose each other's events."""
+
+    def __init__(self, storage, s3_client, s3_bucket, s3_key_prefix):
+        self.storage = storage # a stubhubz.storage.Storage
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key_prefix = s3_key_prefix
+
+    def update(self, events):
+        """Replaces the entries of 'events' (the Events that changed) in the index, returning whether it was written. The
+        index is built from every event if it doesn't exist yet."""
+        for _attempt in range(INDEX_WRITE_ATTEMPTS):
+            _index, _etag = self._read_index()
+            if _index is None:
+                _new_index = self.build_index(self.storage.get_events())
+            else:
+                _entries = {_entry['id']: _entry for _entry in _index['events']}
+                for _event in events:
+                    _entries.pop(_event.id, None)
+                    if _listed(_event):
+                        _entries[_event.id] = _index_entry(_event)
+                _new_index = _sorted_index(_entries.values())
+                if _new_index == _index:
+                    return False
+            if self._write_index(_new_index, {'IfMatch': _etag} if _etag is not None else {'IfNoneMatch': '*'}):
+                return True
+            time.sleep(random.uniform(0, 0.1 * 2 ** _attempt))
+        raise RuntimeError('Could not update the events index, it kept changing while it was being updated')
+
+    def rebuild(self):
+        """Writes the index of every event (from the Event table)"""
+        self._write_index(self.build_index(self.storage.get_events()), {})
+
+    @staticmethod
+    def build_index(events):
+        """Returns the index of 'events' (Events): {'version', 'events': [{'id', 'primaryPerformer', 'venue', 'dateTime',
+        'scrapeStatus', 'lastScrapedDateTime', 'minPrice'}, ...]} where 'minPrice' is the lowest price of the event's
+        zones when it was last scraped"""
+        return _sorted_index(_index_entry(_event) for _event in events if _listed(_event))
+
+    def _read_index(self):
+        """Returns the index and its ETag, or (None, None) if it hasn't been written yet"""
+        try:
+            with metrics.phase('s3_read'):
+                _response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self._index_key())
+                _body = _response['Body'].read()
+        except Exception as err:
+            if _error_code(err) in ['NoSuchKey', '404']:
+                return None, None
+            raise
+        metrics.increment('s3_gets')
+        metrics.increment('s3_read_bytes', len(_body))
+        return json.loads(gzip.decompress(_body).decode('utf-8')), _response['ETag']
+
+    def _write_index(self, index, condition):
+        """Writes the index if 'condition' holds, e.g. {'IfMatch': <ETag of the index that was read>} or {'IfNoneMatch': '*'}
+        if there wasn't one. Returns False if it doesn't."""
+        _body = gzip.compress(json.dumps(index).encode('utf-8'))
+        try:
+            with metrics.phase('s3_write'):
+                self.s3_client.put_object(ACL='private', Body=_body, Bucket=self.s3_bucket, ContentEncoding='gzip', ContentType='application/javascript',
+                    Key=self._index_key(), **condition)
+        except Exception as err:
+            if _error_code(err) in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                return False
+            raise
+        metrics.increment('s3_puts')
+        metrics.increment('s3_bytes', len(_body))
+        return True
+
+    def _index_key(self):
+        return '{}/events.js'.format(self.s3_key_prefix)
+
+def _listed(event):
+    """Whether the UI lists an event, i.e. it has a status"""
+    return bool(event.event_status or event.scrape_status)
+
+def _index_entry(event):
+    return {
+        'id': event.id,
+        'primaryPerformer': event.primary_performer or '',
+        'venue': ', '.join(_part for _part in [event.venue_name, event.venue_city] if _part),
+        'dateTime': event.date_time.isoformat() if event.date_time is not None else '',
+        'scrapeStatus': event.scrape_status or '',
+        'lastScrapedDateTime': event.last_scraped_date_time.isoformat() if event.last_scraped_date_time is not None else '',
+        'minPrice': float(event.min_price) if event.min_price is not None else None
+    }
+
+def _sorted_index(entries):
+    """Returns the index of 'entries': tracked events first, then by event date (times are all UTC so they sort as text)"""
+    return {'version': EVENTS_INDEX_VERSION, 'events': sorted(entries, key=lambda entry: (entry['scrapeStatus'] != 'Active', entry['dateTime'] == '',
+            entry['dateTime'], entry['id']))}
+
+def _error_code(err):
+    """The error code of a botocore ClientError (without importing botocore), or None for any other exception"""
+    return getattr(err, 'response', {}).get('Error', {}).get('Code')
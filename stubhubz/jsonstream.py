@@ -0,0 +1,98 @@
+import codecs
+import json
+
+STREAM_CHUNK_SIZE = 16 * 1024 # bytes read from a response at a time
+_COMPACT_SIZE = 64 * 1024 # characters consumed before they're dropped from the buffer
+_WHITESPACE = ' \t\r\n'
+_DELIMITERS = _WHITESPACE + ',]}'
+
+class JsonStreamReader:
+    """Reads a JSON document from an iterable of chunks (bytes in UTF-8 or str, e.g. a streamed HTTP response's
+    iter_content()) one value at a time so a large document never has to be held whole. Objects and arrays can be
+    walked with iter_object() and iter_array() and any value read with value(), e.g. to read just the elements of a
+    large array and pick the fields that are needed from each."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._finished = False
+
+    def value(self):
+        """Reads the next value (of any type)"""
+        self.peek()
+        while True:
+            try:
+                _value, _end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number could carry on in the next chunk (e.g. '12' then '.5'), it's only complete once a delimiter follows it
+                _number = isinstance(_value, (int, float)) and not isinstance(_value, bool)
+                if not _number or self._finished or (_end < len(self._buffer) and self._buffer[_end] in _DELIMITERS):
+                    self._position = _end
+                    return _value
+            except json.JSONDecodeError:
+                if self._finished:
+                    raise
+            self._read()
+
+    def iter_object(self):
+        """Reads an object yielding each of its keys. The caller must read the key's value (with value(), iter_object(),
+        or iter_array()) before asking for the next key."""
+        self._expect('{')
+        if self.peek() == '}':
+            self._position += 1
+            return
+        while True:
+            _key = self.value()
+            self._expect(':')
+            yield _key
+            if self._separator('}'):
+                return
+
+    def iter_array(self):
+        """Reads an array yielding each element"""
+        self._expect('[')
+        if self.peek() == ']':
+            self._position += 1
+            return
+        while True:
+            yield self.value()
+            if self._separator(']'):
+                return
+
+    def peek(self):
+        """Returns the next character that isn't whitespace (without reading it) or None at the end of the document"""
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in _WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if self._finished:
+                return None
+            self._read()
+
+    def _expect(self, character):
+        if self.peek() != character:
+            raise ValueError('Expected \'{}\' at character {} of JSON but found \'{}\''.format(character, self._position, self.peek()))
+        self._position += 1
+
+    def _separator(self, end):
+        """Reads a ',' returning False or 'end' returning True"""
+        if self.peek() == end:
+            self._position += 1
+            return True
+        self._expect(',')
+        return False
+
+    def _read(self):
+        if self._position > _COMPACT_SIZE:
+            self._buffer = self._buffer[self._position:]
+            self._position = 0
+        for _chunk in self._chunks:
+            _text = self._utf8.decode(_chunk) if isinstance(_chunk, bytes) else _chunk
+            if len(_text) > 0:
+                self._buffer += _text
+                return
+        self._buffer += self._utf8.decode(b'', final=True)
+        self._finished = True
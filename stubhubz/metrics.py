@@ -0,0 +1,183 @@
+import collections
+import contextvars
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 'StubHubz' # of the CloudWatch metrics
+RUN = 'run' # what's recorded outside of an event
+
+# The Metrics being recorded and the event being worked on. These are context variables so they follow the work onto
+# the threads of a stubhubz.concurrency.WorkerPool, e.g. a listings page fetched on the page pool counts for its event
+_METRICS = contextvars.ContextVar('stubhubz_metrics', default=None)
+_EVENT = contextvars.ContextVar('stubhubz_event', default=RUN)
+
+class Metrics:
+    """Per event (and per run) wall time of each phase (e.g. 'listings', 'dynamodb_write', 's3_write') and counters
+    (e.g. StubHub requests, bytes, and retries, DynamoDB items written). Code records into whichever Metrics is active
+    (see activate()) with the module's phase() and increment(), which do nothing when none is."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = collections.OrderedDict() # event ID (or RUN) -> ({phase: seconds}, {counter: total})
+
+    def __str__(self):
+        return 'Metrics events={}'.format(len([_event_id for _event_id in self._events if _event_id != RUN]))
+
+    def add_time(self, event_id, phase, seconds):
+        with self._lock:
+            _timings, _ = self._get(event_id)
+            _timings[phase] = _timings.get(phase, 0) + seconds
+
+    def add_count(self, event_id, counter, amount):
+        with self._lock:
+            _, _counters = self._get(event_id)
+            _counters[counter] = _counters.get(counter, 0) + amount
+
+    def _get(self, event_id):
+        if event_id not in self._events:
+            self._events[event_id] = ({}, {})
+        return self._events[event_id]
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+
+    def records(self):
+        """Returns a record per event (and for the run, i.e. whatever wasn't recorded for an event) of its phases' wall
+        time in milliseconds and its counters, e.g. {'event_id': 123, 'phases_ms': {'scrape': 812.4, ...},
+        'counters': {'stubhub_requests': 4, ...}}"""
+        with self._lock:
+            return [{'event_id': _event_id, 'phases_ms': {_phase: round(_seconds * 1000, 1) for _phase, _seconds in _timings.items()},
+                    'counters': dict(_counters)} for _event_id, (_timings, _counters) in self._events.items()]
+
+    def totals(self):
+        """Returns a single record summing every event's (and the run's)"""
+        _phases_ms = {}
+        _counters = {}
+        _records = self.records()
+        for _record in _records:
+            for _phase, _ms in _record['phases_ms'].items():
+                _phases_ms[_phase] = round(_phases_ms.get(_phase, 0) + _ms, 1)
+            for _counter, _amount in _record['counters'].items():
+                _counters[_counter] = _counters.get(_counter, 0) + _amount
+        return {'event_id': 'total', 'events': len([_record for _record in _records if _record['event_id'] != RUN]), 'phases_ms': _phases_ms,
+                'counters': _counters}
+
+    def emf_records(self, namespace=NAMESPACE):
+        """Returns the records in CloudWatch Embedded Metric Format, which AWS Lambda turns into CloudWatch metrics when
+        they're printed. Only the totals are metrics (without dimensions). A metric per event would be a custom metric,
+        billed separately, for every event ever scraped, so the event (and run) records are logged with their 'EventId' as
+        a property instead, for CloudWatch Logs Insights."""
+        _emf_records = []
+        for _record in self.records():
+            _emf_record = {'EventId': str(_record['event_id'])}
+            _emf_record.update((_phase + '_ms', _ms) for _phase, _ms in _record['phases_ms'].items())
+            _emf_record.update(_record['counters'])
+            _emf_records.append(_emf_record)
+        _totals = self.totals()
+        _metrics = [{'Name': _phase + '_ms', 'Unit': 'Milliseconds'} for _phase in _totals['phases_ms']]
+        _metrics.extend({'Name': _counter, 'Unit': 'Bytes' if _counter.endswith('_bytes') else 'Count'} for _counter in _totals['counters'])
+        _emf_record = {'_aws': {'Timestamp': int(time.time() * 1000), 'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [[]],
+                'Metrics': _metrics}]}, 'events': _totals['events']}
+        _emf_record.update((_phase + '_ms', _ms) for _phase, _ms in _totals['phases_ms'].items())
+        _emf_record.update(_totals['counters'])
+        _emf_records.append(_emf_record)
+        return _emf_records
+
+    def write(self, format, file=None):
+        """Writes the records (and totals) as JSON lines, in 'json' or 'emf' (see emf_records()) format, to file (or
+        stdout)"""
+        _file = file if file is not None else sys.stdout
+        for _record in self.emf_records() if format == 'emf' else self.records() + [self.totals()]:
+            _file.write(json.dumps(_record) + '\n')
+        _file.flush()
+
+@contextmanager
+def activate(metrics):
+    """Records into 'metrics' within this block (and the pools it starts work on)"""
+    _token = _METRICS.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _METRICS.reset(_token)
+
+def set_active(metrics):
+    """Records into 'metrics' from now on in the calling thread (and the pools it starts work on), e.g. for the whole of
+    a command-line run"""
+    _METRICS.set(metrics)
+
+@contextmanager
+def event(event_id):
+    """Records for the event 'event_id' within this block"""
+    _token = _EVENT.set(event_id)
+    try:
+        yield
+    finally:
+        _EVENT.reset(_token)
+
+@contextmanager
+def phase(name):
+    """Adds the wall time of this block to the phase 'name' of the current event"""
+    _metrics = _METRICS.get()
+    if _metrics is None:
+        yield
+        return
+    _started = time.monotonic()
+    try:
+        yield
+    finally:
+        _metrics.add_time(_EVENT.get(), name, time.monotonic() - _started)
+
+def increment(name, amount=1):
+    """Adds 'amount' to the counter 'name' of the current event"""
+    _metrics = _METRICS.get()
+    if _metrics is not None:
+        _metrics.add_count(_EVENT.get(), name, amount)
+
+class Profiler:
+    """Profiles everything between start() and stop() with cProfile (CPU) and tracemalloc (memory) and writes a text
+    report to 'path': the functions with the most cumulative time and the lines that allocated the most memory still in
+    use, plus the peak. The raw cProfile stats are written to '<path>.prof' (e.g. for snakeviz). cProfile only profiles
+    the thread that called start(), so the work done on the threads of a stubhubz.concurrency.WorkerPool (with more than
+    one worker) is missing from the report."""
+
+    def __init__(self, path, top=40):
+        self.path = path
+        self.top = top
+        self._profile = None
+        self._started = None
+
+    def start(self):
+        import cProfile
+        import tracemalloc
+        tracemalloc.start(10)
+        self._profile = cProfile.Profile()
+        self._started = time.monotonic()
+        self._profile.enable()
+
+    def stop(self):
+        if self._profile is None:
+            return
+        import io
+        import pstats
+        import tracemalloc
+        self._profile.disable()
+        _elapsed = time.monotonic() - self._started
+        _snapshot = tracemalloc.take_snapshot()
+        _current, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._profile.dump_stats(self.path + '.prof')
+        _stats = io.StringIO()
+        pstats.Stats(self._profile, stream=_stats).sort_stats('cumulative').print_stats(self.top)
+        with open(self.path, 'w') as _file:
+            _file.write('Wall time: {:.3f}s\nMemory: current={:.1f} KiB, peak={:.1f} KiB\n\n'.format(_elapsed, _current / 1024, _peak / 1024))
+            _file.write('Top {} lines by memory allocated (and still in use)\n'.format(self.top))
+            for _statistic in _snapshot.statistics('lineno')[:self.top]:
+                _file.write(' {}\n'.format(_statistic))
+            _file.write('\nTop {} functions by cumulative time\n'.format(self.top))
+            _file.write(_stats.getvalue())
+        self._profile = None
+        print('Wrote profile to {} (and {}.prof)'.format(self.path, self.path))
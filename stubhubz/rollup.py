@@ -0,0 +1,97 @@
+import collections
+import datetime
+
+from stubhubz.delta import read_price_history
+
+RAW_RETENTION_DAYS = 7 # scrapes older than this are folded into hourly rollups
+HOURLY_RETENTION_DAYS = 90 # hourly rollups (and scrapes) older than this are folded into daily rollups
+ROLLUP_FIELDS = ['min_price', 'avg_price', 'median_price'] # the zone price fields summarised by a rollup
+
+def bucket_start(date_time, resolution):
+    """The start of the 'hour' or 'day' the date time is in"""
+    if resolution == 'hour':
+        return date_time.replace(minute=0, second=0, microsecond=0)
+    return date_time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def rollup_zone_prices(price_histories):
+    """Folds PriceHistory items (oldest first) into the zone_prices of a single rollup item. Each zone keeps its last
+    zone price (so readers can treat a rollup like any other item) plus a 'rollup' summary of ROLLUP_FIELDS: the min,
+    max, and mean over every scrape folded in, and how many scrapes that was. Items which are already rollups are folded
+    in with their summaries so rollups can be rolled up again (e.g. hourly into daily)."""
+    _zones = collections.OrderedDict() # zone ID -> (last zone price, samples, field -> [min, max, total])
+    for _price_history in price_histories:
+        for _zone_price in _price_history.zone_prices or []:
+            _summary = _zone_price.get('rollup')
+            _samples = _summary['samples'] if _summary is not None else 1
+            _, _zone_samples, _fields = _zones.get(_zone_price['zone_id'], (None, 0, {}))
+            for _field in ROLLUP_FIELDS:
+                if _summary is not None and _field in _summary:
+                    _min, _max, _mean = _summary[_field]['min'], _summary[_field]['max'], _summary[_field]['mean']
+                elif _zone_price.get(_field) is not None:
+                    _min = _max = _mean = _zone_price[_field]
+                else:
+                    continue
+                _stats = _fields.setdefault(_field, [_min, _max, 0])
+                _stats[0] = min(_stats[0], _min)
+                _stats[1] = max(_stats[1], _max)
+                _stats[2] += _mean * _samples
+            _zones[_zone_price['zone_id']] = (_zone_price, _zone_samples + _samples, _fields)
+    _result = []
+    for _last, _samples, _fields in _zones.values():
+        _zone_price = dict(_last)
+        _zone_price['rollup'] = {'samples': _samples}
+        for _field, (_min, _max, _total) in _fields.items():
+            _zone_price['rollup'][_field] = {'min': _min, 'max': _max, 'mean': _total / _samples}
+        _result.append(_zone_price)
+    return _result
+
+class PriceHistoryCompactor:
+    """Folds an event's old PriceHistory items into rollups: scrapes older than 'raw_retention_days' into one item per
+    hour and anything older than 'hourly_retention_days' into one item per day. A rollup replaces the last item of its
+    hour or day (so it has that item's date_time) and the others are deleted. Readers get rollups and recent scrapes
+    from the same query, in time order. Delta items (see stubhubz.delta) are expanded first so rollups have every zone.
+
+    Compaction can be re-run at any time: items already at the right resolution are left alone. Rollups are written
+    before anything is deleted, and items older than a rollup in its own hour or day were folded into it, so a run that
+    was interrupted is finished by deleting them."""
+
+    def __init__(self, storage, raw_retention_days=RAW_RETENTION_DAYS, hourly_retention_days=HOURLY_RETENTION_DAYS):
+        self.storage = storage # a stubhubz.storage.Storage
+        self.raw_retention_days = raw_retention_days
+        self.hourly_retention_days = max(hourly_retention_days, raw_retention_days)
+
+    def __str__(self):
+        return 'PriceHistoryCompactor raw_retention_days={}, hourly_retention_days={}'.format(self.raw_retention_days, self.hourly_retention_days)
+
+    def compact(self, event_id, now=None):
+        """Compacts an event's price history returning (items read, rollups written, items deleted)"""
+        _now = now if now is not None else datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        _raw_cutoff = _now - datetime.timedelta(days=self.raw_retention_days)
+        _hourly_cutoff = _now - datetime.timedelta(days=self.hourly_retention_days)
+        _buckets = collections.OrderedDict() # (resolution, start) -> PriceHistory items
+        _read = 0
+        for _price_history in read_price_history(self.storage, event_id, until=_raw_cutoff):
+            _resolution = 'day' if _price_history.date_time < _hourly_cutoff or _price_history.resolution == 'day' else 'hour'
+            _buckets.setdefault((_resolution, bucket_start(_price_history.date_time, _resolution)), []).append(_price_history)
+            _read += 1
+        _written = 0
+        _deletes = []
+        with self.storage.write_batch():
+            for (_resolution, _), _price_histories in _buckets.items():
+                _folded = 0 # items before the bucket's newest rollup are already folded into it
+                for _index, _price_history in enumerate(_price_histories):
+                    if _price_history.resolution == _resolution:
+                        _folded = _index
+                _deletes.extend(_price_history.date_time for _price_history in _price_histories[:_folded])
+                _unfolded = _price_histories[_folded:]
+                if len(_unfolded) == 1 and _unfolded[0].resolution == _resolution:
+                    continue
+                # Only zones still listed at the end of the bucket, delta items after the rollup carry on from its zones
+                _zone_ids = set(_zone_price['zone_id'] for _zone_price in _unfolded[-1].zone_prices)
+                _zone_prices = [_zone_price for _zone_price in rollup_zone_prices(_unfolded) if _zone_price['zone_id'] in _zone_ids]
+                self.storage.add_price_history(event_id, _unfolded[-1].date_time, _zone_prices, _resolution)
+                _written += 1
+                _deletes.extend(_price_history.date_time for _price_history in _unfolded[:-1])
+        if len(_deletes) > 0:
+            self.storage.delete_price_history(event_id, _deletes)
+        return _read, _written, len(_deletes)
@@ -0,0 +1,107 @@
+import datetime
+import threading
+import time
+
+MIN_INTERVAL_MINUTES = 60 # how often the scrape is triggered by CloudWatch, no event can be scraped more often than this
+MAX_INTERVAL_MINUTES = 24 * 60
+DUE_SLACK_MINUTES = 10 # events due this soon after a run starts are scraped now rather than waiting for the next run
+# Minutes between scrapes by hours until the event. Events further away than the last entry use MAX_INTERVAL_MINUTES
+INTERVALS_BY_HOURS_TO_EVENT = [(48, 60), (7 * 24, 3 * 60), (30 * 24, 6 * 60)]
+VOLATILITY_WINDOW_HOURS = 24 # how much recent price history volatility is measured over
+HIGH_VOLATILITY = 0.05 # events whose zones' min prices move more than this (5%) between scrapes are scraped twice as often
+LOW_VOLATILITY = 0.005 # and events whose prices move less than this are scraped half as often
+
+class ScrapeScheduler:
+    """Decides when each event is next due to be scraped, which due events to scrape first, and when a run has used up
+    its budget. Events are scraped more often as they get closer and when their prices have been moving.
+    'request_budget' is the most StubHub requests a run may make and 'time_limit' the most seconds it may take (either
+    can be None for no limit). Events that don't fit in a run stay due and go first next time."""
+
+    def __init__(self, request_budget=None, time_limit=None):
+        self.request_budget = request_budget
+        self.time_limit = time_limit
+        self._lock = threading.Lock()
+        self._requests = None
+        self._requests_at_start = 0
+        self._request_budget = request_budget
+        self._started_at = None
+        self._deadline = None
+        self._longest_event = 0
+
+    def __str__(self):
+        return 'ScrapeScheduler request_budget={}, time_limit={}'.format(self.request_budget, self.time_limit)
+
+    def interval(self, event, now):
+        """How long to wait before scraping the event again given its date and (stored) volatility"""
+        _hours_to_event = (event.date_time - now).total_seconds() / 3600
+        _minutes = MAX_INTERVAL_MINUTES
+        for _hours, _interval in INTERVALS_BY_HOURS_TO_EVENT:
+            if _hours_to_event <= _hours:
+                _minutes = _interval
+                break
+        if event.volatility is not None:
+            if event.volatility >= HIGH_VOLATILITY:
+                _minutes /= 2
+            elif event.volatility <= LOW_VOLATILITY:
+                _minutes *= 2
+        return datetime.timedelta(minutes=min(MAX_INTERVAL_MINUTES, max(MIN_INTERVAL_MINUTES, _minutes)))
+
+    def next_scrape(self, event, now):
+        return now + self.interval(event, now)
+
+    def due(self, events, now):
+        """Returns the events that are due, most overdue (relative to their interval) first. Events that have never been
+        scheduled go first, soonest event first."""
+        _due = []
+        for _event in events:
+            if _event.next_scrape_date_time is None:
+                _due.append((float('inf'), -_event.date_time.timestamp(), _event))
+            elif _event.next_scrape_date_time <= now + datetime.timedelta(minutes=DUE_SLACK_MINUTES):
+                _lateness = (now - _event.next_scrape_date_time) / self.interval(_event, now)
+                _due.append((_lateness, -_event.date_time.timestamp(), _event))
+        _due.sort(key=lambda due: due[:2], reverse=True)
+        return [_event for _, _, _event in _due]
+
+    def begin(self, requests, time_limit=None, request_budget=None):
+        """Starts a run. 'requests' is called to get how many StubHub requests have been made so far. 'time_limit' and
+        'request_budget' override the scheduler's limits for this run (e.g. the time an AWS Lambda has left, or a shard's
+        share of the budget)."""
+        with self._lock:
+            self._requests = requests
+            self._request_budget = request_budget if request_budget is not None else self.request_budget
+            self._requests_at_start = requests()
+            self._started_at = time.monotonic()
+            _time_limit = time_limit if time_limit is not None else self.time_limit
+            self._deadline = self._started_at + _time_limit if _time_limit is not None else None
+            self._longest_event = 0
+
+    def can_start(self):
+        """Whether there's enough budget left in the run to start scraping another event"""
+        with self._lock:
+            if self._request_budget is not None and self._requests() - self._requests_at_start >= self._request_budget:
+                return False
+            if self._deadline is not None and time.monotonic() + self._longest_event >= self._deadline:
+                return False
+            return True
+
+    def finished(self, seconds):
+        """Records how long scraping an event took so a run doesn't start an event it won't have time to finish"""
+        with self._lock:
+            self._longest_event = max(self._longest_event, seconds)
+
+    @staticmethod
+    def volatility(zone_prices_history):
+        """The mean relative change of each zone's min price between consecutive scrapes, given a list of PriceHistory
+        zone_prices lists (oldest first), or None if there aren't two scrapes to compare"""
+        _changes = []
+        _previous = None
+        for _zone_prices in zone_prices_history:
+            _current = {_zone['zone_id']: _zone['min_price'] for _zone in _zone_prices if _zone.get('min_price')}
+            if _previous is not None:
+                for _zone_id, _min_price in _current.items():
+                    if _zone_id in _previous:
+                        _changes.append(abs(_min_price - _previous[_zone_id]) / _previous[_zone_id])
+            _previous = _current
+        if len(_changes) == 0:
+            return None
+        return sum(_changes) / len(_changes)
@@ -0,0 +1,99 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from stubhubz import metrics
+
+# Sessions by name (see get_session()), so every caller shares a session's connection pool
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+class ConnectionStats:
+    """Thread safe counters of how many connections were opened versus reused, and how many requests were retried"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.checkouts = 0
+        self.opened = 0
+        self.retries = 0
+
+    def __str__(self):
+        return 'requests={}, connections opened={}, connections reused={}, retries={}'.format(self.requests, self.opened, self.reused, self.retries)
+
+    @property
+    def reused(self):
+        return max(0, self.checkouts - self.opened)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+class PooledSession(requests.Session):
+    """A requests.Session with a bounded keep-alive connection pool, default timeouts, and retry with exponential backoff
+    for 429 and 5xx responses. Once retries are exhausted the last response is returned so callers can report it."""
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30, retries=3, backoff_factor=0.5):
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = ConnectionStats()
+        _adapter = _CountingAdapter(self.stats, pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=_counting_retry(self.stats)(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None, raise_on_status=False, respect_retry_after_header=True))
+        self.mount('https://', _adapter)
+        self.mount('http://', _adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.stats.increment('requests')
+        return super().request(method, url, **kwargs)
+
+def reset_sessions():
+    """Closes the shared sessions' pooled connections, e.g. in a forked process so it doesn't share its parent's. The
+    sessions stay usable and open new connections."""
+    with _SESSIONS_LOCK:
+        for _session in _SESSIONS.values():
+            _session.close()
+
+def get_session(name, **config):
+    """Returns the shared PooledSession called 'name', creating it with 'config' (see PooledSession) the first time"""
+    with _SESSIONS_LOCK:
+        if name not in _SESSIONS:
+            _SESSIONS[name] = PooledSession(**config)
+        return _SESSIONS[name]
+
+class _CountingAdapter(HTTPAdapter):
+    """Swaps urllib3's connection pool classes for ones that count connection checkouts and new connections"""
+
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self._stats),
+            'https': _counting_pool(HTTPSConnectionPool, self._stats)
+        }
+
+def _counting_pool(pool_class, stats):
+    class _CountingPool(pool_class):
+        def _get_conn(self, timeout=None):
+            stats.increment('checkouts')
+            return super()._get_conn(timeout=timeout)
+
+        def _new_conn(self):
+            stats.increment('opened')
+            return super()._new_conn()
+    return _CountingPool
+
+def _counting_retry(stats):
+    class _CountingRetry(Retry):
+        def increment(self, *args, **kwargs):
+            stats.increment('retries')
+            metrics.increment('http_retries') # e.g. a 429 or 5xx retried with backoff
+            return super().increment(*args, **kwargs)
+    return _CountingRetry
@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from pynamodb.attributes import MapAttribute
+
+from stubhubz.dynamodb import Event, ExportState, PriceHistory
+from stubhubz.storage import Storage
+
+DATE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z' # as PynamoDB stores UTCDateTimeAttribute, in UTC so text order is time order
+EVENT_COLUMNS = ['id', 'name', 'date_time', 'event_status', 'venue_name', 'venue_city', 'primary_performer', 'last_scraped_date_time',
+        'scrape_status', 'ticket_info', 'last_checked_date_time', 'next_scrape_date_time', 'volatility', 'min_price']
+EVENT_DATE_TIME_COLUMNS = ['date_time', 'last_scraped_date_time', 'last_checked_date_time', 'next_scrape_date_time']
+EXPORT_STATE_COLUMNS = ['event_id', 'last_date_time', 'segment', 'segment_rows', 'rows_exported', 'summary_segments']
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS event (id INTEGER PRIMARY KEY, name TEXT, date_time TEXT, event_status TEXT, venue_name TEXT,
+        venue_city TEXT, primary_performer TEXT, last_scraped_date_time TEXT, scrape_status TEXT, ticket_info TEXT,
+        last_checked_date_time TEXT, next_scrape_date_time TEXT, volatility REAL, min_price REAL)''',
+    'CREATE INDEX IF NOT EXISTS event_active ON event (scrape_status, date_time)',
+    '''CREATE TABLE IF NOT EXISTS price_history (event_id INTEGER NOT NULL, date_time TEXT NOT NULL, zone_prices TEXT NOT NULL,
+        resolution TEXT, delta INTEGER, PRIMARY KEY (event_id, date_time)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS export_state (event_id INTEGER PRIMARY KEY, last_date_time TEXT, segment INTEGER,
+        segment_rows INTEGER, rows_exported INTEGER, summary_segments INTEGER)'''
+]
+
+class SqliteStorage(Storage):
+    """Storage in a local SQLite database (in WAL mode so readers don't block the scrape). Price history is keyed on
+    (event_id, date_time) so range queries are index seeks, and zone prices are stored as JSON which SQLite's JSON
+    functions can query across events. Within write_batch() writes are committed in one transaction."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock() # one connection is shared by every thread
+        self._connection = None
+        self._pid = None
+        self._batch_depth = 0
+
+    def __str__(self):
+        return 'SQLite {}'.format(self.path)
+
+    def _connect(self):
+        # A forked process (see stubhubz.dispatch.ProcessDispatcher) can't use its parent's connection so it opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            for _statement in SCHEMA:
+                self._connection.execute(_statement)
+            self._connection.commit()
+            self._pid = os.getpid()
+            self._batch_depth = 0
+        return self._connection
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    def _write(self, sql, parameters=()):
+        with self._lock:
+            _connection = self._connect()
+            _connection.execute(sql, parameters)
+            if self._batch_depth == 0:
+                _connection.commit()
+
+    @contextmanager
+    def write_batch(self):
+        with self._lock:
+            self._connect()
+            self._batch_depth += 1
+        try:
+            yield None
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._connection.commit()
+
+    def create_tables(self):
+        self._connect()
+        print('Created tables in {}'.format(self.path))
+
+    def migrate_tables(self):
+        self.create_tables()
+
+    def drop_tables(self):
+        with self._lock:
+            _connection = self._connect()
+            for _table in ['event', 'price_history', 'export_state']:
+                _connection.execute('DROP TABLE IF EXISTS {}'.format(_table))
+            _connection.commit()
+            self._connection.close()
+            self._connection = None
+        print('Dropped tables in {}'.format(self.path))
+
+    def add_event(self, event_id):
+        self._write('INSERT OR IGNORE INTO event (id) VALUES (?)', (event_id,))
+
+    def get_event(self, event_id):
+        _rows = self._query('SELECT {} FROM event WHERE id = ?'.format(', '.join(EVENT_COLUMNS)), (event_id,))
+        return self._to_event(_rows[0]) if len(_rows) > 0 else None
+
+    def save_event(self, event):
+        _values = [self._from_attribute(_column, getattr(event, _column)) for _column in EVENT_COLUMNS]
+        self._write('INSERT OR REPLACE INTO event ({}) VALUES ({})'.format(', '.join(EVENT_COLUMNS), ', '.join('?' * len(EVENT_COLUMNS))), _values)
+
+    def get_events(self):
+        return [self._to_event(_row) for _row in self._query('SELECT {} FROM event ORDER BY id'.format(', '.join(EVENT_COLUMNS)))]
+
+    def get_active_events(self, since):
+        return [self._to_event(_row) for _row in self._query('SELECT {} FROM event WHERE scrape_status = ? AND date_time >= ? ORDER BY date_time'.format(
+                ', '.join(EVENT_COLUMNS)), ('Active', _format_date_time(since)))]
+
+    def get_expired_active_events(self, before):
+        return [self._to_event(_row) for _row in self._query('SELECT {} FROM event WHERE scrape_status = ? AND date_time < ? ORDER BY date_time'.format(
+                ', '.join(EVENT_COLUMNS)), ('Active', _format_date_time(before)))]
+
+    def update_event_scraped(self, event, date_time, scrape_status=None, ticket_info=None, next_scrape_date_time=None, volatility=None,
+            min_price=None):
+        event.last_scraped_date_time = date_time
+        if scrape_status is not None:
+            event.scrape_status = scrape_status
+        if ticket_info is not None:
+            event.ticket_info = ticket_info
+        if next_scrape_date_time is not None:
+            event.next_scrape_date_time = next_scrape_date_time
+        if volatility is not None:
+            event.volatility = volatility
+        if min_price is not None:
+            event.min_price = min_price
+        self.save_event(event)
+
+    def update_event_checked(self, event, date_time, next_scrape_date_time=None):
+        event.last_checked_date_time = date_time
+        if next_scrape_date_time is not None:
+            event.next_scrape_date_time = next_scrape_date_time
+        self.save_event(event)
+
+    def add_price_history(self, event_id, date_time, zone_prices, resolution=None, delta=False):
+        self._write('INSERT OR REPLACE INTO price_history (event_id, date_time, zone_prices, resolution, delta) VALUES (?, ?, ?, ?, ?)',
+                (event_id, _format_date_time(date_time), json.dumps(zone_prices), resolution, 1 if delta else None))
+
+    def delete_price_history(self, event_id, date_times):
+        with self.write_batch():
+            for _date_time in date_times:
+                self._write('DELETE FROM price_history WHERE event_id = ? AND date_time = ?', (event_id, _format_date_time(_date_time)))
+
+    def get_price_history(self, event_id, since=None, until=None, newest_first=False, limit=None, attributes=None, page_size=None):
+        _sql = 'SELECT date_time, resolution, delta, {} FROM price_history WHERE event_id = ?'.format(
+                'zone_prices' if attributes is None or 'zone_prices' in attributes else 'NULL')
+        _parameters = [event_id]
+        if since is not None:
+            _sql += ' AND date_time > ?'
+            _parameters.append(_format_date_time(since))
+        if until is not None:
+            _sql += ' AND date_time <= ?'
+            _parameters.append(_format_date_time(until))
+        _sql += ' ORDER BY date_time DESC' if newest_first else ' ORDER BY date_time'
+        if limit is not None:
+            _sql += ' LIMIT ?'
+            _parameters.append(limit)
+        return [PriceHistory(event_id, _parse_date_time(_date_time), zone_prices=json.loads(_zone_prices) if _zone_prices is not None else None,
+                resolution=_resolution, delta=True if _delta else None) for _date_time, _resolution, _delta, _zone_prices in self._query(_sql, _parameters)]
+
+    def get_export_state(self, event_id):
+        _rows = self._query('SELECT {} FROM export_state WHERE event_id = ?'.format(', '.join(EXPORT_STATE_COLUMNS)), (event_id,))
+        if len(_rows) == 0:
+            return None
+        _event_id, _last_date_time, _segment, _segment_rows, _rows_exported, _summary_segments = _rows[0]
+        return ExportState(_event_id, last_date_time=_parse_date_time(_last_date_time), segment=_segment, segment_rows=_segment_rows,
+                rows_exported=_rows_exported, summary_segments=_summary_segments)
+
+    def new_export_state(self, event_id):
+        return ExportState(event_id, segment=0, segment_rows=0, rows_exported=0)
+
+    def save_export_state(self, export_state):
+        self._write('INSERT OR REPLACE INTO export_state ({}) VALUES ({})'.format(', '.join(EXPORT_STATE_COLUMNS), ', '.join('?' * len(EXPORT_STATE_COLUMNS))),
+                (export_state.event_id, _format_date_time(export_state.last_date_time), export_state.segment, export_state.segment_rows,
+                export_state.rows_exported, export_state.summary_segments))
+
+    def delete_export_state(self, event_id):
+        self._write('DELETE FROM export_state WHERE event_id = ?', (event_id,))
+
+    def _to_event(self, row):
+        _attributes = {}
+        for _column, _value in zip(EVENT_COLUMNS[1:], row[1:]):
+            if _value is None:
+                continue
+            if _column in EVENT_DATE_TIME_COLUMNS:
+                _value = _parse_date_time(_value)
+            elif _column == 'ticket_info':
+                _value = MapAttribute(**json.loads(_value))
+            _attributes[_column] = _value
+        return Event(row[0], **_attributes)
+
+    def _from_attribute(self, column, value):
+        if value is None:
+            return None
+        if column in EVENT_DATE_TIME_COLUMNS:
+            return _format_date_time(value)
+        if column == 'ticket_info':
+            return json.dumps(value.as_dict() if isinstance(value, MapAttribute) else value)
+        return value
+
+def _format_date_time(value):
+    if value is None:
+        return None
+    if value.tzinfo is None: # StubHubz uses naive datetime.utcnow()s
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime(DATE_TIME_FORMAT)
+
+def _parse_date_time(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, DATE_TIME_FORMAT)
@@ -0,0 +1,133 @@
+import datetime
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+PRICE_HISTORY_PAGE_SIZE = 100
+PRICE_HISTORY_KEYS = ['event_id', 'date_time'] # always retrieved whatever attributes are asked for
+
+class Storage(metaclass=ABCMeta):
+    """Where StubHubz keeps events, their price history, and how far it has been exported. Items are the PynamoDB models
+    of stubhubz.dynamodb (Event, PriceHistory, ExportState) whichever backend stores them. StubHubzDynamoDb is the AWS
+    backend and stubhubz.sqlite.SqliteStorage an embedded one for offline analysis and tests."""
+
+    @abstractmethod
+    def create_tables(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def migrate_tables(self):
+        """Adds whatever create_tables() would create to existing tables"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def drop_tables(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def write_batch(self):
+        """Within this block writes may be buffered, everything is written by the time the block exits"""
+        yield None
+
+    @abstractmethod
+    def add_event(self, event_id):
+        raise NotImplementedError
+
+    def has_event(self, event_id):
+        return self.get_event(event_id) is not None
+
+    @abstractmethod
+    def get_event(self, event_id):
+        """Returns the Event or None if it doesn't exist"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_event(self, event):
+        """Saves every attribute of the Event"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_events(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_active_events(self, since):
+        """Returns the Active events scheduled at or after 'since'"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expired_active_events(self, before):
+        """Returns the Active events scheduled before 'before'"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_event_scraped(self, event, date_time, scrape_status=None, ticket_info=None, next_scrape_date_time=None, volatility=None,
+            min_price=None):
+        """Records that an event was scraped, updating the other attributes that aren't None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_event_checked(self, event, date_time, next_scrape_date_time=None):
+        """Records that an event's ticket info was checked and hadn't changed since it was last scraped"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_price_history(self, event_id, date_time, zone_prices, resolution=None, delta=False):
+        """Adds (or replaces) a PriceHistory item. 'resolution' is None for a scrape or 'hour' or 'day' for a rollup.
+        'delta' means zone_prices only has the zones that changed since the previous item (see stubhubz.delta)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_price_history(self, event_id, date_times):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_price_history(self, event_id, since=None, until=None, newest_first=False, limit=None, attributes=None, page_size=None):
+        """Returns an event's PriceHistory items, oldest first (or newest first). If 'since' is given only items newer than
+        it and if 'until' is given only items up to and including it. 'limit' is the most items to return and
+        'attributes' the names of the attributes to retrieve (the keys are always retrieved), e.g. ['date_time'] to only
+        list when the event was scraped. 'page_size' is the most items read at a time, for callers that usually stop
+        iterating after a few items."""
+        raise NotImplementedError
+
+    def get_price_history_page(self, event_id, cursor=None, page_size=PRICE_HISTORY_PAGE_SIZE, since=None, until=None, newest_first=False,
+            attributes=None):
+        """Returns a page of an event's PriceHistory items (see get_price_history()) and the cursor of the next page, or
+        None if this is the last page. Pass the cursor back to get the next page."""
+        if cursor is not None:
+            _cursor = datetime.datetime.fromisoformat(cursor)
+            if newest_first:
+                _before = _cursor - datetime.timedelta(microseconds=1) # 'until' is inclusive
+                until = _before if until is None else min(until, _before)
+            else:
+                since = _cursor if since is None else max(since, _cursor)
+        _items = list(self.get_price_history(event_id, since, until, newest_first, page_size, attributes))
+        _next_cursor = _items[-1].date_time.isoformat() if len(_items) == page_size else None
+        return _items, _next_cursor
+
+    @abstractmethod
+    def get_export_state(self, event_id):
+        """Returns the event's ExportState or None if it has never been exported"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def new_export_state(self, event_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_export_state(self, export_state):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_export_state(self, event_id):
+        """Forgets how far the event's price history has been exported so its next export starts from scratch"""
+        raise NotImplementedError
+
+def get_storage(spec, region=None, endpoint=None):
+    """Returns the storage for 'spec' which is 'dynamodb' (using 'region' and 'endpoint') or 'sqlite:<path>'"""
+    if spec == 'dynamodb':
+        from stubhubz.dynamodb import StubHubzDynamoDb
+        return StubHubzDynamoDb(region, endpoint)
+    if spec.startswith('sqlite:'):
+        from stubhubz.sqlite import SqliteStorage
+        return SqliteStorage(spec[len('sqlite:'):])
+    raise ValueError('Unknown storage \'{}\'. Expected \'dynamodb\' or \'sqlite:<path>\''.format(spec))
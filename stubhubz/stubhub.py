@@ -1,22 +1,68 @@
 import base64
-import requests
 import json
+import threading
+import time
 from datetime import datetime
-from stubhubz.dynamodb import Event
+from stubhubz import metrics
+from stubhubz.cache import get_cache
+from stubhubz.jsonstream import STREAM_CHUNK_SIZE, JsonStreamReader
 from stubhubz.model import TicketSource
 
+LISTINGS_PAGE_SIZE = 100 # the most listings StubHub returns per find listings request
+SECTION_ZONES_TTL = 7 * 24 * 3600 # a venue's zones almost never change while we track an event
+EVENT_INFO_TTL = 3600
+TOKEN_REFRESH_MARGIN = 300 # refresh access tokens this many seconds before they expire
+TOKEN_STORE_TTL = 90 * 24 * 3600 # how long a stored token (and its refresh token) is kept
+TICKET_INFO_BATCH_SIZE = 50 # how many events' ticket info is requested per search
+TICKET_INFO_KEYS = ['minListPrice', 'maxListPrice', 'totalTickets', 'totalListings']
+
 class AuthToken:
     """Reprents a logged in session for either the V2 or V3 API, i.e. has the bear/access token"""
     def __init__(self, response):
         if response.status_code != 200:
             raise RuntimeError('Login failed. Response status code: ' + str(response.status_code) + '. Text: ' + str(response.text))
         self.access_token = response.json()['access_token']
-        self.refresh_token = response.json()['refresh_token']
+        self.refresh_token = response.json().get('refresh_token')
+        _expires_in = response.json().get('expires_in')
+        self.expires_at = time.time() + int(_expires_in) if _expires_in is not None else None # epoch seconds or None if unknown
+
+    def expires_soon(self):
+        """Whether the access token has expired or will within TOKEN_REFRESH_MARGIN seconds"""
+        return self.expires_at is not None and self.expires_at - TOKEN_REFRESH_MARGIN <= time.time()
+
+    def to_dict(self):
+        return {'access_token': self.access_token, 'refresh_token': self.refresh_token, 'expires_at': self.expires_at}
+
+    @classmethod
+    def from_dict(cls, value):
+        _token = cls.__new__(cls)
+        _token.access_token = value['access_token']
+        _token.refresh_token = value['refresh_token']
+        _token.expires_at = value['expires_at']
+        return _token
+
+class TokenStore:
+    """Keeps AuthTokens in a stubhubz.cache.Cache (e.g. a file or DynamoDB) so they are reused across processes"""
+
+    def __init__(self, cache, user):
+        self.cache = cache
+        self.user = user
+
+    def load(self, api_version):
+        _value = self.cache.get(self._key(api_version))
+        return AuthToken.from_dict(_value) if _value is not None else None
+
+    def save(self, api_version, token):
+        self.cache.set(self._key(api_version), token.to_dict(), TOKEN_STORE_TTL)
+
+    def _key(self, api_version):
+        return 'token:{}:{}'.format(api_version, self.user)
 
 class StubHubApi(TicketSource):
     """Represents the StubHub API"""
 
-    def __init__(self, v2_consumer_key, v2_consumer_secret, v2_scope, v3_consumer_key, v3_consumer_secret, user, password):
+    def __init__(self, v2_consumer_key, v2_consumer_secret, v2_scope, v3_consumer_key, v3_consumer_secret, user, password, rate_limiter=None, session=None,
+            cache=None, token_store=None):
         self.v2_consumer_key = v2_consumer_key
         self.v2_consumer_secret = v2_consumer_secret
         self.v2_scope = v2_scope
@@ -26,66 +72,111 @@ class StubHubApi(TicketSource):
         self.password = password
         self.v2_auth_token = None
         self.v3_auth_token = None
+        self.rate_limiter = rate_limiter # optional stubhubz.concurrency.TokenBucket shared by every thread calling this API
+        self._auth_lock = threading.Lock()
+        if session is None:
+            from stubhubz.session import get_session # imports requests which only the StubHub API needs
+            session = get_session('stubhub')
+        self.session = session # keep-alive connections to api.stubhub.com
+        self.cache = cache if cache is not None else get_cache('memory') # section zones and event info, see stubhubz.cache
+        self.token_store = token_store # optional TokenStore so logins are reused across processes
 
     def __str__(self):
         return "StubHub API"
 
-    def authenticate(self, is_v3):
-        """Returns StubHub access token. Should be called before StubHub API calls. Can be called multiple times."""
+    def authenticate(self, is_v3, stale_access_token=None):
+        """Returns StubHub access token. Should be called before StubHub API calls. Can be called multiple times (and from
+        multiple threads). Tokens are reused from the token store and refreshed before they expire, or if the caller
+        had 'stale_access_token' rejected."""
+        with self._auth_lock:
+            _api_version = 'v3' if is_v3 else 'v2'
+            _token = self.v3_auth_token if is_v3 else self.v2_auth_token
+            if _token is None and self.token_store is not None:
+                _token = self.token_store.load(_api_version)
+            if _token is not None and not _token.expires_soon() and _token.access_token != stale_access_token:
+                self._set_auth_token(is_v3, _token)
+                return _token.access_token
+            _refreshed = None
+            if _token is not None and _token.refresh_token is not None:
+                try:
+                    _refreshed = self._refresh(is_v3, _token)
+                except RuntimeError as err:
+                    print(' Could not refresh StubHub {} token, logging in again. Error: {}'.format(_api_version, err))
+            _token = _refreshed if _refreshed is not None else self._login(is_v3)
+            self._set_auth_token(is_v3, _token)
+            if self.token_store is not None:
+                self.token_store.save(_api_version, _token)
+            return _token.access_token
+
+    def _set_auth_token(self, is_v3, token):
         if is_v3:
-            if self.v3_auth_token is None:
-                consumer_token = base64.b64encode((self.v3_consumer_key + ':' + self.v3_consumer_secret).encode('utf-8'))
-                url = 'https://api.stubhub.com/sellers/oauth/accesstoken'
-                headers = {
-                    'Authorization': 'Basic ' + consumer_token.decode('utf-8'),
-                    'Content-Type': 'application/json'
-                }
-                params = {'grant_type': 'client_credentials'}
-                payload = {
-                    'username': self.user,
-                    'password': self.password
-                }
-                auth_response = requests.post(url, headers=headers, params=params, json=payload)
-                self.v3_auth_token = AuthToken(auth_response)
-                self.v3_consumer_key = None
-                self.v3_consumer_secret = None
-            return self.v3_auth_token.access_token
+            self.v3_auth_token = token
         else:
-            if self.v2_auth_token is None:
-                consumer_token = base64.b64encode((self.v2_consumer_key + ':' + self.v2_consumer_secret).encode('utf-8'))
-                url = 'https://api.stubhub.com/login'
-                headers = {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                    'Authorization': 'Basic ' + consumer_token.decode('utf-8')}
-                body = {
-                    'grant_type': 'password',
-                    'username': self.user,
-                    'password': self.password,
-                    'scope': self.v2_scope}
-                auth_response = requests.post(url, headers=headers, data=body)
-                self.v2_auth_token = AuthToken(auth_response)
-                self.v2_consumer_key = None
-                self.v2_consumer_secret = None
-                self.v2_scope = None
-            return self.v2_auth_token.access_token
+            self.v2_auth_token = token
+
+    def _login(self, is_v3):
+        if is_v3:
+            url = 'https://api.stubhub.com/sellers/oauth/accesstoken'
+            headers = {
+                'Authorization': 'Basic ' + self._consumer_token(is_v3),
+                'Content-Type': 'application/json'
+            }
+            params = {'grant_type': 'client_credentials'}
+            payload = {
+                'username': self.user,
+                'password': self.password
+            }
+            return AuthToken(self.session.post(url, headers=headers, params=params, json=payload))
+        else:
+            url = 'https://api.stubhub.com/login'
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Authorization': 'Basic ' + self._consumer_token(is_v3)}
+            body = {
+                'grant_type': 'password',
+                'username': self.user,
+                'password': self.password,
+                'scope': self.v2_scope}
+            return AuthToken(self.session.post(url, headers=headers, data=body))
+
+    def _refresh(self, is_v3, token):
+        if is_v3:
+            url = 'https://api.stubhub.com/sellers/oauth/accesstoken'
+            headers = {
+                'Authorization': 'Basic ' + self._consumer_token(is_v3),
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+            params = {'grant_type': 'refresh_token'}
+            body = {'refresh_token': token.refresh_token}
+            _refreshed = AuthToken(self.session.post(url, headers=headers, params=params, data=body))
+        else:
+            url = 'https://api.stubhub.com/login'
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Authorization': 'Basic ' + self._consumer_token(is_v3)}
+            body = {
+                'grant_type': 'refresh_token',
+                'refresh_token': token.refresh_token,
+                'scope': self.v2_scope}
+            _refreshed = AuthToken(self.session.post(url, headers=headers, data=body))
+        if _refreshed.refresh_token is None:
+            _refreshed.refresh_token = token.refresh_token
+        return _refreshed
+
+    def _consumer_token(self, is_v3):
+        if is_v3:
+            _consumer = self.v3_consumer_key + ':' + self.v3_consumer_secret
+        else:
+            _consumer = self.v2_consumer_key + ':' + self.v2_consumer_secret
+        return base64.b64encode(_consumer.encode('utf-8')).decode('utf-8')
 
     def get_event_info(self, event_id):
         """Retrieves basic info about an event as a dynamodb.Event or None if not found."""
-        #TODO not sure which ID to use for NZ events
-        url = 'https://api.stubhub.com/sellers/search/events/v3'
-        headers = {
-            'Authorization': 'Bearer ' + self.authenticate(True),
-            'Accept': 'application/json',
-            'Accept-Encoding': 'application/json'
-        }
-        params = {'id': str(event_id)}
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != 200:
-            raise RuntimeError('Could not get Event {} from StubHub. Status: {}. Text: {}'.format(event_id, response.status_code, response.text))
-        jsonResponse = json.loads(response.text)
+        jsonResponse = self.cache.get_or_load('event:{}'.format(event_id), EVENT_INFO_TTL, lambda: self._search_event(event_id))
         if 'numFound' in jsonResponse:
             if jsonResponse['numFound'] != 1:
                 raise RuntimeError('Search for Event {} returned more than one result. Results: {}'.format(event_id, jsonResponse))
+            from stubhubz.dynamodb import Event
             eventJson = jsonResponse['events'][0]
             event = Event(eventJson['id'])
             event.name = eventJson['description']
@@ -100,6 +191,46 @@ class StubHubApi(TicketSource):
             return event
         return None
 
+    def _search_event(self, event_id):
+        """Searches StubHub for a single event by ID returning the parsed JSON response"""
+        #TODO not sure which ID to use for NZ events
+        url = 'https://api.stubhub.com/sellers/search/events/v3'
+        headers = {
+            'Authorization': 'Bearer ' + self.authenticate(True),
+            'Accept': 'application/json',
+            'Accept-Encoding': 'application/json'
+        }
+        params = {'id': str(event_id)}
+        response = self._get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            raise RuntimeError('Could not get Event {} from StubHub. Status: {}. Text: {}'.format(event_id, response.status_code, response.text))
+        return json.loads(response.text)
+
+    def get_ticket_info(self, event_ids):
+        """Returns the summary of the tickets listed for each of the events (a dictionary of event ID -> dictionary of
+        TICKET_INFO_KEYS) using one search per TICKET_INFO_BATCH_SIZE events. Events StubHub didn't return are left out."""
+        url = 'https://api.stubhub.com/sellers/search/events/v3'
+        _event_ids = list(event_ids)
+        _result = {}
+        for _start in range(0, len(_event_ids), TICKET_INFO_BATCH_SIZE):
+            _batch = _event_ids[_start:_start + TICKET_INFO_BATCH_SIZE]
+            headers = {
+                'Authorization': 'Bearer ' + self.authenticate(True),
+                'Accept': 'application/json',
+                'Accept-Encoding': 'application/json'
+            }
+            params = {
+                'id': '|'.join(str(_event_id) for _event_id in _batch),
+                'rows': len(_batch)
+            }
+            response = self._get(url, headers=headers, params=params)
+            if response.status_code != 200:
+                raise RuntimeError('Could not get ticket info of Events {} from StubHub. Status: {}. Text: {}'.format(_batch, response.status_code, response.text))
+            for _event in json.loads(response.text).get('events', []):
+                if 'ticketInfo' in _event:
+                    _result[_event['id']] = {_key: _event['ticketInfo'].get(_key) for _key in TICKET_INFO_KEYS}
+        return _result
+
     def search_events(self, name, city, country):
         """Search for events returning (as text) given the search criteria."""
         #TODO doesn't return hits for NZ
@@ -116,7 +247,7 @@ class StubHubApi(TicketSource):
             'parking': 'false',
             'rows': 50
         }
-        search_results = json.loads(requests.get(url, headers=headers, params=params).text)
+        search_results = json.loads(self._get(url, headers=headers, params=params).text)
 
         result = "Number of events found: " + (str(search_results['numFound']) if 'numFound' in search_results else "0") + "\n"
         for event in search_results['events']:
@@ -125,22 +256,29 @@ class StubHubApi(TicketSource):
             )
         return result
 
-    # Retrieves the available zones for an event. Array of zone dictionary objects ('id', 'name', section dictionary objects)
-    def get_section_zones(self, event_id):
+    # Retrieves the available zones for an event. Array of zone dictionary objects ('id', 'name', section dictionary objects).
+    # Zones are cached unless 'refresh' is True
+    def get_section_zones(self, event_id, refresh=False):
+        return self.cache.get_or_load('zones:{}'.format(event_id), SECTION_ZONES_TTL, lambda: self._get_section_zones(event_id), refresh)
+
+    def _get_section_zones(self, event_id):
         url = 'https://api.stubhub.com/partners/catalog/events/v3/{}/sectionZones'.format(event_id)
         headers = {
             'Authorization': 'Bearer ' + self.authenticate(True),
             'Accept': 'application/json',
             'Accept-Encoding': 'application/json'
         }
-        response = requests.get(url, headers=headers)
+        response = self._get(url, headers=headers)
         if response.status_code != 200:
             raise RuntimeError('Could not get Section Zones for Event {} from StubHub. Status: {}. Text: {}'.format(event_id, response.status_code, response.text))
         jsonResponse = json.loads(response.text)
         return jsonResponse['zones']
 
-    # Find listings for an event by zone ID
-    def find_listings(self, event_id, zone_id_list, quantity):
+    # Finds a page of listings for an event by zone ID (or for every zone if 'zone_id_list' is None). 'start' is the offset
+    # of the first listing and 'rows' the page size. With 'fields_only' the response is parsed as it streams in and only
+    # the fields StubHubz aggregates are kept (see parse_listing_fields()) instead of the whole response. 'on_raw_page' is
+    # called with 'zone_id_list', 'start', and the response's bytes, e.g. to archive them (see stubhubz.archive)
+    def find_listings(self, event_id, zone_id_list, quantity, start=0, rows=LISTINGS_PAGE_SIZE, fields_only=False, on_raw_page=None):
         url = 'https://api.stubhub.com/sellers/find/listings/v3/'
         headers = {
             'Authorization': 'Bearer ' + self.authenticate(True),
@@ -150,10 +288,85 @@ class StubHubApi(TicketSource):
         params = {
             'eventid': event_id,
             'sort': 'currentprice asc',
-            'zoneIdList': str(zone_id_list),
-            'quantity': str(quantity)
+            'quantity': str(quantity),
+            'start': str(start),
+            'rows': str(rows)
         }
-        response = requests.get(url, headers=headers, params=params)
+        if zone_id_list is not None:
+            params['zoneIdList'] = str(zone_id_list)
+        response = self._get(url, headers=headers, params=params, stream=fields_only)
         if response.status_code != 200:
             raise RuntimeError('Could not get Listings for Event {} from StubHub. Status: {}. Text: {}'.format(event_id, response.status_code, response.text))
-        return json.loads(response.text)
\ No newline at end of file
+        if fields_only:
+            _raw = [] if on_raw_page is not None else None
+            with response:
+                _page = parse_listing_fields(_count_bytes(response.iter_content(STREAM_CHUNK_SIZE), _raw))
+            if on_raw_page is not None:
+                on_raw_page(zone_id_list, start, b''.join(_raw))
+            return _page
+        if on_raw_page is not None:
+            on_raw_page(zone_id_list, start, response.content)
+        return json.loads(response.text)
+
+    def iter_listings_pages(self, event_id, zone_id_list, quantity, pool=None, fields_only=False, on_raw_page=None):
+        """Yields every page of listings for an event by zone ID (or every zone if 'zone_id_list' is None). The first page
+        tells us how many listings there are, the remaining pages are then fetched concurrently on 'pool' (a
+        stubhubz.concurrency.WorkerPool) if one is given. See find_listings() for 'fields_only' and 'on_raw_page'."""
+        _first_page = self.find_listings(event_id, zone_id_list, quantity, fields_only=fields_only, on_raw_page=on_raw_page)
+        yield _first_page
+        _starts = range(LISTINGS_PAGE_SIZE, _first_page.get('totalListings', 0), LISTINGS_PAGE_SIZE)
+        _fetch_page = lambda start: self.find_listings(event_id, zone_id_list, quantity, start, fields_only=fields_only, on_raw_page=on_raw_page)
+        for _page in (pool.imap(_fetch_page, _starts) if pool is not None else map(_fetch_page, _starts)):
+            yield _page
+
+    def _get(self, url, headers=None, params=None, stream=False):
+        """HTTP GET against the StubHub (V3) API which waits for the rate limiter (if any) first. If StubHub rejects the
+        access token the token is refreshed and the request retried once. The requests, retries, time spent, and bytes
+        received (of a streamed response as it's read) are recorded in stubhubz.metrics."""
+        response = self._request(url, headers, params, stream)
+        if response.status_code == 401 and headers is not None and 'Authorization' in headers:
+            response.close() # a streamed response holds its connection until it's read or closed
+            metrics.increment('stubhub_retries')
+            _stale_access_token = headers['Authorization'][len('Bearer '):]
+            headers = dict(headers, Authorization='Bearer ' + self.authenticate(True, _stale_access_token))
+            response = self._request(url, headers, params, stream)
+        return response
+
+    def _request(self, url, headers, params, stream):
+        if self.rate_limiter is not None:
+            with metrics.phase('rate_limit_wait'):
+                self.rate_limiter.acquire()
+        with metrics.phase('stubhub_request'):
+            response = self.session.get(url, headers=headers, params=params, stream=stream)
+            metrics.increment('stubhub_requests')
+            if not stream:
+                metrics.increment('stubhub_bytes', len(response.content))
+        return response
+
+def _count_bytes(chunks, raw=None):
+    """Passes on the chunks of a streamed response recording their size in stubhubz.metrics (and keeping them in the
+    list 'raw' if given)"""
+    for _chunk in chunks:
+        metrics.increment('stubhub_bytes', len(_chunk))
+        if raw is not None:
+            raw.append(_chunk)
+        yield _chunk
+
+def parse_listing_fields(chunks):
+    """Parses a find listings response from an iterable of chunks (see stubhubz.jsonstream.JsonStreamReader) keeping only
+    what's aggregated. Returns the response without 'listings' but with each listing's 'listing_prices',
+    'listing_quantities', and 'listing_zone_ids' (parallel lists) and 'zone_names' (zone ID -> name). Each listing is
+    dropped as soon as its fields are read so memory use doesn't depend on the size of the response."""
+    _reader = JsonStreamReader(chunks)
+    _page = {'listing_prices': [], 'listing_quantities': [], 'listing_zone_ids': [], 'zone_names': {}}
+    for _key in _reader.iter_object():
+        if _key != 'listings':
+            _page[_key] = _reader.value()
+            continue
+        for _listing in _reader.iter_array():
+            _page['listing_prices'].append(_listing['pricePerProduct']['amount'])
+            _page['listing_quantities'].append(_listing['quantity'])
+            _page['listing_zone_ids'].append(_listing.get('zoneId'))
+            if _listing.get('zoneId') not in _page['zone_names']:
+                _page['zone_names'][_listing.get('zoneId')] = _listing.get('zoneName')
+    return _page
@@ -1,18 +1,41 @@
-import botocore.session
 import datetime
-import gzip
 import json
+import threading
+import time
 
-import stubhubz.dynamodb
+from stubhubz import metrics
+from stubhubz.aws import get_client
+from stubhubz.concurrency import TokenBucket, WorkerPool
+from stubhubz.delta import PriceHistoryWriter, read_price_history
+from stubhubz.dispatch import reset_connections, split_shards
+from stubhubz.rollup import HOURLY_RETENTION_DAYS, RAW_RETENTION_DAYS, PriceHistoryCompactor
+from stubhubz.schedule import VOLATILITY_WINDOW_HOURS, ScrapeScheduler
+
+EVENT_EXPIRY_MINUTES = 120 # events are no longer scraped this long after they were scheduled to start
+UNCHANGED_SCRAPE_HOURS = 24 # events are scraped at least this often even if their ticket info hasn't changed
 
 # The business logic of StubHubz
 class StubHubz:
-    def __init__(self, stubhub, ticketmaster, dynamo, region, debug):
+    def __init__(self, stubhub, ticketmaster, storage, region, debug, workers=1, scrape_mode='zone', change_detection=True,
+            scheduler=None, metrics_recorder=None, archive=None, events_index=None):
         self.stubhub = stubhub
         self.ticketmaster = ticketmaster
-        self.dynamo = dynamo
+        self.storage = storage # a stubhubz.storage.Storage
         self.region = region
         self.debug = debug
+        self.workers = workers # how many events (and zones and listing pages within each event) are scraped concurrently
+        self._zone_pool = WorkerPool(1)
+        self._page_pool = WorkerPool(1)
+        self.scrape_mode = scrape_mode # 'zone' requests listings zone by zone, 'event' requests all of an event's listings at once
+        self.change_detection = change_detection # whether to skip events whose ticket info hasn't changed since they were last scraped
+        self.scheduler = scheduler # a ScrapeScheduler to only scrape events when they're due, or None to scrape every event every time
+        self._price_history_writer = PriceHistoryWriter(storage) # only writes the zones that changed since the last scrape
+        # Per event phase timings and request, byte, and retry counts of scrapes and exports (see stubhubz.metrics)
+        self.metrics = metrics_recorder if metrics_recorder is not None else metrics.Metrics()
+        self.archive = archive # a stubhubz.archive.ListingsArchive to keep each scrape's raw listings in, or None
+        self.events_index = events_index # (S3 bucket, key prefix) of the events index to update when events change, or None
+        self._changed_events = {} # the Events written since the events index was last updated, by ID
+        self._changed_events_lock = threading.Lock()
 
     def get_ticketsource_event(self, event_id, ticket_source):
         """Return info about an event from a TicketSource"""
@@ -23,30 +46,71 @@ class StubHubz:
         return ticket_source.search_events(name, city, country)
 
     def get_stubhub_listing(self, event_id):
-        """Get listings from StubHub for an event"""
-        _zones = self.stubhub.get_section_zones(event_id)
-        _listings_by_zone = {}
-        for _zone in _zones:
-            _listings = self.stubhub.find_listings(event_id, _zone['id'], 1)
+        """Yields every listing (from every page) from StubHub for an event, a zone at a time (sorted by zone name) so only
+        one zone's listings are held at once"""
+        for _zone in sorted(self.stubhub.get_section_zones(event_id), key=lambda zone: zone['name']):
+            _listings = self._find_all_listings(event_id, _zone['id'])
             _listings['zone_name'] = _zone['name']
             _listings['zone_id'] = _zone['id']
-            _listings_by_zone[_zone['name']] = _listings
-        return _listings_by_zone
+            yield _listings
+
+    def get_stubhub_zone_prices(self, event_id, archive_batch=None):
+        """Get a price summary (a ZonePriceAccumulator) of every zone for an event from StubHub. Every page of listings is
+        read but each page is folded into its zone's summary and discarded as soon as it arrives (after adding it to
+        'archive_batch', a stubhubz.archive.ArchiveBatch, if given)."""
+        _on_raw_page = archive_batch.add_page if archive_batch is not None else None
+        if self.scrape_mode == 'event':
+            return self._accumulate_event(event_id, _on_raw_page)
+        _zones = self.stubhub.get_section_zones(event_id)
+        return self._zone_pool.map(lambda zone: self._accumulate_zone(event_id, zone, _on_raw_page), _zones)
+
+    def _find_all_listings(self, event_id, zone_id):
+        _listings = None
+        for _page in self.stubhub.iter_listings_pages(event_id, zone_id, 1, self._page_pool):
+            if _listings is None:
+                _listings = _page
+            else:
+                _listings['listings'].extend(_page.get('listings', []))
+        return _listings
+
+    def _accumulate_event(self, event_id, on_raw_page=None):
+        from stubhubz.aggregate import EventPriceAccumulator # imports NumPy which only scraping and exporting need
+        _accumulator = EventPriceAccumulator(lambda zone_id: self._get_zone_name(event_id, zone_id))
+        for _page in self.stubhub.iter_listings_pages(event_id, None, 1, self._page_pool, fields_only=True, on_raw_page=on_raw_page):
+            _accumulator.add_page(_page)
+        return _accumulator.zone_prices()
+
+    def _get_zone_name(self, event_id, zone_id):
+        """Name of an event's zone whose listings didn't name it. The event's section zones are (re)fetched from StubHub
+        only for a zone we don't know"""
+        _zone_names = {_zone['id']: _zone['name'] for _zone in self.stubhub.get_section_zones(event_id)}
+        if zone_id not in _zone_names:
+            _zone_names = {_zone['id']: _zone['name'] for _zone in self.stubhub.get_section_zones(event_id, refresh=True)}
+        return _zone_names.get(zone_id)
+
+    def _accumulate_zone(self, event_id, zone, on_raw_page=None):
+        from stubhubz.aggregate import ZonePriceAccumulator
+        _accumulator = ZonePriceAccumulator(zone['id'], zone['name'])
+        for _page in self.stubhub.iter_listings_pages(event_id, zone['id'], 1, self._page_pool, fields_only=True, on_raw_page=on_raw_page):
+            _accumulator.add_page(_page)
+        return _accumulator
 
     def track_event(self, event_id):
         """Add a StubHub event for tracking in StubHubz"""
-        if self.dynamo.has_event(event_id):
+        if self.storage.has_event(event_id):
             pass
         else:
-            self.dynamo.add_event(event_id)
+            self.storage.add_event(event_id)
+            self._event_changed(self.storage.get_event(event_id))
+            self.publish_events_index()
 
     def get_event(self, event_id):
         """Retrieves an event from AWS DynamoDB"""
-        return self.dynamo.get_event(event_id)
+        return self.storage.get_event(event_id)
 
     def update_event(self, event_id):
         """Updates a AWS DynamoDB Event with info from StubHub"""
-        dynamo_event = self.dynamo.get_event(event_id)
+        dynamo_event = self.storage.get_event(event_id)
         if dynamo_event is None:
             raise RuntimeError('Cannot update event {} as it does not exist. You need to add it first using the "add-event" action.'.format(event_id))
         ticketsource_event = self.get_ticketsource_event(event_id, self.stubhub)
@@ -57,13 +121,15 @@ class StubHubz:
             else:
                 ticketsource_event.scrape_status = 'Inactive'
             ticketsource_event.last_scraped_date_time = datetime.datetime.utcnow()
-            ticketsource_event.save()
+            self.storage.save_event(ticketsource_event)
+            self._event_changed(ticketsource_event)
+            self.publish_events_index()
         else:
             raise RuntimeError('OK something weird went on, we requested event {} but StubHub API returned something else. Response was: {}'.format(event_id, ticketsource_event))
 
     def update_event_manual(self, event_id, primary_performer, name, venue_city, venue_name, date_time, event_status, scrape_status):
         """Updates a AWS DynamoDB Event with info manually entered by the user"""
-        dynamo_event = self.dynamo.get_event(event_id)
+        dynamo_event = self.storage.get_event(event_id)
         if dynamo_event is None:
             raise RuntimeError('Cannot update event {} as it does not exist. You need to add it first using the "add-event" action.'.format(event_id))
         dynamo_event.primary_performer = primary_performer
@@ -73,139 +139,402 @@ class StubHubz:
         dynamo_event.date_time = date_time
         dynamo_event.event_status = event_status
         dynamo_event.scrape_status = scrape_status
-        dynamo_event.save()
-
-    def scrape(self, event_id=None):
-        _scraped_events = []
-        if event_id is None:
-            events = self.dynamo.get_events()
-            for event in events:
-                if self._scrape(event):
-                    _scraped_events.append(event.id)
-        else:
-            event = self.dynamo.get_event(event_id)
-            if event is None:
-                print(' No such event {} in DynamoDB. Maybe add it to DynamoDB first?'.format(event_id))
+        self.storage.save_event(dynamo_event)
+        self._event_changed(dynamo_event)
+        self.publish_events_index()
+
+    # Scrapes all active events (or just 'event_id') returning the IDs of the events that were scraped. Up to 'workers' events
+    # are scraped at the same time, each fetching up to 'workers' zones at the same time. A failure to scrape one event
+    # is reported and doesn't stop the other events from being scraped. When scraping all events, events whose ticket info
+    # hasn't changed since they were last scraped are only marked as checked (see _check_unchanged). With a scheduler only
+    # the events that are due are scraped, in priority order, until the run's request budget (or 'request_budget') or
+    # 'time_limit' (seconds) is used up. 'event_ids' scrapes a shard of events already chosen by scrape_sharded()
+    def scrape(self, event_id=None, time_limit=None, event_ids=None, request_budget=None):
+        with metrics.activate(self.metrics):
+            if event_ids is not None:
+                _events = [_event for _event in (self.storage.get_event(_event_id) for _event_id in event_ids) if _event is not None]
+            elif event_id is None:
+                with metrics.phase('select_events'):
+                    _events = self.get_due_events()
             else:
-                if self._scrape(event):
-                    _scraped_events.append(event.id)
+                _event = self.storage.get_event(event_id)
+                if _event is None:
+                    print(' No such event {} in {}. Maybe add it first?'.format(event_id, self.storage))
+                    return []
+                _events = [_event]
+            _scraped_events = []
+            _failed_events = []
+            _unchanged_events = []
+            _deferred_events = []
+            _ticket_info = {}
+            if self.scheduler is not None:
+                self.scheduler.begin(lambda: self.stubhub.session.stats.requests, time_limit, request_budget)
+            with self.storage.write_batch(), WorkerPool(self.workers) as _event_pool, WorkerPool(self.workers) as self._zone_pool, \
+                    WorkerPool(self.workers) as self._page_pool:
+                if event_id is None and self.change_detection:
+                    with metrics.phase('ticket_info'):
+                        _ticket_info, _unchanged_events = self._check_unchanged(_events)
+                _changed_events = [_event for _event in _events if _event.id not in _unchanged_events]
+                for _event, _scraped, _error in _event_pool.map_outcomes(lambda event: self._scrape_scheduled(event, _ticket_info.get(event.id)), _changed_events):
+                    if _error is not None:
+                        print(' Failed to scrape event {}. Error: {}'.format(_event.id, _error))
+                        _failed_events.append(_event.id)
+                    elif _scraped is None:
+                        _deferred_events.append(_event.id)
+                    elif _scraped:
+                        _scraped_events.append(_event.id)
+            print('Scraped {} of {} events. Unchanged: {}. Out of budget: {}. Failed: {}'.format(len(_scraped_events), len(_events), len(_unchanged_events),
+                    _deferred_events, _failed_events))
+            print(' StubHub HTTP: {}'.format(self.stubhub.session.stats))
+            print(' StubHub cache: {}'.format(self.stubhub.cache.stats))
+        self.publish_events_index()
         return _scraped_events
 
+    # Returns the events to scrape: the Active events that haven't expired and, with a scheduler, are due (in priority order)
+    def get_due_events(self):
+        _events = self._get_events_to_scrape()
+        if self.scheduler is not None:
+            _active_events = len(_events)
+            _events = self.scheduler.due(_events, datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc))
+            print('{} of {} active events are due to be scraped'.format(len(_events), _active_events))
+        return _events
+
+    # Splits the events to scrape into (at most) 'shards' shards and sends each to a worker with 'dispatcher' as a
+    # 'scrape_shard' message (see scrape_shard()). The run's request budget and the StubHub API's rate limit are split
+    # between the shards as the shards call StubHub at the same time. Returns the IDs
+    # of the events the workers scraped or None if the workers run asynchronously (in which case each worker triggers
+    # the export of the events it scraped, so each event is still exported once)
+    def scrape_sharded(self, dispatcher, shards):
+        _event_ids = [_event.id for _event in self.get_due_events()]
+        _shards = split_shards(_event_ids, shards)
+        self.publish_events_index()
+        if len(_shards) == 0:
+            print('No events are due to be scraped')
+            return []
+        _request_budget = None
+        if self.scheduler is not None and self.scheduler.request_budget is not None:
+            _request_budget = max(1, self.scheduler.request_budget // max(1, len(_shards)))
+        _rate_limit = None
+        if self.stubhub.rate_limiter is not None:
+            _rate_limit = self.stubhub.rate_limiter.rate / len(_shards)
+        _messages = [{'action': 'scrape_shard', 'event_ids': _shard, 'shard': _index, 'shards': len(_shards), 'request_budget': _request_budget,
+                'rate_limit': _rate_limit} for _index, _shard in enumerate(_shards)]
+        print('Dispatching {} events in {} shards with {}'.format(len(_event_ids), len(_shards), dispatcher))
+        _results = dispatcher.dispatch(_messages)
+        if _results is None:
+            return None
+        _scraped_events = [_event_id for _result in _results for _event_id in _result]
+        print('Workers scraped {} of {} events'.format(len(_scraped_events), len(_event_ids)))
+        return _scraped_events
+
+    # Handles a 'scrape_shard' message (see scrape_sharded()) returning the IDs of the events that were scraped. The shard
+    # calls StubHub at its share of the rate limit, if there is one
+    def scrape_shard(self, message, time_limit=None):
+        print('Scraping shard {} of {} ({} events)'.format(message['shard'] + 1, message['shards'], len(message['event_ids'])))
+        _rate_limiter = self.stubhub.rate_limiter
+        if message.get('rate_limit'):
+            self.stubhub.rate_limiter = TokenBucket(message['rate_limit'])
+        try:
+            return self.scrape(time_limit=time_limit, event_ids=message['event_ids'], request_budget=message.get('request_budget'))
+        finally:
+            self.stubhub.rate_limiter = _rate_limiter
+
+    # Returns the Active events which haven't expired (i.e. happened more than EVENT_EXPIRY_MINUTES ago) after marking the
+    # Active events that have expired as Inactive
+    def _get_events_to_scrape(self):
+        _cutoff = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - datetime.timedelta(minutes=EVENT_EXPIRY_MINUTES)
+        for _event in self.storage.get_expired_active_events(_cutoff):
+            print('Event \'{}\' ({}) has expired. Event was scheduled for {}'.format(_event.name, _event.id, _event.date_time))
+            self.storage.update_event_scraped(_event, datetime.datetime.utcnow(), 'Inactive')
+            self._event_changed(_event)
+        return list(self.storage.get_active_events(_cutoff))
+
+    # Fetches the ticket info of all the events with a few batched searches and marks the events whose ticket info is the
+    # same as when they were last scraped (and were scraped in the last UNCHANGED_SCRAPE_HOURS) as checked. Returns the
+    # ticket info by event ID and the IDs of the unchanged events. If the ticket info can't be fetched every event is changed
+    def _check_unchanged(self, events):
+        try:
+            _ticket_info = self.stubhub.get_ticket_info(_event.id for _event in events)
+        except Exception as err:
+            print(' Could not get ticket info so scraping every event. Error: {}'.format(err))
+            return {}, []
+        _now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        _unchanged_events = []
+        for _event in events:
+            _info = _ticket_info.get(_event.id)
+            if _info is None or _event.ticket_info is None or _event.last_scraped_date_time is None:
+                continue
+            if _event.ticket_info.as_dict() == _info and not self._date_check(_event.last_scraped_date_time, UNCHANGED_SCRAPE_HOURS * 60):
+                if self.debug:
+                    print(' Event {} is unchanged since {}. Ticket info: {}'.format(_event.id, _event.last_scraped_date_time, _info))
+                self.storage.update_event_checked(_event, _now, self.scheduler.next_scrape(_event, _now) if self.scheduler is not None else None)
+                _unchanged_events.append(_event.id)
+        return _ticket_info, _unchanged_events
+
+    # Scrapes an event if the scheduler's budget allows (returning None if it doesn't) and records how long it took
+    def _scrape_scheduled(self, event, ticket_info=None):
+        if self.scheduler is None:
+            return self._scrape(event, ticket_info)
+        if not self.scheduler.can_start():
+            return None
+        _started = time.monotonic()
+        _scraped = self._scrape(event, ticket_info)
+        self.scheduler.finished(time.monotonic() - _started)
+        return _scraped
+
     # Scrapes an Event (i.e. query StubHub for price info and store in DynamoDB) and updates the
     # Event's last scrape time. Returns True if the event was scraped or False (e.g. Event has
-    # expired, is no longer active)
-    def _scrape(self, event):
+    # expired, is no longer active). 'ticket_info' is the event's current ticket info (if known) to remember for next time
+    def _scrape(self, event, ticket_info=None):
+        with metrics.event(event.id), metrics.phase('scrape'):
+            return self._scrape_event(event, ticket_info)
+
+    def _scrape_event(self, event, ticket_info):
         print('Scarping event \'{}\' ({})...'.format(event.name, event.id))
         if event.scrape_status != 'Active':
             print(' Skipping event because it is no longer active')
             return False
-        if self._date_check(event.date_time, 120):
+        if self._date_check(event.date_time, EVENT_EXPIRY_MINUTES):
             print(' Skipping event because it has expired. Event was scheduled for {}'.format(event.date_time))
-            event.update(actions=[
-                stubhubz.dynamodb.Event.last_scraped_date_time.set(datetime.datetime.utcnow()),
-                stubhubz.dynamodb.Event.scrape_status.set('Inactive')
-            ])
+            self.storage.update_event_scraped(event, datetime.datetime.utcnow(), 'Inactive')
+            self._event_changed(event)
             return False
-        zone_prices = [] # array of avg_price, max_ticket_quantity, min_price, total_listings, total_tickets, zone_id, zone_name
-        listings_by_zone = self.get_stubhub_listing(event.id)
+        _archive_batch = self.archive.new_batch(event.id, self.scrape_mode) if self.archive is not None else None
+        with metrics.phase('listings'):
+            _zones = self.get_stubhub_zone_prices(event.id, _archive_batch)
         if self.debug:
-            print(' Retrieved listings for event {} from StubHub. Listings: {}'.format(event.id, listings_by_zone))
-        for zone_name, zone_listings in listings_by_zone.items():
-            min_price = 9999999
-            max_quantity = 0
-            tickets_seen = 0
-            total_price = 0
-            for listing in zone_listings['listings']:
-                quantity = listing['quantity']
-                if quantity > max_quantity:
-                    max_quantity = quantity
-                tickets_seen += quantity
-                price = listing['pricePerProduct']['amount']
-                if price < min_price:
-                    min_price = price
-                total_price += price * quantity
-            avg_price_accurate = True if tickets_seen == zone_listings['totalTickets'] else False
-            zone_prices.append(self._build_zone_price(zone_listings['zone_id'], zone_name, min_price, total_price/tickets_seen, None,
-                    zone_listings['totalTickets'], zone_listings['totalListings'], avg_price_accurate))
-        self.dynamo.add_price_history(event.id, datetime.datetime.utcnow(), zone_prices)
-        event.update(actions=[
-            stubhubz.dynamodb.Event.last_scraped_date_time.set(datetime.datetime.utcnow())
-        ])
+            for zone in _zones:
+                print(' Retrieved listings for event {} from StubHub. Zone: {}'.format(event.id, zone))
+        with metrics.phase('aggregate'):
+            zone_prices = self.build_zone_prices(_zones)
+        with metrics.phase('schedule'):
+            _next_scrape, _volatility = self._schedule(event, zone_prices)
+        _scraped_date_time = datetime.datetime.utcnow()
+        with metrics.phase('write'):
+            _written = self._price_history_writer.write(event.id, _scraped_date_time, zone_prices)
+            self.storage.update_event_scraped(event, datetime.datetime.utcnow(), ticket_info=ticket_info, next_scrape_date_time=_next_scrape,
+                    volatility=_volatility, min_price=min(_zone_price['min_price'] for _zone_price in zone_prices) if len(zone_prices) > 0 else None)
+            self._event_changed(event)
+        if _archive_batch is not None:
+            try:
+                _archive_batch.close(_scraped_date_time, _zones)
+            except Exception as err:
+                print(' Could not archive the listings of event {} in {}. Error: {}'.format(event.id, self.archive, err))
+        metrics.increment('zones', len(zone_prices))
+        metrics.increment('zones_written', _written)
+        if self.debug:
+            print(' Wrote {} of {} zones'.format(_written, len(zone_prices)))
         print(' Scraped event')
         return True
 
+    # Returns when the event is next due to be scraped and its price volatility over the last VOLATILITY_WINDOW_HOURS
+    # (including the 'zone_prices' just scraped), or Nones without a scheduler
+    def _schedule(self, event, zone_prices):
+        if self.scheduler is None:
+            return None, None
+        _now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        _history = [_price_history.zone_prices for _price_history in
+                read_price_history(self.storage, event.id, _now - datetime.timedelta(hours=VOLATILITY_WINDOW_HOURS))]
+        _volatility = ScrapeScheduler.volatility(_history + [zone_prices])
+        if _volatility is not None:
+            event.volatility = _volatility
+        _next_scrape = self.scheduler.next_scrape(event, _now)
+        if self.debug:
+            print(' Event {} has volatility {} and is next due at {}'.format(event.id, event.volatility, _next_scrape))
+        return _next_scrape, _volatility
+
     def get_events(self):
-        return self.dynamo.get_events()
+        return self.storage.get_events()
+
+    # Folds old price history of every event (or just 'event_ids') into hourly and daily rollups (see
+    # stubhubz.rollup.PriceHistoryCompactor), 'workers' events at a time. Returns the IDs of the events that were compacted
+    def compact_price_history(self, event_ids=None, raw_retention_days=RAW_RETENTION_DAYS, hourly_retention_days=HOURLY_RETENTION_DAYS):
+        _compactor = PriceHistoryCompactor(self.storage, raw_retention_days, hourly_retention_days)
+        _event_ids = event_ids if event_ids is not None else [_event.id for _event in self.storage.get_events()]
+        print('Compacting price history of {} events with {}...'.format(len(_event_ids), _compactor))
+        _compacted_events = []
+        _failed_events = []
+        with WorkerPool(self.workers) as _event_pool:
+            for _event_id, _result, _error in _event_pool.map_outcomes(_compactor.compact, _event_ids):
+                if _error is not None:
+                    print(' Failed to compact event {}. Error: {}'.format(_event_id, _error))
+                    _failed_events.append(_event_id)
+                    continue
+                _read, _written, _deleted = _result
+                if _written > 0 or _deleted > 0:
+                    print(' Event {}: read {} old items, wrote {} rollups, deleted {} items'.format(_event_id, _read, _written, _deleted))
+                    _compacted_events.append(_event_id)
+        print('Compacted {} of {} events. Failed: {}'.format(len(_compacted_events), len(_event_ids), _failed_events))
+        return _compacted_events
+
+    # Recomputes the price history of events (every archived event or just 'event_ids') from the raw listings in the
+    # archive 'archive_spec' (see stubhubz.archive), e.g. after adding a statistic or fixing an aggregation bug, without
+    # calling StubHub. The scrapes after 'since' and up to 'until' are re-aggregated in a pool of 'processes' forked
+    # processes and each event's PriceHistory is rewritten from its first replayed scrape on (see
+    # PriceHistoryWriter.rewrite()). Each replayed event's ExportState is reset so its next export (see
+    # export_price_history()) publishes the rewritten price history from scratch. Returns the IDs of the events that were replayed
+    def replay(self, archive_spec, event_ids=None, since=None, until=None, processes=None):
+        import multiprocessing
+        from stubhubz.archive import get_archive, replay_batch
+        _archive = get_archive(archive_spec, self.region)
+        _event_ids = event_ids if event_ids is not None else _archive.list_event_ids()
+        _processes = processes or multiprocessing.cpu_count()
+        print('Replaying the archived listings of {} events from {} with {} processes...'.format(len(_event_ids), _archive, _processes))
+        _replayed_events = []
+        _failed_events = []
+        with multiprocessing.get_context('fork').Pool(_processes, initializer=reset_connections) as _pool:
+            for _event_id in _event_ids:
+                try:
+                    _keys = _archive.list_batches(_event_id, since, until)
+                    if len(_keys) == 0:
+                        continue
+                    _replayed = _pool.starmap(replay_batch, [(archive_spec, self.region, _key) for _key in _keys],
+                            chunksize=max(1, len(_keys) // (4 * _processes)))
+                    with self.storage.write_batch():
+                        _written = self._price_history_writer.rewrite(_event_id, [(_date_time, _zone_prices) for _, _date_time, _zone_prices in _replayed])
+                    self.storage.delete_export_state(_event_id) # what was exported is out of date, the next export starts again
+                except Exception as err:
+                    print(' Failed to replay event {}. Error: {}'.format(_event_id, err))
+                    _failed_events.append(_event_id)
+                    continue
+                print(' Event {}: replayed {} scrapes, rewrote {} items'.format(_event_id, len(_keys), _written))
+                _replayed_events.append(_event_id)
+        print('Replayed {} of {} events. Failed: {}'.format(len(_replayed_events), len(_event_ids), _failed_events))
+        return _replayed_events
+
+    # Copies events (all or just 'event_ids') and their price history to another storage
+    def copy_storage(self, to_storage, event_ids=None):
+        _events = self.storage.get_events() if event_ids is None else [self.storage.get_event(_event_id) for _event_id in event_ids]
+        with to_storage.write_batch():
+            for _event in _events:
+                if _event is None:
+                    continue
+                to_storage.save_event(_event)
+                _rows = 0
+                _cursor = None
+                while True:
+                    _price_histories, _cursor = self.storage.get_price_history_page(_event.id, _cursor)
+                    for _price_history in _price_histories:
+                        to_storage.add_price_history(_event.id, _price_history.date_time, _price_history.zone_prices, _price_history.resolution,
+                                _price_history.delta)
+                        _rows += 1
+                    if _cursor is None:
+                        break
+                print(' Copied event {} with {} price history items'.format(_event.id, _rows))
 
     def get_price_history(self, event_id):
-        return self.dynamo.get_price_history(event_id)
-
-    # Retrieves price history for an event of DynamoDB in a specified 'format' (text or json).
-    # Stores the result if s3_bucket and s3_key_prefix are specified and the format is json
-    def get_price_history_formatted(self, event_id, format, s3_bucket, s3_key_prefix):
-        print('Retrieving price history from DynamoDB for event ID {}...', event_id)
-        _price_history = self.dynamo.get_price_history(event_id)
-        print(' Price history retrieved. Formatting...', event_id)
+        return read_price_history(self.storage, event_id)
+
+    # Returns an event's price history from storage as 'text', 'json', or 'columnar'. 'since' and 'until' restrict it to a
+    # time window and 'limit' to (at most) the newest 'limit' items. If the format is json or columnar and s3_bucket and
+    # s3_key_prefix are given, the event's whole price history is (re-)exported to S3 instead (ignoring 'since', 'until',
+    # and 'limit') and a message saying how many items were exported is returned
+    def get_price_history_formatted(self, event_id, format, s3_bucket, s3_key_prefix, since=None, until=None, limit=None):
+        if format != 'text' and s3_bucket is not None and s3_key_prefix is not None:
+            _exported = self.export_price_history(event_id, s3_bucket, s3_key_prefix, False, format)
+            return 'Exported {} price history items for event {} to S3'.format(_exported, event_id)
+        from stubhubz.export import PriceHistorySeries
+        print('Retrieving price history from {} for event ID {}...'.format(self.storage, event_id))
+        _price_histories = read_price_history(self.storage, event_id, since, until, limit is not None, limit)
+        if limit is not None:
+            _price_histories = _price_histories[::-1]
+        if format != 'text':
+            _series = PriceHistorySeries()
+            for _price_history in _price_histories:
+                _series.add(_price_history)
+            return json.dumps(_series.to_chartjs() if format == 'json' else _series.to_object(format))
         _result = ""
-        if format == 'json':
-            _price_histories = [] # array of zone -> date, price
-            _data_by_zone = dict()
-            for _price_history in self.get_price_history(event_id): # array of date -> zones, prices
-                for _zone_price in _price_history.zone_prices:
-                    _zone_name = _zone_price['zone_name']
-                    _data_zone_prices = None
-                    if _zone_name in _data_by_zone:
-                        _data_zone_prices = _data_by_zone[_zone_name]
-                        _data_zone_prices.append(self._build_price_history(_price_history, _zone_price))
-                    else:
-                        _data_by_zone[_zone_name] = [self._build_price_history(_price_history, _zone_price)]
-                        _price_histories.append({'zone': _zone_name, 'data': _data_by_zone[_zone_name]})
-            _price_histories = sorted(_price_histories, key=lambda k: k['zone'])
-            _json_text = json.dumps(_price_histories)
-            if s3_bucket is not None and s3_key_prefix is not None:
-                print(' Saving price history JSON to S3...', event_id)
-                _aws_session = botocore.session.get_session()
-                _aws_client = _aws_session.create_client('s3', self.region)
-                _aws_client.put_object(ACL='private', Body=gzip.compress(_json_text.encode('utf-8')), Bucket=s3_bucket, ContentEncoding='gzip',
-                    ContentType='application/javascript', Key=s3_key_prefix + '/' + str(event_id) + '.js')
-            return _json_text
-        else:
-            for _price_history in self.get_price_history(event_id):
-                _result += str(_price_history) + '\n'
+        for _price_history in _price_histories:
+            _result += str(_price_history) + '\n'
         return _result
 
+    # Exports an event's price history to S3 for the UI returning how many PriceHistory items were exported. If
+    # 'incremental' only the price history since the last export is read (see stubhubz.export.PriceHistoryExporter).
+    # 'format' is 'json' (Chart.js datasets) or the more compact 'columnar'
+    def export_price_history(self, event_id, s3_bucket, s3_key_prefix, incremental=True, format='json'):
+        from stubhubz.export import PriceHistoryExporter
+        print('Exporting price history for event ID {} to S3 ({}, {})...'.format(event_id, 'incremental' if incremental else 'full', format))
+        _exporter = PriceHistoryExporter(self.storage, self._aws_client('s3'), s3_bucket, s3_key_prefix, format)
+        with metrics.activate(self.metrics), metrics.event(event_id), metrics.phase('export'):
+            _exported = _exporter.export(event_id, incremental)
+            metrics.increment('price_history_exported', _exported)
+        print(' Exported {} price history items'.format(_exported))
+        return _exported
+
+    # Updates the events index the UI lists events from (see stubhubz.export.EventsIndexExporter) with the events written
+    # since it was last updated, returning whether it was written. Does nothing without an 'events_index'. 'rebuild'
+    # rewrites it from the Event table instead. If the index can't be updated the events are kept for the next update
+    def publish_events_index(self, rebuild=False):
+        from stubhubz.export import EventsIndexExporter
+        if self.events_index is None:
+            return False
+        with self._changed_events_lock:
+            _events, self._changed_events = self._changed_events, {}
+        if len(_events) == 0 and not rebuild:
+            return False
+        try:
+            _exporter = EventsIndexExporter(self.storage, self._aws_client('s3'), self.events_index[0], self.events_index[1])
+            with metrics.activate(self.metrics), metrics.phase('events_index'):
+                if rebuild:
+                    _exporter.rebuild()
+                    print('Rebuilt the events index in S3')
+                    return True
+                _written = _exporter.update(list(_events.values()))
+        except Exception as err:
+            print('Could not update the events index in S3. Error: {}'.format(err))
+            with self._changed_events_lock:
+                for _event_id, _event in _events.items():
+                    self._changed_events.setdefault(_event_id, _event)
+            return False
+        print('Updated the events index in S3 ({} events changed)'.format(len(_events)) if _written else 'The events index hasn\'t changed')
+        return _written
+
+    # Records that an Event was written so the next publish_events_index() updates its entry in the events index
+    def _event_changed(self, event):
+        if self.events_index is not None and event is not None:
+            with self._changed_events_lock:
+                self._changed_events[event.id] = event
+
+    # Clients are shared (see stubhubz.aws) so they're created once per process, not per call
+    def _aws_client(self, service_name):
+        return get_client(service_name, self.region)
+
     def _date_check(self, event_date, grace_min):
         delta = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - event_date
         return delta.total_seconds() / 60 > grace_min
 
-    """Builds a single price history of an event's zone for storage in S3 JSON file."""
-    def _build_price_history(self, price_history, zone_price):
-        result = {
-            'x': price_history.date_time.isoformat(),
-            'y': round(float(zone_price['min_price']), 2),
-            'avgPrice': round(float(zone_price['avg_price']), 2),
-            'totalTickets': zone_price['total_tickets'],
-            'totalListings': zone_price['total_listings']
-        }
-        if 'avg_price_accurate' in zone_price:
-            result['avgPriceAccurate'] = zone_price['avg_price_accurate']
-        return result
-
     def notify_new_price_history(self, sns_topic, event_ids):
         if len(event_ids) == 0:
             return
-        _aws_session = botocore.session.get_session()
-        _aws_client = _aws_session.create_client('sns', self.region)
+        _aws_client = self._aws_client('sns')
         _aws_client.publish(TopicArn=sns_topic, MessageStructure='json',
             Message=json.dumps({'default': json.dumps({'action': 'dump_price_history', 'event_ids': event_ids})})
         )
 
+    # Builds the zone prices to store (see _build_zone_price()) from price summaries (ZonePriceAccumulators), skipping
+    # zones without listings
+    @staticmethod
+    def build_zone_prices(zones):
+        _zone_prices = []
+        for zone in zones:
+            if zone.tickets_seen == 0:
+                print(' Skipping zone \'{}\' because it has no listings'.format(zone.zone_name))
+                continue
+            _summary = zone.summary()
+            _zone_prices.append(StubHubz._build_zone_price(zone.zone_id, zone.zone_name, zone.min_price, zone.avg_price, zone.max_quantity,
+                    zone.total_tickets, zone.total_listings, zone.avg_price_accurate, _summary['max_price'], _summary['median_price'],
+                    _summary['p10_price'], _summary['p25_price'], _summary['histogram']))
+        return _zone_prices
+
     """
     Builds a dictionary representing a single event's single zone's price summary for storage in DynamoDB. 'avg_price_accurate' means 
-    whether we saw all the listings or not.
+    whether we saw all the listings or not. The max, median, and percentile prices and the histogram (see
+    stubhubz.aggregate.histogram()) are only stored if given.
     """
-    def _build_zone_price(self, zone_id, zone_name, min_price, avg_price, max_ticket_quantity, total_tickets, total_listings, avg_price_accurate):
-        return {
+    @staticmethod
+    def _build_zone_price(zone_id, zone_name, min_price, avg_price, max_ticket_quantity, total_tickets, total_listings, avg_price_accurate,
+            max_price=None, median_price=None, p10_price=None, p25_price=None, histogram=None):
+        _zone_price = {
             'zone_id': zone_id,
             'zone_name': zone_name,
             'min_price': min_price,
@@ -215,4 +544,9 @@ class StubHubz:
             'total_tickets': total_tickets,
             'total_listings': total_listings
         }
+        for _name, _value in [('max_price', max_price), ('median_price', median_price), ('p10_price', p10_price), ('p25_price', p25_price),
+                ('histogram', histogram)]:
+            if _value is not None:
+                _zone_price[_name] = _value
+        return _zone_price
 
@@ -1,14 +1,16 @@
 import json
-import requests
 from datetime import datetime
-from stubhubz.dynamodb import Event
 from stubhubz.model import TicketSource
 
 class TicketMasterApi(TicketSource):
     """Represents the TicketMaster API"""
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, session=None):
         self.api_key = api_key
+        if session is None:
+            from stubhubz.session import get_session
+            session = get_session('ticketmaster')
+        self.session = session # keep-alive connections to app.ticketmaster.com
 
     def __str__(self):
         return "TicketMaster API"
@@ -17,12 +19,13 @@ class TicketMasterApi(TicketSource):
         """Retrieves basic info about an event as a dynamodb.Event or None if not found."""
         _url = 'https://app.ticketmaster.com/discovery/v2/events/' + str(event_id) + '.json'
         _params = {'apikey': str(self.api_key)}
-        _response = requests.get(_url, params=_params)
+        _response = self.session.get(_url, params=_params)
         if _response.status_code == 404:
             return None
         elif _response.status_code != 200:
             raise RuntimeError('Could not get Event {} from TicketMaster. Status: {}. Text: {}'.format(event_id, _response.status_code, _response.text))
         _event_json = json.loads(_response.text)
+        from stubhubz.dynamodb import Event
         _event = Event(_event_json['id'])
         _event.name = _event_json['name']
         _event.date_time = datetime.strptime(_event_json['dates']['start']['dateTime'], '%Y-%m-%dT%H:%M:%S%z')
@@ -39,7 +42,7 @@ class TicketMasterApi(TicketSource):
         """Search for events returning (as text) given the search criteria."""
         _url = 'https://app.ticketmaster.com/discovery/v2/events.json'
         _params = {'apikey': str(self.api_key), 'keyword': name, 'city': city, 'countryCode': country.lower(), 'locale': 'en'}
-        _response = requests.get(_url, params=_params)
+        _response = self.session.get(_url, params=_params)
         if _response.status_code != 200:
             raise RuntimeError('Could not get search for events from TicketMaster. Status: {}. Text: {}'.format(_response.status_code, _response.text))
         _search_results = json.loads(_response.text)
@@ -6,12 +6,21 @@
 # - 'keys.ini' file with the StubHub generated API keys and credentials
 
 import argparse
+import atexit
 import configparser
 import datetime
 
-from stubhubz.dynamodb import StubHubzDynamoDb
+from stubhubz import metrics
+from stubhubz.archive import get_archive
+from stubhubz.cache import get_cache
+from stubhubz.concurrency import TokenBucket
+from stubhubz.dispatch import get_dispatcher
+from stubhubz.storage import get_storage
+from stubhubz.rollup import HOURLY_RETENTION_DAYS, RAW_RETENTION_DAYS
+from stubhubz.schedule import ScrapeScheduler
+from stubhubz.session import get_session
 from stubhubz.ticketmaster import TicketMasterApi
-from stubhubz.stubhub import StubHubApi
+from stubhubz.stubhub import StubHubApi, TokenStore
 from stubhubz.stubhubz import StubHubz
 
 # =====================
@@ -39,6 +48,15 @@ def ask_date(default_date_time):
             print('Error: {}. The date time \'{}\' is invalid. Format should be \'{}\''.format(err, _candidate, _date_time_format))
     return _result
 
+# Parses a --since/--until argument which is either an ISO 8601 date time (UTC unless it has an offset) or how long ago,
+# e.g. '24h' or '7d'
+def parse_date_time_argument(value):
+    if value[-1:] in ('h', 'd') and value[:-1].isdigit():
+        _ago = datetime.timedelta(hours=int(value[:-1])) if value[-1] == 'h' else datetime.timedelta(days=int(value[:-1]))
+        return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - _ago
+    _result = datetime.datetime.fromisoformat(value)
+    return _result if _result.tzinfo is not None else _result.replace(tzinfo=datetime.timezone.utc)
+
 # Ask for generic parameter when updating an event manually
 def ask_generic_input(prompt_name, default_value):
     _result = input('{} (default is \'{}\'): '.format(prompt_name, default_value))
@@ -75,34 +93,86 @@ parser_update_event_manual = subparsers.add_parser('update-event-manual', help='
 parser_scrape = subparsers.add_parser('scrape', help='Checks StubHub prices for events in the Events table')
 parser_scrape.add_argument('id', type=int, nargs='?', default=None, help='The ID of the event')
 parser_scrape.add_argument('--sns', action='store_true', help='Whether to trigger a new price history event to the SNS topic in \'aws.ini\'')
+parser_scrape.add_argument('--workers', type=int, default=1, help='How many events (and zones per event) to scrape concurrently (default is 1)')
+parser_scrape.add_argument('--mode', choices=['zone', 'event'], default='zone', help='Request listings zone by zone (default) or all of an event\'s listings at once and group them into zones locally')
+parser_scrape.add_argument('--full', action='store_true', help='Scrape every event even if its ticket info hasn\'t changed since it was last scraped')
+parser_scrape.add_argument('--ignore-schedule', dest='ignore_schedule', action='store_true', help='Scrape every active event instead of only the ones that are due')
+parser_scrape.add_argument('--budget', type=int, default=None, help='Maximum StubHub API requests to make while scraping (events that don\'t fit are scraped next time)')
+parser_scrape.add_argument('--time-limit', dest='time_limit', type=float, default=None, help='Stop starting to scrape events after this many seconds')
+parser_scrape.add_argument('--shards', type=int, default=1, help='Split the events to scrape into this many shards, each scraped by a worker from --dispatch')
+parser_scrape.add_argument('--dispatch', default='local', help='How shards are sent to workers: \'local\' (default, one after another in this process), \'process[:<processes>]\', \'sns:<topic ARN>\', or \'lambda:<function name>\'')
+parser_scrape.add_argument('--archive', default=None, help='Keep the raw listings of each scrape in this archive for replay: \'file:<directory>\' or \'s3:<bucket>[/<key prefix>]\' (default is Location in the Archive section of \'aws.ini\', if any)')
+parser_scrape.add_argument('--rate-limit', dest='rate_limit', type=float, default=None, help='Maximum StubHub API requests per second shared by all workers')
 parser_dump_events = subparsers.add_parser('dump-events', help='Dumps events out of Event table')
+parser_dump_events.add_argument('--s3', action='store_true', help='Rebuild the events index the UI lists events from (in the S3 bucket in \'aws.ini\') from the Event table instead')
 parser_price_history = subparsers.add_parser('dump-price-history', help='Dumps price history out of the PriceHistory table for an event')
 parser_price_history.add_argument('ids', type=int, nargs='+', help='The IDs of the event separated by spaces')
-parser_price_history.add_argument('--format', dest='format', choices=['text', 'json'], default='text')
+parser_price_history.add_argument('--format', dest='format', choices=['text', 'json', 'columnar'], default='text',
+                                  help='\'columnar\' is a more compact version of \'json\' where each zone is stored as arrays with delta encoded times')
 parser_price_history.add_argument('--s3', action='store_true', help='Whether to store the result to the S3 bucket in \'aws.ini\'. Only if format=\'json\'')
+parser_price_history.add_argument('--incremental', action='store_true', help='With --s3, only export price history since the last export (like Lambda does)')
+parser_price_history.add_argument('--since', type=parse_date_time_argument, default=None, help='Only price history after this ISO 8601 date time (UTC) or how long ago, e.g. \'24h\' or \'7d\'')
+parser_price_history.add_argument('--until', type=parse_date_time_argument, default=None, help='Only price history up to this ISO 8601 date time (UTC) or how long ago')
+parser_price_history.add_argument('--limit', type=int, default=None, help='Only the newest LIMIT price history items')
+parser_compact = subparsers.add_parser('compact-price-history', help='Folds old price history into hourly and daily rollups')
+parser_compact.add_argument('ids', type=int, nargs='*', help='The IDs of the events to compact (default is every event)')
+parser_compact.add_argument('--raw-days', dest='raw_days', type=float, default=RAW_RETENTION_DAYS, help='Fold scrapes older than this many days into hourly rollups (default is {})'.format(RAW_RETENTION_DAYS))
+parser_compact.add_argument('--hourly-days', dest='hourly_days', type=float, default=HOURLY_RETENTION_DAYS, help='Fold anything older than this many days into daily rollups (default is {})'.format(HOURLY_RETENTION_DAYS))
+parser_compact.add_argument('--workers', type=int, default=1, help='How many events to compact concurrently (default is 1)')
+parser_replay = subparsers.add_parser('replay', help='Recomputes price history from the raw listings archive (see scrape --archive) without calling StubHub')
+parser_replay.add_argument('ids', type=int, nargs='*', help='The IDs of the events to replay (default is every archived event)')
+parser_replay.add_argument('--archive', default=None, help='The archive to replay: \'file:<directory>\' or \'s3:<bucket>[/<key prefix>]\' (default is Location in the Archive section of \'aws.ini\')')
+parser_replay.add_argument('--since', type=parse_date_time_argument, default=None, help='Only scrapes after this ISO 8601 date time (UTC) or how long ago, e.g. \'7d\'')
+parser_replay.add_argument('--until', type=parse_date_time_argument, default=None, help='Only scrapes up to this ISO 8601 date time (UTC) or how long ago')
+parser_replay.add_argument('--processes', type=int, default=None, help='How many processes aggregate listings (default is one per CPU)')
+parser_replay.add_argument('--s3', action='store_true', help='Re-export the replayed events\' price history to the S3 bucket in \'aws.ini\' (otherwise it\'s re-exported by their next export)')
+parser_replay.add_argument('--format', dest='format', choices=['json', 'columnar'], default='columnar', help='With --s3, the format to export in (default is columnar, like Lambda)')
 parser_publish_sns = subparsers.add_parser('publish-sns', help='Publishes event IDs to AWS SNS topic to trigger generation of price history to S3')
 parser_publish_sns.add_argument('ids', type=int, nargs='+', help='The ID of the events separated by spaces')
-parser_dynamodb = subparsers.add_parser('dynamodb', help='Create or drop AWS DynamoDB tables')
-parser_dynamodb.add_argument('action', choices=['create', 'drop'])
+parser_dynamodb = subparsers.add_parser('dynamodb', help='Create, migrate (add indexes to existing tables), or drop AWS DynamoDB tables (or the tables of --storage)')
+parser_dynamodb.add_argument('action', choices=['create', 'migrate', 'drop'])
+parser_copy_storage = subparsers.add_parser('copy-storage', help='Copies events and their price history to another storage, e.g. from DynamoDB to SQLite for offline analysis')
+parser_copy_storage.add_argument('to', help='The storage to copy to: \'dynamodb\' or \'sqlite:<path>\'')
+parser_copy_storage.add_argument('ids', type=int, nargs='*', help='The IDs of the events to copy (default is every event)')
 parser.add_argument('-tm', '--ticketmaster', action='store_true', help='Source info from TicketMaster (default is StubHub)')
 parser.add_argument('--debug', action='store_true', help='print debug messages')
+parser.add_argument('--metrics', choices=['json', 'emf'], default=None, help='When done, print each event\'s phase timings and request, byte, and retry counts as JSON lines (\'emf\' is CloudWatch Embedded Metric Format)')
+parser.add_argument('--profile', metavar='PATH', default=None, help='Profile the command with cProfile and tracemalloc and write a report to PATH (and the raw stats to PATH.prof). cProfile only sees the main thread so use --workers 1 to profile scraping')
+parser.add_argument('--storage', default=None, help='Where events and price history are stored: \'dynamodb\' or \'sqlite:<path>\' (default is Backend in the Storage section of \'aws.ini\', or \'dynamodb\')')
 args = parser.parse_args()
 DEBUG = args.debug
 if args.target == None:
     parser.print_help()
     exit()
+if args.profile is not None:
+    _profiler = metrics.Profiler(args.profile)
+    atexit.register(_profiler.stop)
+    _profiler.start()
 
 # Load config
 keys_config = load_config('keys.ini')
 aws_config = load_config('aws.ini')
 
 # Init business logic class
-dynamodb = StubHubzDynamoDb(aws_config['General']['Region'], aws_config['DynamoDB']['Endpoint'])
+storage = get_storage(args.storage or aws_config.get('Storage', 'Backend', fallback='dynamodb'), aws_config['General']['Region'],
+                      aws_config['DynamoDB']['Endpoint'])
 stubhub_api = StubHubApi(keys_config['StubHubV2']['ConsumerKey'], keys_config['StubHubV2']['ConsumerSecret'], keys_config['StubHubV2']['Scope'],
                          keys_config['StubHubV3']['ConsumerKey'], keys_config['StubHubV3']['ConsumerSecret'],
-                         keys_config['Credentials']['User'], keys_config['Credentials']['Password'])
+                         keys_config['Credentials']['User'], keys_config['Credentials']['Password'],
+                         TokenBucket(args.rate_limit) if getattr(args, 'rate_limit', None) else None,
+                         get_session('stubhub', pool_size=max(10, getattr(args, 'workers', 1))),
+                         get_cache(aws_config.get('Cache', 'Backend', fallback='memory')),
+                         TokenStore(get_cache(aws_config.get('Cache', 'Backend', fallback='memory')), keys_config['Credentials']['User']))
 ticketmaster_api = TicketMasterApi(keys_config['TicketMaster']['ApiKey'])
-stubhubz = StubHubz(stubhub_api, ticketmaster_api, dynamodb, aws_config['General']['Region'], DEBUG)
+archive_spec = getattr(args, 'archive', None) or aws_config.get('Archive', 'Location', fallback=None)
+stubhubz = StubHubz(stubhub_api, ticketmaster_api, storage, aws_config['General']['Region'], DEBUG, getattr(args, 'workers', 1),
+                    getattr(args, 'mode', 'zone'), not getattr(args, 'full', False),
+                    None if getattr(args, 'ignore_schedule', False) else ScrapeScheduler(getattr(args, 'budget', None), getattr(args, 'time_limit', None)),
+                    archive=get_archive(archive_spec, aws_config['General']['Region']) if archive_spec and args.target == 'scrape' else None,
+                    events_index=(aws_config['S3']['Bucket'], aws_config['S3']['KeyPrefix']) if aws_config.has_section('S3') else None)
+metrics.set_active(stubhubz.metrics)
+if args.metrics is not None:
+    atexit.register(stubhubz.metrics.write, args.metrics)
 
 ticket_source = ticketmaster_api if args.ticketmaster else stubhub_api
 
@@ -129,10 +199,8 @@ elif args.target == 'event-search':
     print(stubhubz.search_events(_name, _city, _country, ticket_source))
 elif args.target == 'listings':
     print('Getting listings for event {}'.format(args.id))
-    _listings_by_zone = stubhubz.get_stubhub_listing(args.id)
-    for _zone in sorted(_listings_by_zone.keys()):
-        _listing = _listings_by_zone[_zone]
-        print('Zone: {}, zone ID: {}, total listings: {}, total tickets: {}. Listings: \n{}'.format(_zone, _listing['zone_id'], _listing['totalListings'], _listing['totalTickets'], _listing['listings']))
+    for _listing in stubhubz.get_stubhub_listing(args.id):
+        print('Zone: {}, zone ID: {}, total listings: {}, total tickets: {}. Listings: \n{}'.format(_listing['zone_name'], _listing['zone_id'], _listing['totalListings'], _listing['totalTickets'], _listing['listings']))
 elif args.target == 'track-event':
     print('Adding event {} for tracking'.format(args.id))
     stubhubz.track_event(args.id)
@@ -178,7 +246,14 @@ elif args.target == 'update-event-manual':
         print('Event updated')
 elif args.target == 'scrape':
     _scraped_events = []
-    if args.id is None:
+    if args.id is None and args.shards > 1:
+        print('Scraping events in shards...')
+        _dispatcher = get_dispatcher(args.dispatch, lambda message: stubhubz.scrape_shard(message), aws_config['General']['Region'])
+        _scraped_events = stubhubz.scrape_sharded(_dispatcher, args.shards)
+        if _scraped_events is None:
+            print('Shards were dispatched to asynchronous workers which will publish the events they scrape themselves')
+            _scraped_events = []
+    elif args.id is None:
         print('Scraping events...')
         _scraped_events = stubhubz.scrape()
     else:
@@ -189,30 +264,53 @@ elif args.target == 'scrape':
         print('Publishing scraped events to SNS topic {}'.format(_topic))
         stubhubz.notify_new_price_history(_topic, _scraped_events)
 elif args.target == 'dump-events':
-    print('Dumping Event table...')
-    _events = sorted(stubhubz.get_events(), key=lambda event: event.date_time)
-    for event in _events:
-        print(str(event) + '\n')
+    if args.s3:
+        stubhubz.publish_events_index(rebuild=True)
+    else:
+        print('Dumping Event table...')
+        _events = sorted(stubhubz.get_events(), key=lambda event: event.date_time)
+        for event in _events:
+            print(str(event) + '\n')
 elif args.target == 'dump-price-history':
-    if args.s3 and args.format != 'json':
-        print('Aborting. Publishing to S3 can only be done if the format is \'json\'.')
+    if args.s3 and args.format == 'text':
+        print('Aborting. Publishing to S3 can only be done if the format is \'json\' or \'columnar\'.')
     else:
         _s3_bucket = aws_config['S3']['Bucket'] if args.s3 else None
         _s3_key_prefix = aws_config['S3']['KeyPrefix'] if args.s3 else None
         for _event_id in args.ids:
-            print(stubhubz.get_price_history_formatted(_event_id, args.format, _s3_bucket, _s3_key_prefix))
+            if args.s3 and args.incremental:
+                stubhubz.export_price_history(_event_id, _s3_bucket, _s3_key_prefix, True, args.format)
+            else:
+                print(stubhubz.get_price_history_formatted(_event_id, args.format, _s3_bucket, _s3_key_prefix, args.since, args.until, args.limit))
+elif args.target == 'compact-price-history':
+    stubhubz.compact_price_history(args.ids if len(args.ids) > 0 else None, args.raw_days, args.hourly_days)
+elif args.target == 'replay':
+    if not archive_spec:
+        print('Aborting. Give the archive to replay with --archive or Location in the Archive section of \'aws.ini\'.')
+    else:
+        _replayed_events = stubhubz.replay(archive_spec, args.ids if len(args.ids) > 0 else None, args.since, args.until, args.processes)
+        if args.s3:
+            for _event_id in _replayed_events:
+                stubhubz.export_price_history(_event_id, aws_config['S3']['Bucket'], aws_config['S3']['KeyPrefix'], False, args.format)
 elif args.target == 'publish-sns':
     print('Publishing SNS topic')
     _topic = aws_config['SNS']['NewPriceHistoryTopic']
     stubhubz.notify_new_price_history(_topic, args.ids)
 elif args.target == 'dynamodb':
-    _confirmation = input("Are you sure you want to '" + args.action + "' for endpoint '" + aws_config['Endpoint'] + "'? Type 'YES' to proceed: ")
+    _confirmation = input("Are you sure you want to '" + args.action + "' for '" + str(storage) + "'? Type 'YES' to proceed: ")
     if _confirmation != 'YES':
         print('Aborting...')
     else:
         if args.action == 'create':
-            print('Creating DynamoDB tables...')
-            dynamodb.create_tables()
+            print('Creating tables...')
+            storage.create_tables()
+        elif args.action == 'migrate':
+            print('Migrating tables...')
+            storage.migrate_tables()
         elif args.action == 'drop':
-            print('Dropping DynamoDB tables...')
-            dynamodb.drop_tables()
\ No newline at end of file
+            print('Dropping tables...')
+            storage.drop_tables()
+elif args.target == 'copy-storage':
+    _to_storage = get_storage(args.to, aws_config['General']['Region'], aws_config['DynamoDB']['Endpoint'])
+    print('Copying from {} to {}...'.format(storage, _to_storage))
+    stubhubz.copy_storage(_to_storage, args.ids if len(args.ids) > 0 else None)
\ No newline at end of file
@@ -1,48 +1,137 @@
 # AWS Lambda function for StubHubz
 
+# Only what every invocation needs is imported here. The rest (botocore, PynamoDB, requests, NumPy) is imported by the
+# first invocation that uses it, so e.g. an export doesn't pay for importing what scraping needs
 import json
 import os
 
-from stubhubz.dynamodb import StubHubzDynamoDb
-from stubhubz.stubhub import StubHubApi
-from stubhubz.stubhubz import StubHubz
-
 DEBUG = False
+TIME_LIMIT_MARGIN = 60 # seconds of a Lambda's time left for writing and publishing once it stops starting to scrape events
+STUBHUB_ACTIONS = ['scrape', 'scrape_shard'] # the actions which call the StubHub API
+
+# Built by the first invocation and reused by later (warm) invocations of the same container. The stubhubz modules'
+# own module level state (AWS clients, HTTP sessions, caches, and the exporter's and PriceHistoryWriter's copies of what
+# they last wrote) lives as long as the container too, so a warm invocation reuses connections and skips reads. Another
+# container may have written since, so anything read back from that state is checked against storage before it's used
+_STUBHUBZ = None
 
 def handler(event, context):
     global DEBUG
     if os.environ['STUBHUBZ_DEBUG'] == 'True':
         DEBUG = True
-    stubhubz = initStubHubz()
     if 'Records' in event: # This is an SNS topic
         for record in event['Records']:
-            handleEvent(stubhubz, json.loads(record['Sns']['Message']))
+            handleMessage(json.loads(record['Sns']['Message']), context)
     else:
-        handleEvent(stubhubz, event)
+        handleMessage(event, context)
     return None
 
-def handleEvent(stubhubz, event):
+# Handles a message recording its phase timings and request, byte, and retry counts (see stubhubz.metrics). With
+# STUBHUBZ_METRICS set to 'emf' (CloudWatch Embedded Metric Format, which Lambda turns into CloudWatch metrics) or 'json'
+# they're printed after each message
+def handleMessage(message, context):
+    from stubhubz import metrics
+    _stubhubz = getStubHubz(message['action'])
+    _format = os.environ.get('STUBHUBZ_METRICS')
+    try:
+        with metrics.activate(_stubhubz.metrics):
+            handleEvent(_stubhubz, message, context)
+    finally:
+        if _format:
+            _stubhubz.metrics.write(_format)
+        _stubhubz.metrics.reset()
+
+# The 'scrape' action scrapes every due event, or with STUBHUBZ_SCRAPE_SHARDS > 1 splits them into shards which are
+# dispatched (see getDispatcher()) as 'scrape_shard' actions. Each scrape (or shard) publishes the events it scraped to
+# STUBHUBZ_SNS_TOPIC which triggers the 'dump_price_history' action. Its event IDs are likewise split into
+# STUBHUBZ_EXPORT_SHARDS shards (messages marked as a 'shard' aren't split again). The events index the UI lists events
+# from is updated by the scrape itself with the events it changed (see StubHubz.publish_events_index())
+def handleEvent(stubhubz, event, context=None):
     print('Handling action: {}'.format(event['action']))
+    _time_limit = context.get_remaining_time_in_millis() / 1000 - TIME_LIMIT_MARGIN if context is not None else None
     if event['action'] == 'scrape':
         _scraped_events = []
+        _shards = int(os.environ.get('STUBHUBZ_SCRAPE_SHARDS', '1'))
         if 'event_id' in event:
             _scraped_events.append(stubhubz.scrape(event['event_id']))
+        elif _shards > 1:
+            _dispatcher = getDispatcher(stubhubz, context, lambda message: stubhubz.scrape_shard(message, _time_limit))
+            _scraped_events = stubhubz.scrape_sharded(_dispatcher, _shards) or []
         else:
-            _scraped_events = stubhubz.scrape()
-        if 'STUBHUBZ_SNS_TOPIC' in os.environ:
-            _s3_topic = os.environ['STUBHUBZ_SNS_TOPIC']
-            stubhubz.notify_new_price_history(_s3_topic, _scraped_events)
+            _scraped_events = stubhubz.scrape(time_limit=_time_limit)
+        notifyNewPriceHistory(stubhubz, _scraped_events)
+    elif event['action'] == 'scrape_shard':
+        notifyNewPriceHistory(stubhubz, stubhubz.scrape_shard(event, _time_limit))
+    elif event['action'] == 'compact_price_history':
+        from stubhubz.rollup import HOURLY_RETENTION_DAYS, RAW_RETENTION_DAYS
+        stubhubz.compact_price_history(event.get('event_ids'), float(os.environ.get('STUBHUBZ_COMPACT_RAW_DAYS', RAW_RETENTION_DAYS)),
+                float(os.environ.get('STUBHUBZ_COMPACT_HOURLY_DAYS', HOURLY_RETENTION_DAYS)))
     elif event['action'] == 'dump_price_history':
         _event_ids = event['event_ids']
-        if len(_event_ids) > 0:
+        _shards = int(os.environ.get('STUBHUBZ_EXPORT_SHARDS', '1'))
+        if _shards > 1 and len(_event_ids) > 1 and not event.get('shard', False):
+            from stubhubz.dispatch import split_shards
+            _dispatcher = getDispatcher(stubhubz, context, lambda message: handleEvent(stubhubz, message, context))
+            _dispatcher.dispatch([{'action': 'dump_price_history', 'event_ids': _shard, 'shard': True} for _shard in split_shards(_event_ids, _shards)])
+        elif len(_event_ids) > 0:
             _s3_bucket = os.environ['STUBHUBZ_S3_BUCKET']
             _s3_key_prefix = os.environ['STUBHUBZ_S3_KEY_PREFIX']
+            _format = os.environ.get('STUBHUBZ_EXPORT_FORMAT', 'columnar')
             for _event_id in _event_ids:
-                stubhubz.get_price_history_formatted(_event_id, 'json', _s3_bucket, _s3_key_prefix)
+                stubhubz.export_price_history(_event_id, _s3_bucket, _s3_key_prefix, True, _format)
+
+def notifyNewPriceHistory(stubhubz, event_ids):
+    if 'STUBHUBZ_SNS_TOPIC' in os.environ:
+        _s3_topic = os.environ['STUBHUBZ_SNS_TOPIC']
+        stubhubz.notify_new_price_history(_s3_topic, event_ids)
+
+# Returns the dispatcher configured by STUBHUBZ_DISPATCH (see stubhubz.dispatch.get_dispatcher()). The default invokes
+# this Lambda function asynchronously. 'handler' handles messages when dispatching locally
+def getDispatcher(stubhubz, context, handler):
+    from stubhubz.dispatch import get_dispatcher
+    _default = 'lambda:' + context.function_name if context is not None else 'local'
+    return get_dispatcher(os.environ.get('STUBHUBZ_DISPATCH', _default), handler, stubhubz.region)
+
+# Returns the StubHubz built by an earlier invocation, or builds it. The StubHub API is only set up for actions which
+# need it (see STUBHUB_ACTIONS)
+def getStubHubz(action):
+    global _STUBHUBZ
+    if _STUBHUBZ is None:
+        _STUBHUBZ = initStubHubz()
+    if _STUBHUBZ.stubhub is None and action in STUBHUB_ACTIONS:
+        _STUBHUBZ.stubhub = initStubHubApi(_STUBHUBZ.workers)
+    _STUBHUBZ.debug = DEBUG
+    return _STUBHUBZ
 
 def initStubHubz():
+    from stubhubz.schedule import ScrapeScheduler
+    from stubhubz.storage import get_storage
+    from stubhubz.stubhubz import StubHubz
     _region = os.environ['STUBHUBZ_REGION']
     _dynamodb_url = None
+    _workers = int(os.environ.get('STUBHUBZ_SCRAPE_WORKERS', '1'))
+    _scrape_mode = os.environ.get('STUBHUBZ_SCRAPE_MODE', 'zone')
+    _change_detection = os.environ.get('STUBHUBZ_CHANGE_DETECTION', 'true').lower() == 'true'
+    _scheduler = None
+    if os.environ.get('STUBHUBZ_SCHEDULE', 'true').lower() == 'true':
+        _request_budget = int(os.environ.get('STUBHUBZ_REQUEST_BUDGET', '0'))
+        _scheduler = ScrapeScheduler(_request_budget if _request_budget > 0 else None)
+    _storage = get_storage(os.environ.get('STUBHUBZ_STORAGE', 'dynamodb'), _region, _dynamodb_url) # e.g. 'sqlite:<path>' for benchmarks
+    _archive = None
+    if os.environ.get('STUBHUBZ_ARCHIVE'): # keeps each scrape's raw listings, 'file:<directory>' or 's3:<bucket>[/<key prefix>]'
+        from stubhubz.archive import get_archive
+        _archive = get_archive(os.environ['STUBHUBZ_ARCHIVE'], _region)
+    _events_index = None
+    if 'STUBHUBZ_S3_BUCKET' in os.environ:
+        _events_index = (os.environ['STUBHUBZ_S3_BUCKET'], os.environ['STUBHUBZ_S3_KEY_PREFIX'])
+    return StubHubz(None, None, _storage, _region, DEBUG, _workers, _scrape_mode, _change_detection, _scheduler, archive=_archive,
+                    events_index=_events_index)
+
+def initStubHubApi(workers):
+    from stubhubz.cache import get_cache
+    from stubhubz.concurrency import TokenBucket
+    from stubhubz.session import get_session
+    from stubhubz.stubhub import StubHubApi, TokenStore
     _stubhub_v2_consumer_key = os.environ['STUBHUBZ_STUBHUB_V2_CONSUMER_KEY']
     _stubhub_v2_consumer_secret = os.environ['STUBHUBZ_STUBHUB_V2_CONSUMER_SECRET']
     _stubhub_v2_scope = os.environ['STUBHUBZ_STUBHUB_V2_SCOPE']
@@ -50,6 +139,11 @@ def initStubHubz():
     _stubhub_v3_consumer_secret = os.environ['STUBHUBZ_STUBHUB_V3_CONSUMER_SECRET']
     _stubhub_user = os.environ['STUBHUBZ_STUBHUB_USER']
     _stubhub_password = os.environ['STUBHUBZ_STUBHUB_PASSWORD']
-    return StubHubz(StubHubApi(_stubhub_v2_consumer_key, _stubhub_v2_consumer_secret, _stubhub_v2_scope, 
-            _stubhub_v3_consumer_key, _stubhub_v3_consumer_secret, _stubhub_user, _stubhub_password), 
-            None, StubHubzDynamoDb(_region, _dynamodb_url), _region, DEBUG)
+    _cache = os.environ.get('STUBHUBZ_CACHE', 'memory')
+    _token_store = TokenStore(get_cache(os.environ.get('STUBHUBZ_TOKEN_STORE', _cache)), _stubhub_user)
+    _rate_limit = float(os.environ.get('STUBHUBZ_RATE_LIMIT', '0'))
+    _session = get_session('stubhub', pool_size=int(os.environ.get('STUBHUBZ_HTTP_POOL_SIZE', max(10, workers))),
+            read_timeout=float(os.environ.get('STUBHUBZ_HTTP_TIMEOUT', '30')), retries=int(os.environ.get('STUBHUBZ_HTTP_RETRIES', '3')))
+    return StubHubApi(_stubhub_v2_consumer_key, _stubhub_v2_consumer_secret, _stubhub_v2_scope,
+            _stubhub_v3_consumer_key, _stubhub_v3_consumer_secret, _stubhub_user, _stubhub_password,
+            TokenBucket(_rate_limit) if _rate_limit > 0 else None, _session, get_cache(_cache), _token_store)
@@ -1,8 +1,87 @@
-function renderPriceHistory(eventId, chartTitle){
+// Price history is split into segments listed by a manifest which also lists downsampled resolutions ('overview', 'daily')
+// of the whole history. 'full' loads every segment. Events exported before segments existed only have a single file
+function loadPriceHistory(eventId, resolution, callback){
 	$.ajax({
-		url: '/price_history/' + eventId + '.js',
+		url: '/price_history/' + eventId + '/manifest.js',
 		dataType: 'json'
-	}).done(function(response){
+	}).done(function(manifest){
+		if (resolution != 'full' && manifest.resolutions && manifest.resolutions.hasOwnProperty(resolution)){
+			$.ajax({
+				url: '/price_history/' + eventId + '/' + manifest.resolutions[resolution],
+				dataType: 'json'
+			}).done(function(response){
+				callback(decodeZones(response), false);
+			});
+			return;
+		}
+		var requests = manifest.segments.map(function(segment){
+			return $.ajax({url: '/price_history/' + eventId + '/' + segment, dataType: 'json'});
+		});
+		$.when.apply($, requests).done(function(){
+			var segments = requests.length == 1 ? [arguments[0]] : Array.prototype.map.call(arguments, function(args){ return args[0]; });
+			callback(mergeSegments(segments), true);
+		});
+	}).fail(function(){
+		$.ajax({
+			url: '/price_history/' + eventId + '.js',
+			dataType: 'json'
+		}).done(function(response){
+			callback(response, true);
+		});
+	});
+}
+
+// Joins each zone's data across segments (in segment order) into one dataset per zone sorted by zone name
+function mergeSegments(segments){
+	var datasetsByZone = {};
+	segments.forEach(function(segment){
+		decodeZones(segment).forEach(function(zone){
+			if (datasetsByZone.hasOwnProperty(zone.zone)){
+				datasetsByZone[zone.zone].data = datasetsByZone[zone.zone].data.concat(zone.data);
+				datasetsByZone[zone.zone].histogram = zone.histogram || datasetsByZone[zone.zone].histogram;
+			}else{
+				datasetsByZone[zone.zone] = zone;
+			}
+		});
+	});
+	return Object.keys(datasetsByZone).sort().map(function(zone){ return datasetsByZone[zone]; });
+}
+
+// Returns the Chart.js datasets of an exported segment/resolution. Version 2 (columnar) stores each zone as arrays with times
+// as a start plus deltas (in seconds) and prices in cents
+function decodeZones(exported){
+	if (exported.version != 2){
+		return exported.zones;
+	}
+	return exported.zones.map(function(zone){
+		var data = [];
+		var time = zone.start;
+		for (var i = 0; i < zone.dt.length; i++){
+			time += zone.dt[i];
+			var point = {
+				x: time * 1000,
+				y: zone.y[i] / 100,
+				avgPrice: zone.avgPrice[i] / 100,
+				totalTickets: zone.totalTickets[i],
+				totalListings: zone.totalListings[i]
+			};
+			if (zone.avgPriceAccurate[i] != null){
+				point.avgPriceAccurate = zone.avgPriceAccurate[i] == 1;
+			}
+			['maxPrice', 'medianPrice', 'p10Price', 'p25Price'].forEach(function(stat){
+				if (zone.hasOwnProperty(stat) && zone[stat][i] != null){
+					point[stat] = zone[stat][i] / 100;
+				}
+			});
+			data.push(point);
+		}
+		return {zone: zone.zone, data: data, histogram: zone.histogram};
+	});
+}
+
+function renderPriceHistory(eventId, chartTitle){
+	window.currentEvent = {id: eventId, title: chartTitle};
+	loadPriceHistory(eventId, $('#resolution').val(), function(response, needsDownsample){
 		config.data.datasets = response;
 		config.options.title.text = chartTitle;
 		for(var i = 0; i < response.length; i++){
@@ -11,7 +90,9 @@ function renderPriceHistory(eventId, chartTitle){
 			dataset.borderColor = window.chartColors[i];
 			dataset.backgroundColor = window.chartColors[i];
 			dataset.fill = false;
-			dataset.data = downsample(dataset.data, 300);
+			if (needsDownsample){
+				dataset.data = downsample(dataset.data, 300);
+			}
 		}
 		if (window.myLine == undefined){
 			var ctx = document.getElementById('canvas').getContext('2d');
@@ -22,27 +103,36 @@ function renderPriceHistory(eventId, chartTitle){
 	});
 }
 
+// Loads the events index published to S3 next to the price history (already filtered and sorted, with each event's
+// latest min price) and falls back to API Gateway's dump of the Event table if it hasn't been published yet
+function loadEvents(){
+	$.ajax({
+		url: '/price_history/events.js',
+		dataType: 'json'
+	}).done(handleEventResponse).fail(function(){
+		$.ajax({
+			url: '/event',
+			dataType: 'json'
+		}).done(handleEventResponse);
+	});
+}
+
 function handleEventResponse(response){
+	var indexed = response.version != undefined;
 	eventArray = [];
 	response.events.forEach(function(event) {
-		if (event.eventStatus == "" && event.scrapeStatus == ""){
+		if (!indexed && event.eventStatus == "" && event.scrapeStatus == ""){
 			return;//skip this bad event
 		}
-		var venue = event.venueName;
-		if (event.venueCity != ''){
-			if (venue == ''){
-				venue = event.venueCity;
-			}else{
-				venue += ', ' + event.venueCity
-			}
-		}
+		var venue = indexed ? event.venue : formatVenue(event.venueName, event.venueCity);
 		eventArray[eventArray.length] = [
 			event.id,
 			event.primaryPerformer,
 			venue,
 			formatIso8601Date(event.dateTime, false),
 			formatScrapeStatus(event.scrapeStatus),
-			formatIso8601Date(event.lastScrapedDateTime, true)
+			formatIso8601Date(event.lastScrapedDateTime, true),
+			event.minPrice != null ? event.minPrice.toFixed(2) : ''
 		];
 	});
 	$.fn.dataTable.moment('DD MMM YYYY HH:mmZZ', 'en');
@@ -54,18 +144,34 @@ function handleEventResponse(response){
 			{title: 'Venue'},
 			{title: 'Event Date'},
 			{title: 'Status'},
-			{title: 'Last Update Time'}
+			{title: 'Last Update Time'},
+			{title: 'Min Price', type: 'num'}
 		],
+		'order': [],
 		'paging': false,
 		'searching': false
 	});
-	eventsDataTable.order([4, 'desc'], [3, 'asc']).draw();
+	if (!indexed){
+		eventsDataTable.order([4, 'desc'], [3, 'asc']).draw();
+	}
 	$('#eventsTable tbody').on('click', 'tr', function () {
 		var data = eventsDataTable.row(this).data();
 		renderPriceHistory(data[0], formatChartTitle(data[1], data[2]));
 	});
 }
 
+function formatVenue(venueName, venueCity){
+	var venue = venueName;
+	if (venueCity != ''){
+		if (venue == ''){
+			venue = venueCity;
+		}else{
+			venue += ', ' + venueCity
+		}
+	}
+	return venue;
+}
+
 function formatChartTitle(primaryPerformer, venue){
 	if (primaryPerformer){
 		return venue ? primaryPerformer + " (" + venue + ")" : primaryPerformer;
@@ -105,11 +211,31 @@ function getTooltipFooter(tooltipItems, data) {
 		label = isAccurate ? 'Average Price: ' : 'Approx Average Price: ';
 		footer.push(label + point['avgPrice'])
 	}
+	if (point.hasOwnProperty('medianPrice')){
+		footer.push('Median Price: ' + point['medianPrice'])
+	}
+	if (point.hasOwnProperty('p10Price') && point.hasOwnProperty('p25Price')){
+		footer.push('10th/25th Percentile: ' + point['p10Price'] + ' / ' + point['p25Price'])
+	}
+	if (point.hasOwnProperty('maxPrice')){
+		footer.push('Max Price: ' + point['maxPrice'])
+	}
 	if (point.hasOwnProperty('totalTickets')){
 		footer.push('Total Tickets: ' + point['totalTickets'])
 	}
 	if (point.hasOwnProperty('totalListings')){
 		footer.push('Total Listings: ' + point['totalListings'])
 	}
+	// The latest tickets by price (only exported for the latest scrape) on the zone's last point
+	var dataset = data.datasets[tooltipItems[0].datasetIndex];
+	if (dataset.histogram && tooltipItems[0].index == dataset.data.length - 1){
+		footer.push('Tickets by price:');
+		dataset.histogram.tickets.forEach(function(tickets, i){
+			if (tickets > 0){
+				var start = dataset.histogram.start + i * dataset.histogram.width;
+				footer.push('  ' + start.toFixed(2) + ' - ' + (start + dataset.histogram.width).toFixed(2) + ': ' + tickets);
+			}
+		});
+	}
 	return footer;
 }
\ No newline at end of file